@@ -0,0 +1,3 @@
+# This package contains benchmarks for the SDM backend. They are
+# intended to be run from the sdm-server directory, e.g.:
+#     python -m benchmarks.asgi_concurrency
@@ -0,0 +1,64 @@
+# This benchmark compares how the synchronous Flask endpoints and their
+# asynchronous ASGI variants (sdm_server.asgi) scale with the number of
+# concurrent clients. Both servers are started as local processes against
+# the same seeded SQLite database and driven with identical request mixes.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.asgi_concurrency --concurrency 1,4,16,64 --requests 50
+#
+# The results are printed as JSON.
+import argparse
+import json
+import os
+import tempfile
+from benchmarks import common
+
+READ_ENDPOINTS = ['/api/all-recipes', '/api/filtered-recipes', '/api/partial-filter', '/api/user-ingredients']
+CABINET = ['banana', 'strawberry', 'mango', 'orange juice', 'ice', 'yogurt', 'water', 'peanut butter']
+
+def run(concurrency_levels, requests_per_client):
+    """
+    Seeds a temporary database, then benchmarks the Flask and ASGI servers
+    at every concurrency level.
+    Parameters
+    ----------
+    concurrency_levels : List
+        The numbers of concurrent clients to benchmark.
+    requests_per_client : int
+        The number of requests each client issues per level.
+    Returns
+    -------
+    results : dict
+        The per-server, per-level summaries.
+    """
+    workdir = tempfile.mkdtemp(prefix='sdm-bench-')
+    common.use_database(os.path.join(workdir, 'bench.db'))
+    common.seed_catalog()
+    header = common.create_user('bench', CABINET)
+
+    results = {'endpoints': READ_ENDPOINTS, 'requests_per_client': requests_per_client}
+    servers = {'sync': common.flask_server_command, 'async': common.asgi_server_command}
+    for name, command in servers.items():
+        port = common.free_port()
+        process = common.start_server(command(port), port)
+        try:
+            urls = ['http://127.0.0.1:{}{}'.format(port, endpoint) for endpoint in READ_ENDPOINTS]
+            # Warm up connections, caches and the import of lazily loaded modules.
+            common.drive(urls, header, 1, len(urls))
+            results[name] = {str(level): common.drive(urls, header, level, requests_per_client)
+                             for level in concurrency_levels}
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sync and async read endpoint scaling.")
+    parser.add_argument('--concurrency', default='1,4,16,64', help="Comma separated concurrency levels.")
+    parser.add_argument('--requests', type=int, default=50, help="Requests issued by each client per level.")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.concurrency.split(',')]
+    print(json.dumps(run(levels, args.requests), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# This benchmark compares the recipe and ingredient listings served from the
+# in-memory catalog (sdm_server.catalog) with building them from ORM
+# instances, as the endpoints did before: load every Recipe and Ingredient
+# through the session, then copy them into dictionaries and capitalize the
+# names. For both it reports the latency of a listing and the peak memory
+# allocated while building it, and for the catalog the time to read it and
+# the memory it keeps.
+#
+# Every listing starts with a new session, like a request does, so the ORM
+# path cannot reuse the identity map of the previous listing.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.catalog --ingredients 2000 --recipes 30000
+#
+# The results are printed as JSON.
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from operator import itemgetter
+from benchmarks import common, generator
+
+def orm_recipe_listing():
+    """
+    Lists every Recipe from ORM instances.
+    """
+    from sdm_server import db
+    from sdm_server.models import Recipe, Ingredients, recipe_ingredients
+    ingredients_by_recipe = {}
+    rows = db.session.query(recipe_ingredients.c.recipe_id, Ingredients) \
+                     .join(Ingredients, Ingredients.id == recipe_ingredients.c.ingredient_id)
+    for recipe_id, ingredient in rows:
+        ingredients_by_recipe.setdefault(recipe_id, []).append(ingredient)
+    output = []
+    for recipe in Recipe.query.all():
+        output.append({'name': recipe.name, 'instructions': recipe.instructions,
+                       'ingredients': [ingredient.name.capitalize() for ingredient in ingredients_by_recipe.get(recipe.id, [])]})
+    return sorted(output, key=itemgetter('name'))
+
+def orm_ingredient_listing():
+    """
+    Lists every Ingredient from ORM instances.
+    """
+    from sdm_server.models import Ingredients
+    output = [{'name': ingredient.name.capitalize(), 'type': ingredient.ingredient_type.capitalize(),
+               'quantity': 0, 'favorite': "False"} for ingredient in Ingredients.query.all()]
+    return sorted(output, key=itemgetter('name'))
+
+def catalog_recipe_listing():
+    """
+    Lists every Recipe from the catalog.
+    """
+    from sdm_server import catalog
+    return catalog.get_catalog().recipe_listings()
+
+def catalog_ingredient_listing():
+    """
+    Lists every Ingredient from the catalog.
+    """
+    from sdm_server import catalog
+    return [{'name': ingredient.display_name, 'type': ingredient.type, 'quantity': 0, 'favorite': "False"}
+            for ingredient in catalog.get_catalog().sorted_ingredients]
+
+def measure(listing, repeat):
+    """
+    Measures a listing function, each call with a new session.
+    Returns
+    -------
+    results : dict
+        The mean, median and 95th percentile latency in milliseconds, and the peak memory of one call in MiB.
+    """
+    from sdm_server import db
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        listing()
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.remove()
+    tracemalloc.start()
+    listing()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.remove()
+    return {'mean_ms': statistics.mean(timings), 'median_ms': statistics.median(timings),
+            'p95_ms': common.percentile(timings, 0.95), 'peak_mb': peak / 2 ** 20}
+
+def run(n_ingredients, n_recipes, repeat, seed, database=None):
+    """
+    Generates the dataset and measures both ways of building the listings.
+    Parameters
+    ----------
+    n_ingredients, n_recipes, seed : int
+        The dataset parameters passed to benchmarks.generator.generate.
+    repeat : int
+        The number of times each listing is built.
+    database : str
+        An optional database path; a temporary file is used by default.
+    Returns
+    -------
+    results : dict
+        The parameters, the catalog's read time and size, and the figures of each listing.
+    """
+    database = database or os.path.join(tempfile.mkdtemp(prefix='sdm-bench-'), 'bench.db')
+    common.use_database(database)
+    dataset = generator.generate(n_ingredients, n_recipes, 0, seed)
+
+    from sdm_server import catalog, db
+    from sdm_server.models import Data_Version
+    version, = Data_Version.lookup('catalog')
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = catalog.build_catalog(version)
+    build_ms = (time.perf_counter() - start) * 1000
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    db.session.remove()
+    del records
+    # Read once, so that the measured listings use the cached catalog.
+    catalog.get_catalog()
+
+    return {
+        'parameters': {'ingredients': n_ingredients, 'recipes': n_recipes, 'repeat': repeat, 'seed': seed},
+        'dataset': dataset,
+        'catalog_build_ms': build_ms,
+        'catalog_mb': retained / 2 ** 20,
+        'recipes': {'orm': measure(orm_recipe_listing, repeat), 'catalog': measure(catalog_recipe_listing, repeat)},
+        'ingredients': {'orm': measure(orm_ingredient_listing, repeat), 'catalog': measure(catalog_ingredient_listing, repeat)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare listings served from the in-memory catalog with ORM instances.")
+    parser.add_argument('--ingredients', type=int, default=1000)
+    parser.add_argument('--recipes', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.ingredients, args.recipes, args.repeat, args.seed), indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# This file provides helpers shared by the SDM benchmarks: pointing the
+# application at a throwaway database, seeding it, launching servers as
+# local processes and driving concurrent HTTP requests against them.
+import csv
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+SERVER_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INGREDIENTS_CSV = os.path.join(SERVER_ROOT, 'tests', 'ingredients.csv')
+RECIPES_CSV = os.path.join(SERVER_ROOT, 'tests', 'Recipes.csv')
+
+def use_database(path):
+    """
+    Points the sdm_server package at a SQLite database file. This must be
+    called before sdm_server is imported, because the database URI is read
+    when the package is initialized.
+    Parameters
+    ----------
+    path : str
+        The path of the SQLite database file.
+    Returns
+    -------
+    uri : str
+        The SQLAlchemy URI of the database file.
+    """
+    uri = 'sqlite:///' + os.path.abspath(path)
+    os.environ['SDM_DATABASE_URI'] = uri
+    return uri
+
+def seed_catalog(ingredients_csv=INGREDIENTS_CSV, recipes_csv=RECIPES_CSV):
+    """
+    Creates the database schema and loads the Ingredients and Recipes from
+    the CSV fixtures, linking every Recipe to the Ingredients listed in the
+    third column of the recipe file.
+    Parameters
+    ----------
+    ingredients_csv : str
+        The path of the ingredient fixture file.
+    recipes_csv : str
+        The path of the recipe fixture file.
+    """
+    from sdm_server import db
+    from sdm_server.models import Ingredients, Recipe
+    db.create_all()
+    ingredients = {}
+    with open(ingredients_csv, newline='') as f:
+        for line in csv.reader(f, delimiter=','):
+            name = line[0].lower()
+            if(name not in ingredients):
+                ingredients[name] = Ingredients(name=name, ingredient_type=line[1].lower(), quantity=line[2], is_favorite=line[3] == 'True')
+                db.session.add(ingredients[name])
+    with open(recipes_csv, newline='') as f:
+        for line in csv.reader(f, delimiter=';'):
+            recipe = Recipe(name=line[0], instructions=line[1])
+            db.session.add(recipe)
+            for name in {name.strip().lower() for name in line[2].split(',')}:
+                if(name in ingredients):
+                    ingredients[name].used_in.append(recipe)
+    db.session.commit()
+
+def create_user(username, ingredients=()):
+    """
+    Registers a benchmark User, optionally fills the cabinet, and returns
+    an Authorization header for it.
+    Parameters
+    ----------
+    username : str
+        The username (and e-mail) of the User to create.
+    ingredients : List
+        The names of Ingredients to add to the User's cabinet.
+    Returns
+    -------
+    header : dict
+        An Authorization header containing a valid JWT for the User.
+    """
+    from sdm_server.models import User
+    from sdm_server.validators import add_new_user, generate_token, update_database_ingredients
+    add_new_user(username, 'benchmark', username)
+    user = User.query.filter_by(username=username).first()
+    for name in ingredients:
+        update_database_ingredients(user, name, 1, 'False')
+    token = generate_token(user, 'benchmark')
+    return {'Authorization': 'Bearer ' + token.decode('UTF-8')}
+
+def free_port():
+    """
+    Returns a TCP port on the loopback interface that is currently unused.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(command, port, timeout=30, log=None):
+    """
+    Launches a server as a local child process and waits until it accepts
+    connections. The child inherits the current environment, including the
+    SDM_DATABASE_URI set by use_database.
+    Parameters
+    ----------
+    command : List
+        The command line used to start the server.
+    port : int
+        The port the server listens on.
+    timeout : int
+        The number of seconds to wait for the server to start.
+    log : file
+        An optional open file that receives the server's output, e.g. to
+        inspect logged exceptions. The output is discarded by default.
+    Returns
+    -------
+    process : Popen
+        The running server process. The caller is responsible for terminating it.
+    """
+    output = log if log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=SERVER_ROOT, stdout=output, stderr=output)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server '{}' did not start on port {}.".format(' '.join(command), port))
+
+def flask_server_command(port):
+    """
+    Returns the command line that serves the synchronous Flask application.
+    """
+    return [sys.executable, '-c', 'from sdm_server import app; app.run(port={}, threaded=True)'.format(port)]
+
+def asgi_server_command(port):
+    """
+    Returns the command line that serves the asynchronous ASGI application.
+    """
+    return [sys.executable, '-m', 'uvicorn', 'sdm_server.asgi:application', '--port', str(port), '--log-level', 'warning']
+
+def timed_request(url, method='GET', headers=None, body=None):
+    """
+    Issues one HTTP request and measures its latency.
+    Parameters
+    ----------
+    url : str
+        The absolute URL to request.
+    method : str
+        The HTTP method.
+    headers : dict
+        Additional request headers.
+    body : dict
+        An optional object that is sent as a JSON request body.
+    Returns
+    -------
+    result : tuple
+        A (status, seconds, payload) tuple. The status is 0 if the connection failed.
+    """
+    data = json.dumps(body).encode('UTF-8') if body is not None else None
+    request = Request(url, data=data, method=method, headers=dict(headers or {}))
+    if(data is not None):
+        request.add_header('Content-Type', 'application/json')
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=60) as response:
+            payload = response.read()
+            status = response.status
+    except HTTPError as e:
+        payload = e.read()
+        status = e.code
+    except (URLError, OSError) as e:
+        payload = str(e).encode('UTF-8')
+        status = 0
+    return status, time.perf_counter() - start, payload
+
+def percentile(values, fraction):
+    """
+    Returns the value at a fraction (0 to 1) of the sorted values, using the nearest-rank method.
+    """
+    if(not values):
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def summarize(latencies, errors, elapsed):
+    """
+    Summarizes a list of request latencies into throughput and percentile figures.
+    Parameters
+    ----------
+    latencies : List
+        The latencies of the successful requests, in seconds.
+    errors : int
+        The number of failed requests.
+    elapsed : float
+        The wall-clock duration of the run, in seconds.
+    Returns
+    -------
+    summary : dict
+        A dictionary with request counts, throughput and latencies in milliseconds.
+    """
+    total = len(latencies) + errors
+    return {
+        'requests': total,
+        'errors': errors,
+        'error_rate': errors / total if total else 0.0,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+def drive(urls, headers, concurrency, requests_per_client):
+    """
+    Issues GET requests from a number of concurrent client threads. Each
+    client cycles through the supplied URLs.
+    Parameters
+    ----------
+    urls : List
+        The absolute URLs to request.
+    headers : dict
+        The request headers, usually an Authorization header.
+    concurrency : int
+        The number of concurrent clients.
+    requests_per_client : int
+        The number of requests each client issues.
+    Returns
+    -------
+    summary : dict
+        The summary produced by summarize().
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def client(offset):
+        for i in range(requests_per_client):
+            status, seconds, _ = timed_request(urls[(offset + i) % len(urls)], headers=headers)
+            with lock:
+                if(status == 200):
+                    latencies.append(seconds)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - start)
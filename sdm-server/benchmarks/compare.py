@@ -0,0 +1,49 @@
+# This file compares two result files written by benchmarks.endpoints,
+# e.g. from two commits, and prints the change of the median latency and
+# of the SQL statements per request for every scenario.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.compare before.json after.json
+import argparse
+import json
+
+def compare(before, after):
+    """
+    Compares two benchmark result documents.
+    Parameters
+    ----------
+    before : dict
+        The baseline results.
+    after : dict
+        The results to compare against the baseline.
+    Returns
+    -------
+    rows : List
+        A List of (scenario, before_ms, after_ms, ratio, before_queries, after_queries)
+        tuples for the scenarios present in both documents.
+    """
+    rows = []
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old, new = before['results'][name], after['results'][name]
+        ratio = new['median_ms'] / old['median_ms'] if old['median_ms'] else float('inf')
+        rows.append((name, old['median_ms'], new['median_ms'], ratio,
+                     old['queries_per_request'], new['queries_per_request']))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two endpoint benchmark result files.")
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if(before['parameters'] != after['parameters']):
+        print("Warning: the runs used different parameters, {} and {}.".format(before['parameters'], after['parameters']))
+    print("{:<28} {:>12} {:>12} {:>8} {:>10}".format('scenario', 'before ms', 'after ms', 'ratio', 'queries'))
+    for name, old, new, ratio, old_queries, new_queries in compare(before, after):
+        print("{:<28} {:>12.2f} {:>12.2f} {:>7.2f}x {:>4g} -> {:<4g}".format(name, old, new, ratio, old_queries, new_queries))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# This benchmark times every endpoint in sdm_server.routes through the
+# Flask test client against a synthetic dataset (see benchmarks.generator).
+# The results are written as JSON, together with the commit and dataset
+# parameters, so that runs on different commits can be compared.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.endpoints --ingredients 2000 --recipes 10000 --users 500 --output results.json
+#
+# With --database, a database made by benchmarks.generator is used instead of
+# generating one. The benchmark runs on a copy, because the write scenarios
+# change the cabinet, so several runs can use the same database.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from benchmarks import common, generator
+
+def scenarios(user, header):
+    """
+    Returns the benchmark scenarios, one or more per endpoint. Read-only
+    scenarios come first, because the write scenarios change the cabinet.
+    Parameters
+    ----------
+    user : User
+        The User whose cabinet is used by the scenarios.
+    header : dict
+        The Authorization header of the User.
+    Returns
+    -------
+    scenarios : List
+        A List of (name, method, path, headers, body) tuples. The body is a
+        function of the iteration number, so that writes can alternate.
+    """
+    from sdm_server.models import Recipe
+    cabinet = [ingredient.name for ingredient in user.ingredients.limit(5)]
+    outside = [ingredient.name for ingredient in ingredients_outside_cabinet(user, 5)]
+    recipes = [recipe.name for recipe in Recipe.query.limit(10)]
+    token = user.get_reset_token()
+    none = lambda i: None
+    return [
+        ('index', 'GET', '/', {}, none),
+        ('metrics', 'GET', '/metrics', {}, none),
+        ('authenticate', 'POST', '/api/authenticate', header, none),
+        ('all-ingredients', 'GET', '/api/all-ingredients', header, none),
+        ('custom-ingredients', 'GET', '/api/custom-ingredients', header, none),
+        ('user-ingredients', 'GET', '/api/user-ingredients', header, none),
+        ('all-recipes', 'GET', '/api/all-recipes', header, none),
+        ('filtered-recipes', 'GET', '/api/filtered-recipes', header, none),
+        ('partial-filter', 'GET', '/api/partial-filter', header, none),
+        ('recipe-servings', 'GET', '/api/recipe-servings', header, none),
+        ('shopping-list-optimize', 'GET', '/api/shopping-list/optimize?budget=5', header, none),
+        ('shopping-list', 'POST', '/api/shopping-list', header, lambda i: {'recipes': recipes}),
+        ('similar-recipes', 'GET', '/api/recipes/{}/similar'.format(recipes[0]), header, none),
+        ('recommendations', 'GET', '/api/recommendations', header, none),
+        ('login', 'POST', '/api/login', {}, lambda i: {'loginId': user.username, 'password': generator.PASSWORD}),
+        ('register', 'POST', '/api/register', {},
+         lambda i: {'username': 'bench-new-{}'.format(i), 'password': 'pass', 'email': 'bench-new-{}'.format(i)}),
+        # An unknown login id is used, so that no e-mail is sent.
+        ('forgot-password', 'POST', '/api/forgot-password', {}, lambda i: {'loginId': 'bench-unknown'}),
+        ('reset-password', 'POST', '/api/forgot-password/' + token, {}, lambda i: {'newPassword': generator.PASSWORD}),
+        ('update-ingredient', 'PATCH', '/api/all-ingredients', header,
+         lambda i: {'name': cabinet[i % len(cabinet)] if cabinet else outside[0], 'quantity': i % 7, 'isFavorite': str(i % 2 == 0)}),
+        ('add-user-ingredients', 'POST', '/api/user-ingredients', header, lambda i: {'ingredients': outside}),
+        ('delete-user-ingredients', 'DELETE', '/api/user-ingredients', header, lambda i: {'ingredients': outside}),
+        ('create-custom-ingredient', 'POST', '/api/custom-ingredients', header,
+         lambda i: {'name': 'bench custom {}'.format(i), 'type': 'liquid'}),
+        ('delete-custom-ingredient', 'DELETE', '/api/custom-ingredients', header,
+         lambda i: {'name': 'bench custom {}'.format(i)}),
+    ]
+
+def ingredients_outside_cabinet(user, count):
+    """
+    Returns Ingredients that are not in the User's cabinet.
+    """
+    from sdm_server.models import Ingredients
+    from sdm_server.validators import get_user_ingredient_ids
+    cabinet = get_user_ingredient_ids(user)
+    return [ingredient for ingredient in Ingredients.query.limit(count + len(cabinet)) if ingredient.id not in cabinet][:count]
+
+def time_scenario(client, method, path, headers, body, repeat, warmup):
+    """
+    Times one scenario through the Flask test client.
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client of the application.
+    method : str
+        The HTTP method.
+    path : str
+        The request path.
+    headers : dict
+        The request headers.
+    body : function
+        Returns the JSON body for an iteration, or None.
+    repeat : int
+        The number of timed iterations.
+    warmup : int
+        The number of untimed iterations run first.
+    Returns
+    -------
+    result : dict
+        Timing statistics in milliseconds, the status codes and the SQL
+        statements executed per request.
+    """
+    from sdm_server import db
+    from sqlalchemy import event
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+
+    timings, statuses = [], set()
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for i in range(warmup + repeat):
+            data = body(i)
+            kwargs = {'headers': headers}
+            if(data is not None):
+                kwargs.update(data=json.dumps(data), content_type='application/json')
+            if(i == warmup):
+                queries[0] = 0
+            start = time.perf_counter()
+            response = client.open(path, method=method, **kwargs)
+            elapsed = time.perf_counter() - start
+            if(i >= warmup):
+                timings.append(elapsed * 1000)
+                statuses.add(response.status_code)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return {
+        'method': method,
+        'path': path,
+        'repeat': repeat,
+        'status_codes': sorted(statuses),
+        'mean_ms': statistics.mean(timings),
+        'median_ms': statistics.median(timings),
+        'p95_ms': common.percentile(timings, 0.95),
+        'min_ms': min(timings),
+        'max_ms': max(timings),
+        'queries_per_request': queries[0] / repeat,
+    }
+
+def current_commit():
+    """
+    Returns the git commit the benchmark runs on, or None outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=common.SERVER_ROOT,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(n_ingredients, n_recipes, n_users, seed, repeat, warmup, only=None, database=None):
+    """
+    Generates the dataset and times every scenario.
+    Parameters
+    ----------
+    n_ingredients, n_recipes, n_users, seed : int
+        The dataset parameters passed to benchmarks.generator.generate.
+    repeat : int
+        The number of timed iterations per scenario.
+    warmup : int
+        The number of untimed iterations per scenario.
+    only : List
+        Optional scenario names to restrict the run to.
+    database : str
+        An optional database made by benchmarks.generator, which is copied and used instead
+        of generating a dataset. The dataset parameters are ignored then.
+    Returns
+    -------
+    results : dict
+        The run metadata and the per-scenario results.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='sdm-bench-'), 'bench.db')
+    common.use_database(path)
+    if(database):
+        shutil.copyfile(database, path)
+        dataset = {'database': os.path.abspath(database)}
+    else:
+        dataset = generator.generate(n_ingredients, n_recipes, n_users, seed)
+
+    from sdm_server import app, db
+    from sdm_server.models import User, user_ingredients
+    from sdm_server.validators import generate_token
+    # The median User by cabinet size is representative of the dataset.
+    sizes = db.session.query(User.id, db.func.count(user_ingredients.c.ingredient_id)) \
+                      .outerjoin(user_ingredients, user_ingredients.c.user_id == User.id) \
+                      .group_by(User.id).order_by(db.func.count(user_ingredients.c.ingredient_id), User.id).all()
+    user_id, cabinet_size = sizes[len(sizes) // 2]
+    user = User.query.get(user_id)
+    header = {'Authorization': 'Bearer ' + generate_token(user, generator.PASSWORD).decode('UTF-8')}
+    client = app.test_client()
+
+    results = {}
+    covered = set()
+    adapter = app.url_map.bind('localhost')
+    for name, method, path, headers, body in scenarios(user, header):
+        if(only and name not in only):
+            continue
+        results[name] = time_scenario(client, method, path, headers, body, repeat, warmup)
+        rule, _ = adapter.match(path.split('?')[0], method=method, return_rule=True)
+        covered.add('{} {}'.format(method, rule.rule))
+
+    # Every route should have a scenario; new routes without one are reported.
+    rules = {'{} {}'.format(method, rule.rule) for rule in app.url_map.iter_rules() if rule.endpoint != 'static'
+             for method in rule.methods - {'HEAD', 'OPTIONS'}}
+    return {
+        'commit': current_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'parameters': {'ingredients': n_ingredients, 'recipes': n_recipes, 'users': n_users, 'seed': seed,
+                       'repeat': repeat, 'warmup': warmup},
+        'dataset': dataset,
+        'cabinet_size': cabinet_size,
+        'uncovered_routes': sorted(rules - covered) if not only else [],
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every SDM endpoint on a synthetic dataset.")
+    parser.add_argument('--ingredients', type=int, default=1000)
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--only', help="Comma separated scenario names to run.")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument('--database', help="Use a copy of this database from benchmarks.generator instead of generating one.")
+    args = parser.parse_args()
+    results = run(args.ingredients, args.recipes, args.users, args.seed, args.repeat, args.warmup,
+                  args.only.split(',') if args.only else None, args.database)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if(args.output):
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# This file generates synthetic SDM datasets of arbitrary size. The data
+# is drawn from a seeded random generator, so the same parameters always
+# produce the same database, and runs on different commits can be compared.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.generator bench.db --ingredients 5000 --recipes 20000 --users 1000
+import argparse
+import random
+from werkzeug.security import generate_password_hash
+
+# Ingredient types, weighted like the bundled ingredient fixtures.
+INGREDIENT_TYPES = ['fruit', 'vegetable', 'liquid', 'other', 'yogurt']
+INGREDIENT_TYPE_WEIGHTS = [140, 106, 76, 39, 2]
+
+# Number of ingredients per recipe. The fixtures use three to six; longer
+# recipes are increasingly rare.
+RECIPE_SIZES = list(range(2, 13))
+RECIPE_SIZE_WEIGHTS = [6, 20, 24, 20, 12, 7, 4, 3, 2, 1, 1]
+
+# Amounts written into the instructions, parsed into recipe_measurements like real Recipes.
+AMOUNTS = ['1/4 cup', '1/2 cup', '1 cup', '2 cups', '1 TBSP', '2 TBSP', '1 tsp', '3 slices', '1', '2']
+
+# Every generated User shares this password, hashing it once per User
+# would dominate the generation time.
+PASSWORD = 'benchmark'
+
+SYLLABLES = ['ba', 'na', 'man', 'go', 'ki', 'wi', 'pa', 'pa', 'ya', 'ber', 'ry', 'le', 'mon',
+             'lime', 'or', 'ange', 'ap', 'ple', 'pear', 'mel', 'on', 'co', 'co', 'nut', 'ce', 'le', 'ry']
+
+def ingredient_name(rng, index):
+    """
+    Builds a pronounceable, unique ingredient name.
+    Parameters
+    ----------
+    rng : Random
+        The seeded random generator.
+    index : int
+        The index of the ingredient, appended to keep names unique.
+    Returns
+    -------
+    name : str
+        The lowercase ingredient name.
+    """
+    word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    return '{} {}'.format(word, index)
+
+def popularity_weights(rng, count):
+    """
+    Returns Zipf-like popularity weights, so that a few ingredients (such as
+    ice or milk in the real catalog) appear in many recipes and most appear
+    in few. The weights are shuffled so popularity does not follow the id order.
+    """
+    weights = [1.0 / (rank + 1) for rank in range(count)]
+    rng.shuffle(weights)
+    return weights
+
+def sample_distinct(rng, population, weights, count):
+    """
+    Draws 'count' distinct items from a weighted population.
+    """
+    count = min(count, len(population))
+    chosen = set()
+    while len(chosen) < count:
+        chosen.update(rng.choices(population, weights=weights, k=count - len(chosen)))
+    return list(chosen)
+
+def generate(n_ingredients, n_recipes, n_users, seed=0, cabinet_size=(0, 40), custom_size=(0, 5)):
+    """
+    Creates the database schema and fills it with synthetic Ingredients,
+    Recipes and Users. The database is selected through the SDM_DATABASE_URI
+    environment variable (see benchmarks.common.use_database).
+
+    Rows are written with bulk inserts, so that millions of association rows
+    can be generated in reasonable time.
+    Parameters
+    ----------
+    n_ingredients : int
+        The number of default Ingredients.
+    n_recipes : int
+        The number of Recipes.
+    n_users : int
+        The number of Users. Every User gets a cabinet with Inventory
+        entries and some custom ingredients.
+    seed : int
+        The seed of the random generator.
+    cabinet_size : tuple
+        The minimum and maximum number of Ingredients in a User's cabinet.
+    custom_size : tuple
+        The minimum and maximum number of custom ingredients per User.
+    Returns
+    -------
+    summary : dict
+        The number of rows written to each table.
+    """
+    from sdm_server import db, matches, measurements, similarity
+    from sdm_server.models import (User, Recipe, Ingredients, Inventory, Custom_Ingredients, ingredient_keys, recipe_ingredients,
+                                   user_ingredients, custom_user_ingredients, Data_Version)
+    rng = random.Random(seed)
+    # Amounts are drawn from their own generator, so they do not change the rest of the dataset.
+    amounts = random.Random(seed + 1)
+    db.create_all()
+
+    ingredient_ids = list(range(1, n_ingredients + 1))
+    ingredients = [{'id': i, 'name': ingredient_name(rng, i),
+                    'ingredient_type': rng.choices(INGREDIENT_TYPES, weights=INGREDIENT_TYPE_WEIGHTS)[0],
+                    'quantity': 0, 'is_favorite': False} for i in ingredient_ids]
+    db.session.execute(ingredient_keys.insert(), [{'id': i['id'], 'name': i['name']} for i in ingredients])
+    db.session.execute(Ingredients.__table__.insert(), ingredients)
+    names = {ingredient['id']: ingredient['name'] for ingredient in ingredients}
+
+    weights = popularity_weights(rng, n_ingredients)
+    recipes, links = [], []
+    for recipe_id in range(1, n_recipes + 1):
+        size = rng.choices(RECIPE_SIZES, weights=RECIPE_SIZE_WEIGHTS)[0]
+        chosen = sample_distinct(rng, ingredient_ids, weights, size)
+        recipes.append({'id': recipe_id, 'name': 'Recipe {}'.format(recipe_id),
+                        'instructions': 'Blend {}.'.format(', '.join('{} {}'.format(amounts.choice(AMOUNTS), names[i]) for i in chosen)),
+                        'ingredient_count': len(chosen)})
+        links.extend({'recipe_id': recipe_id, 'ingredient_id': i} for i in chosen)
+    db.session.execute(Recipe.__table__.insert(), recipes)
+    db.session.execute(recipe_ingredients.insert(), links)
+
+    password = generate_password_hash(PASSWORD, method='sha256')
+    users, cabinets, inventory, customs, custom_links = [], [], [], {}, []
+    for user_id in range(1, n_users + 1):
+        users.append({'id': user_id, 'user_uuid': 'bench-{:08d}'.format(user_id), 'username': 'user{}'.format(user_id),
+                      'password': password, 'email': 'user{}@example.com'.format(user_id)})
+        for ingredient_id in sample_distinct(rng, ingredient_ids, weights, rng.randint(*cabinet_size)):
+            cabinets.append({'user_id': user_id, 'ingredient_id': ingredient_id})
+            inventory.append({'user': user_id, 'ingredient': ingredient_id,
+                              'quantity': rng.randint(1, 10), 'favorite': rng.random() < 0.1})
+        # Custom ingredients are shared, so Users that draw the same name own the same row.
+        names = {'custom {}'.format(rng.randint(1, max(1, n_users))) for _ in range(rng.randint(*custom_size))}
+        for name in sorted(names):
+            if(name not in customs):
+                # The keys of the custom names follow the keys of the ingredients.
+                customs[name] = {'id': len(customs) + 1, 'name': name, 'key_id': n_ingredients + len(customs) + 1,
+                                 'ingredient_type': rng.choices(INGREDIENT_TYPES, weights=INGREDIENT_TYPE_WEIGHTS)[0]}
+            custom_links.append({'user_id': user_id, 'ingredient_id': customs[name]['id'],
+                                 'quantity': rng.randint(0, 5), 'favorite': False})
+    keys = [{'id': custom['key_id'], 'name': custom['name']} for custom in customs.values()]
+    for table, rows in [(ingredient_keys, keys), (User.__table__, users), (user_ingredients, cabinets), (Inventory.__table__, inventory),
+                        (Custom_Ingredients.__table__, list(customs.values())), (custom_user_ingredients, custom_links)]:
+        if(rows):
+            db.session.execute(table.insert(), rows)
+    # Bulk inserts bypass the ORM, so the catalog version is bumped and the
+    # materialized recipe matches, measurements and signatures are built explicitly.
+    Data_Version.touch('catalog')
+    matches.rebuild(db.session)
+    measurements.store(db.session)
+    similarity.store(db.session)
+    db.session.commit()
+    return {'ingredients': n_ingredients, 'recipes': n_recipes, 'recipe_ingredients': len(links), 'users': n_users,
+            'user_ingredients': len(cabinets), 'inventory': len(inventory), 'custom_ingredients': len(customs),
+            'custom_user_ingredients': len(custom_links)}
+
+def main():
+    from benchmarks.common import use_database
+    parser = argparse.ArgumentParser(description="Generate a synthetic SDM database.")
+    parser.add_argument('database', help="Path of the SQLite database file to create.")
+    parser.add_argument('--ingredients', type=int, default=1000)
+    parser.add_argument('--recipes', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    use_database(args.database)
+    print(generate(args.ingredients, args.recipes, args.users, args.seed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# This file is a closed-loop load generator for the SDM backend. It starts
+# the server as a local process, then replays realistic user sessions from
+# a growing number of concurrent virtual users. Each virtual user:
+#
+#     1. registers a new account and logs in,
+#     2. PATCHes a few ingredients into the cabinet,
+#     3. polls /api/filtered-recipes until the stage ends.
+#
+# Every stage reports throughput and p50/p95/p99 latency per endpoint, the
+# error rate, and how often the server logged SQLite 'database is locked'
+# errors. The first stage whose error rate exceeds the threshold is
+# reported as the error-rate cliff.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.load_test --users 1,4,16,32 --duration 20
+import argparse
+import csv
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from benchmarks import common
+
+LOCKED_MESSAGE = 'database is locked'
+
+class Recorder:
+    '''
+    Collects the outcome of every request issued during a stage, grouped by endpoint.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.error_statuses = {}
+
+    def record(self, endpoint, status, seconds, expected=200):
+        with self.lock:
+            self.latencies.setdefault(endpoint, [])
+            self.errors.setdefault(endpoint, 0)
+            if(status == expected):
+                self.latencies[endpoint].append(seconds)
+            else:
+                self.errors[endpoint] += 1
+                statuses = self.error_statuses.setdefault(endpoint, {})
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return status == expected
+
+    def summarize(self, elapsed):
+        return {endpoint: dict(common.summarize(self.latencies[endpoint], self.errors[endpoint], elapsed),
+                               error_statuses=self.error_statuses.get(endpoint, {}))
+                for endpoint in sorted(self.latencies)}
+
+class VirtualUser(threading.Thread):
+    '''
+    A virtual user that runs one session after another until the stage is
+    stopped. The loop is closed: a new request is only sent after the
+    previous response was received and the think time has passed.
+    '''
+    def __init__(self, base_url, ingredients, patches, think_time, recorder, stop):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.ingredients = ingredients
+        self.patches = patches
+        self.think_time = think_time
+        self.recorder = recorder
+        self.stop = stop
+        self.rng = random.Random()
+
+    def request(self, endpoint, method='GET', headers=None, body=None):
+        status, seconds, payload = common.timed_request(self.base_url + endpoint, method, headers, body)
+        ok = self.recorder.record('{} {}'.format(method, endpoint), status, seconds)
+        return ok, payload
+
+    def pause(self):
+        # Think times are randomized by +/-50% so that users do not move in lockstep.
+        self.stop.wait(self.think_time * self.rng.uniform(0.5, 1.5))
+
+    def run(self):
+        while not self.stop.is_set():
+            self.session()
+
+    def session(self):
+        username = 'load-{}'.format(uuid.uuid4().hex[:12])
+        credentials = {'username': username, 'password': 'load', 'email': username}
+        ok, _ = self.request('/api/register', 'POST', body=credentials)
+        if(not ok):
+            return self.pause()
+        ok, payload = self.request('/api/login', 'POST', body={'loginId': username, 'password': 'load'})
+        if(not ok):
+            return self.pause()
+        header = {'Authorization': 'Bearer ' + json.loads(payload)['token']}
+
+        for name in self.rng.sample(self.ingredients, self.patches):
+            if(self.stop.is_set()):
+                return
+            self.request('/api/all-ingredients', 'PATCH', header,
+                         {'name': name, 'quantity': self.rng.randint(1, 5), 'isFavorite': 'False'})
+            self.pause()
+        while not self.stop.is_set():
+            self.request('/api/filtered-recipes', headers=header)
+            self.pause()
+
+def count_locked_errors(log, offset):
+    """
+    Counts 'database is locked' errors the server logged after an offset.
+    Parameters
+    ----------
+    log : str
+        The path of the server log.
+    offset : int
+        The log position at the start of the stage.
+    Returns
+    -------
+    result : tuple
+        A (count, new_offset) tuple.
+    """
+    with open(log, errors='replace') as f:
+        f.seek(offset)
+        text = f.read()
+        return text.count(LOCKED_MESSAGE), f.tell()
+
+def run_stage(base_url, users, duration, ingredients, patches, think_time):
+    """
+    Runs one stage with a fixed number of virtual users.
+    Returns
+    -------
+    result : dict
+        The overall and per-endpoint summaries of the stage.
+    """
+    recorder = Recorder()
+    stop = threading.Event()
+    virtual_users = [VirtualUser(base_url, ingredients, patches, think_time, recorder, stop) for _ in range(users)]
+    start = time.perf_counter()
+    for virtual_user in virtual_users:
+        virtual_user.start()
+    stop.wait(duration)
+    stop.set()
+    for virtual_user in virtual_users:
+        virtual_user.join()
+    elapsed = time.perf_counter() - start
+    latencies = [latency for values in recorder.latencies.values() for latency in values]
+    return {'users': users,
+            'overall': common.summarize(latencies, sum(recorder.errors.values()), elapsed),
+            'endpoints': recorder.summarize(elapsed)}
+
+def run(stages, duration, patches, think_time, error_threshold, server_command=None, url=None):
+    """
+    Starts the server (unless a URL is given) and runs every stage.
+    Parameters
+    ----------
+    stages : List
+        The numbers of concurrent virtual users, one stage each.
+    duration : float
+        The duration of each stage, in seconds.
+    patches : int
+        The number of ingredients each session PATCHes into the cabinet.
+    think_time : float
+        The mean pause between two requests of a virtual user, in seconds.
+    error_threshold : float
+        The error rate (0 to 1) that marks an error-rate cliff.
+    server_command : str
+        An optional command line template with a {port} placeholder, e.g.
+        'gunicorn -w 4 -b 127.0.0.1:{port} sdm_server:app'. The threaded
+        Flask server is used by default.
+    url : str
+        The base URL of an already running server. No server is started
+        and server logs are not inspected.
+    Returns
+    -------
+    results : dict
+        The per-stage results and the detected cliff.
+    """
+    with open(common.INGREDIENTS_CSV, newline='') as f:
+        ingredients = sorted({line[0].lower() for line in csv.reader(f)})
+
+    process, log, log_file = None, None, None
+    try:
+        if(not url):
+            workdir = tempfile.mkdtemp(prefix='sdm-load-')
+            common.use_database(os.path.join(workdir, 'load.db'))
+            common.seed_catalog()
+            port = common.free_port()
+            command = server_command.format(port=port).split() if server_command else common.flask_server_command(port)
+            log = os.path.join(workdir, 'server.log')
+            log_file = open(log, 'w')
+            process = common.start_server(command, port, log=log_file)
+            url = 'http://127.0.0.1:{}'.format(port)
+
+        results = {'url': url, 'duration': duration, 'patches': patches, 'think_time': think_time, 'stages': [], 'cliff': None}
+        offset = 0
+        for users in stages:
+            stage = run_stage(url, users, duration, ingredients, patches, think_time)
+            if(log):
+                stage['database_locked_errors'], offset = count_locked_errors(log, offset)
+            results['stages'].append(stage)
+            if(results['cliff'] is None and stage['overall']['error_rate'] > error_threshold):
+                results['cliff'] = {'users': users, 'error_rate': stage['overall']['error_rate'],
+                                    'database_locked_errors': stage.get('database_locked_errors')}
+    finally:
+        if(process):
+            process.terminate()
+            process.wait()
+        if(log_file):
+            log_file.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay concurrent user sessions against a local SDM server.")
+    parser.add_argument('--users', default='1,4,16,32', help="Comma separated virtual user counts, one stage each.")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds per stage.")
+    parser.add_argument('--patches', type=int, default=5, help="Ingredients PATCHed per session.")
+    parser.add_argument('--think-time', type=float, default=0.05, help="Mean pause between requests, in seconds.")
+    parser.add_argument('--error-threshold', type=float, default=0.01, help="Error rate that marks a cliff.")
+    parser.add_argument('--server-command', help="Server command template with a {port} placeholder.")
+    parser.add_argument('--url', help="Base URL of an already running server.")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    args = parser.parse_args()
+    results = run([int(users) for users in args.users.split(',')], args.duration, args.patches, args.think_time,
+                  args.error_threshold, args.server_command, args.url)
+    output = json.dumps(results, indent=2)
+    if(args.output):
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
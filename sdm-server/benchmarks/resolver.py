@@ -0,0 +1,135 @@
+# This benchmark measures sdm_server.resolver on synthetic catalogs. Names
+# are built from the syllables of benchmarks.generator, without the index
+# suffix the generator appends, so that misspellings can land on other
+# names. Every query is a catalog name with one change a User might make:
+# a letter deleted, inserted, replaced or swapped with its neighbour, a
+# plural 's', a dropped space, or different case and spacing.
+#
+# For every query it reports whether it resolved to the name it was made
+# from (correct), to another name (wrong) or to nothing (unresolved), and
+# the latency of resolve(). Names left out of the catalog are resolved too,
+# as they take the longest; they should resolve to nothing. Writes only
+# apply matches found without edits, so the share of unknown names that
+# would be written is reported separately. The index is built in memory,
+# no database is used.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.resolver --ingredients 50000 --queries 5000 --unknown 500
+#
+# The results are printed as JSON.
+import argparse
+import json
+import random
+import string
+import time
+import tracemalloc
+from benchmarks import common
+from benchmarks.generator import SYLLABLES
+
+def catalog_names(rng, count):
+    """
+    Returns count unique names of one or two words.
+    """
+    names = set()
+    word = lambda: ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    while(len(names) < count):
+        names.add(word() if rng.random() < 0.6 else '{} {}'.format(word(), word()))
+    return sorted(names)
+
+def misspell(rng, name):
+    """
+    Returns a name with one random change.
+    """
+    position = rng.randrange(len(name))
+    change = rng.choice(['delete', 'insert', 'replace', 'swap', 'plural', 'spacing'])
+    if(change == 'delete'):
+        return name[:position] + name[position + 1:]
+    if(change == 'insert'):
+        return name[:position] + rng.choice(string.ascii_lowercase) + name[position:]
+    if(change == 'replace'):
+        return name[:position] + rng.choice(string.ascii_lowercase) + name[position + 1:]
+    if(change == 'swap' and position < len(name) - 1):
+        return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+    if(change == 'plural'):
+        return name + 's'
+    return ' ' + name.replace(' ', '').title() + '  '
+
+def latencies(timings):
+    """
+    Returns the mean and percentiles of a list of latencies.
+    """
+    if(not timings):
+        return None
+    return {'mean': sum(timings) / len(timings), 'median': common.percentile(timings, 0.5),
+            'p95': common.percentile(timings, 0.95), 'p99': common.percentile(timings, 0.99)}
+
+def run(n_ingredients, n_queries, n_unknown, seed):
+    """
+    Builds a NameIndex over a synthetic catalog and resolves misspelled names.
+    Parameters
+    ----------
+    n_ingredients : int
+        The number of names in the catalog.
+    n_queries : int
+        The number of misspelled names to resolve.
+    n_unknown : int
+        The number of names left out of the catalog to resolve.
+    seed : int
+        The seed of the random generator.
+    Returns
+    -------
+    results : dict
+        The parameters, the index build time and size, the outcome counts and the latency figures.
+    """
+    from sdm_server import app, resolver
+    rng = random.Random(seed)
+    names = catalog_names(rng, n_ingredients + n_unknown)
+    rng.shuffle(names)
+    names, unknown = names[:n_ingredients], names[n_ingredients:]
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = resolver.NameIndex(None, list(enumerate(names)))
+    build_ms = (time.perf_counter() - start) * 1000
+    index_mb = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    tracemalloc.stop()
+
+    outcomes = {'correct': 0, 'wrong': 0, 'unresolved': 0}
+    timings = []
+    for _ in range(n_queries):
+        source = rng.randrange(len(names))
+        query = misspell(rng, names[source])
+        start = time.perf_counter()
+        match = index.resolve(query)
+        timings.append((time.perf_counter() - start) * 1000)
+        outcomes['unresolved' if match is None else 'correct' if match[0] == source else 'wrong'] += 1
+    unknown_timings, unknown_resolved, unknown_written = [], 0, 0
+    for name in unknown:
+        start = time.perf_counter()
+        match = index.resolve(name)
+        unknown_timings.append((time.perf_counter() - start) * 1000)
+        unknown_resolved += match is not None
+        unknown_written += index.resolve(name, fuzzy=False) is not None
+
+    return {
+        'parameters': {'ingredients': n_ingredients, 'queries': n_queries, 'unknown': n_unknown, 'seed': seed,
+                       'max_edits': app.config['RESOLVER_MAX_EDITS'], 'candidates': app.config['RESOLVER_CANDIDATES']},
+        'index_build_ms': build_ms,
+        'index_mb': index_mb,
+        'outcomes': {name: count / n_queries for name, count in outcomes.items()},
+        'resolve_ms': latencies(timings),
+        'unknown_resolved': unknown_resolved / n_unknown if n_unknown else None,
+        'unknown_written': unknown_written / n_unknown if n_unknown else None,
+        'unknown_resolve_ms': latencies(unknown_timings),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the latency and accuracy of ingredient name resolution.")
+    parser.add_argument('--ingredients', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--unknown', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.ingredients, args.queries, args.unknown, args.seed), indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
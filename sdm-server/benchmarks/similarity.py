@@ -0,0 +1,125 @@
+# This benchmark compares the similar-recipe lookup of sdm_server.similarity
+# (MinHash signatures and LSH buckets) with exact Jaccard similarity, computed
+# by comparing a Recipe with every other Recipe. For a sample of Recipes it
+# reports the latency of both and the recall of the lookup:
+#
+#     - recall is the fraction of the Recipes with an exact similarity of at
+#       least --min-similarity that are among the LSH candidates.
+#     - recall_at_k is the fraction of the exact top k (of those Recipes) that
+#       the lookup returns in its top k. Ties in the exact similarity count as hits.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.similarity --ingredients 1000 --recipes 30000 --sample 200
+#
+# The results are printed as JSON.
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from benchmarks import common, generator
+
+def exact_similar(ingredients, recipe_id):
+    """
+    Returns the exact Jaccard similarity of a Recipe to every other Recipe that shares an Ingredient.
+    """
+    first = ingredients[recipe_id]
+    scores = {}
+    for other, second in ingredients.items():
+        if(other != recipe_id):
+            shared = len(first & second)
+            if(shared):
+                scores[other] = shared / len(first | second)
+    return scores
+
+def summarize_ms(timings):
+    """
+    Returns the mean, median and 95th percentile of timings in milliseconds.
+    """
+    return {'mean_ms': statistics.mean(timings), 'median_ms': statistics.median(timings),
+            'p95_ms': common.percentile(timings, 0.95)}
+
+def run(n_ingredients, n_recipes, sample, k, min_similarity, seed, database=None):
+    """
+    Generates the dataset and measures the lookup of sampled Recipes.
+    Parameters
+    ----------
+    n_ingredients, n_recipes, seed : int
+        The dataset parameters passed to benchmarks.generator.generate.
+    sample : int
+        The number of Recipes to look up.
+    k : int
+        The number of similar Recipes each lookup returns.
+    min_similarity : float
+        The exact similarity from which a Recipe counts as similar.
+    database : str
+        An optional database path; a temporary file is used by default.
+    Returns
+    -------
+    results : dict
+        The parameters, the index build time, and the latency and recall figures.
+    """
+    database = database or os.path.join(tempfile.mkdtemp(prefix='sdm-bench-'), 'bench.db')
+    common.use_database(database)
+    dataset = generator.generate(n_ingredients, n_recipes, 0, seed)
+
+    from sdm_server import app, db, similarity
+    from sdm_server.models import recipe_ingredients
+    ingredients = {}
+    for recipe_id, ingredient_id in db.session.query(recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id):
+        ingredients.setdefault(recipe_id, set()).add(ingredient_id)
+    start = time.perf_counter()
+    index = similarity.get_index()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    lsh_timings, exact_timings, candidates, recalls, recalls_at_k = [], [], [], [], []
+    for recipe_id in random.Random(seed).sample(sorted(ingredients), min(sample, len(ingredients))):
+        start = time.perf_counter()
+        found = index.similar(recipe_id, k)
+        lsh_timings.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        exact = exact_similar(ingredients, recipe_id)
+        exact_timings.append((time.perf_counter() - start) * 1000)
+
+        # Every candidate, not only the top k, for the recall of the buckets.
+        everything = {other for other, _ in index.similar(recipe_id)}
+        candidates.append(len(everything))
+        relevant = {other for other, score in exact.items() if score >= min_similarity}
+        if(not relevant):
+            continue
+        recalls.append(len(relevant & everything) / len(relevant))
+        top = sorted((exact[other] for other in relevant), reverse=True)[:k]
+        hits = sum(1 for other, _ in found[:k] if exact.get(other, 0.0) >= max(top[-1], min_similarity))
+        recalls_at_k.append(min(hits, len(top)) / len(top))
+
+    return {
+        'parameters': {'ingredients': n_ingredients, 'recipes': n_recipes, 'sample': sample, 'k': k,
+                       'min_similarity': min_similarity, 'seed': seed,
+                       'hashes': app.config['SIMILARITY_HASHES'], 'bands': app.config['SIMILARITY_BANDS'],
+                       'shortlist': app.config['SIMILARITY_SHORTLIST']},
+        'dataset': dataset,
+        'index_build_ms': build_ms,
+        'lsh': summarize_ms(lsh_timings),
+        'exact': summarize_ms(exact_timings),
+        'mean_candidates': statistics.mean(candidates),
+        'queries_with_similar_recipes': len(recalls),
+        'recall': statistics.mean(recalls) if recalls else None,
+        'recall_at_k': statistics.mean(recalls_at_k) if recalls_at_k else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the LSH similar-recipe lookup with exact Jaccard similarity.")
+    parser.add_argument('--ingredients', type=int, default=1000)
+    parser.add_argument('--recipes', type=int, default=10000)
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--min-similarity', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    results = run(args.ingredients, args.recipes, args.sample, args.k, args.min_similarity, args.seed)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,10 @@
 # This file performs initial package setup
 # and application variable configuration.
+import os
 from flask import Flask
 from flask_mail import Mail
-from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS, logging
+from sdm_server.engine import ProfiledSQLAlchemy
 
 app = Flask(__name__)
 CORS(app, resources={r"*": {"origins": "http://localhost:3000"}})
@@ -11,15 +12,21 @@ logging.getLogger('flask_cors').level = logging.DEBUG
 app.config['TESTING'] = False
 app.config['SECRET_KEY'] = 'Not_A_Good_Key_Replace_When_Deploy_To_Production'
 # SQLite is used in development. When pushed to production, the SQLALCHEMY_DATABASE_URI must be
-# replaced with the MySQL host, username, and password
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sdm-server.db'
+# replaced with the MySQL host, username, and password, either here or through the
+# SDM_DATABASE_URI environment variable. The engine options for each database are
+# chosen in engine.py and can be overridden through SQLALCHEMY_ENGINE_OPTIONS.
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SDM_DATABASE_URI', 'sqlite:///sdm-server.db')
+# Read-only replicas of the database, given as a comma separated list of URIs. GET listings are
+# served from a replica unless the data was written in the last READ_YOUR_WRITES_SECONDS.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [uri for uri in os.environ.get('SDM_REPLICA_URIS', '').split(',') if uri]
+app.config['READ_YOUR_WRITES_SECONDS'] = 5
 app.config['MAIL_SERVER'] = 'email-smtp.us-east-1.amazonaws.com'
 app.config['MAIL_PORT'] = 587
 app.config['MAIL_USE_TLS'] = True
 app.config['MAIL_USERNAME'] = ''#removed from commit
 app.config['MAIL_PASSWORD'] = ''#removed from commit
 mail = Mail(app)
-db = SQLAlchemy(app)
+db = ProfiledSQLAlchemy(app)
 
-from sdm_server import routes
+from sdm_server import routes, migrations, matches, measurements, similarity, analytics
 
@@ -0,0 +1,316 @@
+# This file computes catalog-wide matching analytics offline: the Recipes
+# that no User can make, the Ingredients that would unlock the most Recipes
+# across all cabinets, and the distribution of makeable Recipes per User.
+#
+# Going through the recipe listings for every User costs a query per User
+# and Recipe. Instead, the Recipe links and the cabinets are read once into
+# sparse arrays, and the User x Recipe coverage matrix is computed with NumPy
+# a chunk of Users at a time:
+#
+#     - For every cabinet Ingredient of the chunk, the Recipes that use it are
+#       gathered from the Recipe lists of the Ingredients, and the hits are
+#       counted per (User, Recipe) cell with a single bincount.
+#     - A Recipe misses (size - hits) Ingredients. When exactly one is missing,
+#       it is the Recipe's Ingredient sum minus the sum of the hit Ingredients,
+#       which is counted with a second, weighted bincount.
+#
+# Only the counts are kept between chunks, so memory is bounded by the chunk
+# size, which is derived from ANALYTICS_CHUNK_CELLS and the number of Recipes.
+#
+# Usage (from the sdm-server directory):
+#     FLASK_APP=sdm_server flask analytics-report --output report/
+#
+# The Users are sharded across worker processes by sdm_server.jobs, which
+# share the CoverageIndex.
+import csv
+import functools
+import os
+import sys
+import time
+import click
+from sqlalchemy import select
+from sdm_server import app, db, jobs
+from sdm_server.models import *
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only needed by the offline analytics, not by the API.
+    np = None
+
+# The number of User x Recipe cells computed at once, about 40 bytes each.
+app.config.setdefault('ANALYTICS_CHUNK_CELLS', 2000000)
+
+class MatchAnalytics:
+    '''
+    The MatchAnalytics class holds the results of analyze().
+
+    user_ids : array, The User ids, in the order of makeable.
+
+    recipe_ids : array, The Recipe ids, in the order of sizes, makers and one_away.
+
+    ingredient_ids : array, The Ingredient ids, in the order of unlocks and unlocked_users.
+
+    sizes : array, The number of Ingredients of each Recipe.
+
+    makers : array, The number of Users that can make each Recipe.
+
+    one_away : array, The number of Users that miss exactly one Ingredient of each Recipe.
+
+    makeable : array, The number of Recipes each User can make.
+
+    unlocks : array, The number of (User, Recipe) pairs each Ingredient would complete.
+
+    unlocked_users : array, The number of Users for whom each Ingredient would complete at least one Recipe.
+    '''
+    def __init__(self, user_ids, recipe_ids, ingredient_ids, sizes, makers, one_away, makeable, unlocks, unlocked_users):
+        self.user_ids = user_ids
+        self.recipe_ids = recipe_ids
+        self.ingredient_ids = ingredient_ids
+        self.sizes = sizes
+        self.makers = makers
+        self.one_away = one_away
+        self.makeable = makeable
+        self.unlocks = unlocks
+        self.unlocked_users = unlocked_users
+
+    def distribution(self):
+        """
+        Returns a List of (makeable_count, users) tuples for every number of
+        makeable Recipes that at least one User has.
+        """
+        counts = np.bincount(self.makeable, minlength=1)
+        return [(count, int(users)) for count, users in enumerate(counts) if users]
+
+    def merge(self, other):
+        """
+        Returns the analytics of the Users of both, which must have been
+        computed with the same CoverageIndex.
+        """
+        return MatchAnalytics(np.concatenate((self.user_ids, other.user_ids)), self.recipe_ids, self.ingredient_ids,
+                              self.sizes, self.makers + other.makers, self.one_away + other.one_away,
+                              np.concatenate((self.makeable, other.makeable)), self.unlocks + other.unlocks,
+                              self.unlocked_users + other.unlocked_users)
+
+def read_ids(connection, column):
+    """
+    Returns the sorted values of a column as an int64 array.
+    """
+    return np.array(sorted(value for (value,) in connection.execute(select([column]))), dtype=np.int64)
+
+def read_pairs(connection, left, right, *criteria):
+    """
+    Returns the rows of two integer columns as a (n, 2) int64 array, ordered by the left column.
+    """
+    query = select([left, right]).order_by(left, right)
+    for criterion in criteria:
+        query = query.where(criterion)
+    return np.array(connection.execute(query).fetchall(), dtype=np.int64).reshape(-1, 2)
+
+def ragged_arange(starts, lengths):
+    """
+    Returns the concatenation of arange(start, start + length) for every start and length.
+    """
+    ends = np.cumsum(lengths)
+    offsets = np.arange(ends[-1] if len(ends) else 0, dtype=np.int64) - np.repeat(ends - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+class CoverageIndex:
+    '''
+    The CoverageIndex class holds the Recipe lists of the Ingredients over
+    dense indexes, in compressed sparse row form. It does not depend on the
+    Users, so it is built once and shared by every chunk and shard.
+
+    recipe_ids : array, The Recipe ids; a Recipe's dense index is its position.
+
+    ingredient_ids : array, The Ingredient ids; an Ingredient's dense index is its position.
+
+    postings_start : array, The Recipes of Ingredient i are postings[postings_start[i]:postings_start[i + 1]].
+
+    postings : array, The dense indexes of the Recipes of every Ingredient.
+
+    sizes : array, The number of Ingredients of each Recipe.
+
+    ingredient_sums : array, The sum of the dense Ingredient indexes of each Recipe.
+    '''
+    def __init__(self, recipe_ids, ingredient_ids, links):
+        self.recipe_ids = recipe_ids
+        self.ingredient_ids = ingredient_ids
+        link_ingredients = np.searchsorted(ingredient_ids, links[:, 0])
+        link_recipes = np.searchsorted(recipe_ids, links[:, 1])
+        self.postings_start = np.concatenate(([0], np.cumsum(np.bincount(link_ingredients, minlength=len(ingredient_ids)))))
+        self.postings = link_recipes
+        self.sizes = np.bincount(link_recipes, minlength=len(recipe_ids))
+        self.ingredient_sums = np.bincount(link_recipes, weights=link_ingredients, minlength=len(recipe_ids))
+
+def build_index(connection):
+    """
+    Reads the Recipes, ingredient keys and their links into a CoverageIndex.
+    """
+    return CoverageIndex(read_ids(connection, Recipe.id), read_ids(connection, ingredient_keys.c.id),
+                         read_pairs(connection, recipe_ingredients.c.ingredient_id, recipe_ingredients.c.recipe_id))
+
+def read_cabinets(connection, first=None, last=None):
+    """
+    Returns the (user_id, ingredient_id) rows of the cabinet keys (see
+    models.cabinet_keys), ordered by User, optionally only of the Users with
+    ids from first to last.
+    """
+    cabinet = cabinet_keys().alias('cabinet')
+    criteria = [] if first is None else [cabinet.c.user_id.between(first, last)]
+    return read_pairs(connection, cabinet.c.user_id, cabinet.c.ingredient_id, *criteria)
+
+def analyze_users(index, user_ids, cabinets, chunk_cells=None):
+    """
+    Computes the coverage of every Recipe by the cabinets of some Users.
+    Parameters
+    ----------
+    index : CoverageIndex
+        The index of the catalog.
+    user_ids : array
+        The sorted ids of the Users.
+    cabinets : array
+        The (user_id, ingredient_id) rows of their cabinets, ordered by User.
+    chunk_cells : int
+        The number of User x Recipe cells computed at once. Defaults to
+        ANALYTICS_CHUNK_CELLS.
+    Returns
+    -------
+    analytics : MatchAnalytics
+        The per Recipe, per Ingredient and per User counts of these Users.
+    """
+    n_users, n_recipes, n_ingredients = len(user_ids), len(index.recipe_ids), len(index.ingredient_ids)
+    sizes, postings, postings_start = index.sizes, index.postings, index.postings_start
+    cabinet_users = np.searchsorted(user_ids, cabinets[:, 0])
+    cabinet_ingredients = np.searchsorted(index.ingredient_ids, cabinets[:, 1])
+
+    makers = np.zeros(n_recipes, dtype=np.int64)
+    one_away = np.zeros(n_recipes, dtype=np.int64)
+    makeable = np.zeros(n_users, dtype=np.int64)
+    unlocks = np.zeros(n_ingredients, dtype=np.int64)
+    unlocked_users = np.zeros(n_ingredients, dtype=np.int64)
+    chunk = max(1, (chunk_cells or app.config['ANALYTICS_CHUNK_CELLS']) // max(1, n_recipes))
+    for first in range(0, n_users, chunk):
+        last = min(first + chunk, n_users)
+        users = last - first
+        begin, end = np.searchsorted(cabinet_users, [first, last])
+        owners, owned = cabinet_users[begin:end] - first, cabinet_ingredients[begin:end]
+        lengths = postings_start[owned + 1] - postings_start[owned]
+        hit_recipes = postings[ragged_arange(postings_start[owned], lengths)]
+        cells = np.repeat(owners, lengths) * n_recipes + hit_recipes
+        hits = np.bincount(cells, minlength=users * n_recipes).reshape(users, n_recipes)
+        missing = sizes - hits
+        can_make = missing == 0
+        makers += can_make.sum(axis=0)
+        makeable[first:last] = can_make.sum(axis=1)
+
+        rows, columns = np.nonzero(missing == 1)
+        one_away += np.bincount(columns, minlength=n_recipes)
+        hit_sums = np.bincount(cells, weights=np.repeat(owned, lengths), minlength=users * n_recipes)
+        last_missing = np.rint(index.ingredient_sums[columns] - hit_sums[rows * n_recipes + columns]).astype(np.int64)
+        unlocks += np.bincount(last_missing, minlength=n_ingredients)
+        unlocked = np.unique(rows * n_ingredients + last_missing) % n_ingredients
+        unlocked_users += np.bincount(unlocked, minlength=n_ingredients)
+    return MatchAnalytics(user_ids, index.recipe_ids, index.ingredient_ids, sizes, makers, one_away, makeable, unlocks, unlocked_users)
+
+def analyze(connection, chunk_cells=None):
+    """
+    Computes the coverage of every Recipe by every User's cabinet.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to read the Recipes and cabinets from.
+    chunk_cells : int
+        The number of User x Recipe cells computed at once. Defaults to
+        ANALYTICS_CHUNK_CELLS.
+    Returns
+    -------
+    analytics : MatchAnalytics
+        The per Recipe, per Ingredient and per User counts.
+    """
+    index = build_index(connection)
+    return analyze_users(index, read_ids(connection, User.id), read_cabinets(connection), chunk_cells)
+
+def analyze_shard(index, user_ids, chunk_cells=None):
+    """
+    Computes the coverage for a shard of consecutive User ids, reading their
+    cabinets through db.session. Used with jobs.run_sharded().
+    """
+    user_ids = np.array(user_ids, dtype=np.int64)
+    cabinets = read_cabinets(db.session, int(user_ids[0]), int(user_ids[-1]))
+    return analyze_users(index, user_ids, cabinets, chunk_cells)
+
+def write_report(analytics, directory):
+    """
+    Writes the analytics as CSV files to a directory:
+
+        - recipes.csv: every Recipe with its size, makers and Users one Ingredient away.
+        - ingredients.csv: every Ingredient with the Recipes and Users it would unlock.
+        - distribution.csv: the number of Users per number of makeable Recipes.
+
+    Parameters
+    ----------
+    analytics : MatchAnalytics
+        The results of analyze().
+    directory : str
+        The directory to write to. It is created if it does not exist.
+    """
+    os.makedirs(directory, exist_ok=True)
+    recipe_names = dict(db.session.query(Recipe.id, Recipe.name))
+    ingredient_names = dict(db.session.query(ingredient_keys.c.id, ingredient_keys.c.name))
+    tables = {
+        'recipes.csv': (('recipe_id', 'name', 'ingredients', 'makers', 'one_away'),
+                        zip(analytics.recipe_ids.tolist(), map(recipe_names.get, analytics.recipe_ids.tolist()),
+                            analytics.sizes.tolist(), analytics.makers.tolist(), analytics.one_away.tolist())),
+        'ingredients.csv': (('ingredient_id', 'name', 'unlocks', 'unlocked_users'),
+                            zip(analytics.ingredient_ids.tolist(), map(ingredient_names.get, analytics.ingredient_ids.tolist()),
+                                analytics.unlocks.tolist(), analytics.unlocked_users.tolist())),
+        'distribution.csv': (('makeable', 'users'), analytics.distribution()),
+    }
+    for filename, (header, rows) in tables.items():
+        with open(os.path.join(directory, filename), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+@app.cli.command('analytics-report')
+@click.option('--output', type=click.Path(file_okay=False), help="Write the CSV report to this directory.")
+@click.option('--top', default=10, show_default=True, help="The number of rows of each summary table.")
+@click.option('--chunk-cells', type=int, help="The number of User x Recipe cells computed at once.")
+@click.option('--workers', type=int, help="The number of worker processes, JOB_WORKERS by default.")
+@click.option('--shard-size', type=int, help="The number of Users per shard, JOB_SHARD_SIZE by default.")
+def analytics_report_command(output, top, chunk_cells, workers, shard_size):
+    """Summarize which Recipes the Users can make."""
+    if(np is None):
+        click.echo("The analytics report requires NumPy (pip install numpy).")
+        sys.exit(1)
+    start = time.perf_counter()
+    index = build_index(db.session)
+    analytics, timings = jobs.run_sharded(functools.partial(analyze_shard, chunk_cells=chunk_cells), MatchAnalytics.merge,
+                                          index, workers=workers, shard_size=shard_size, progress=jobs.echo_progress)
+    if(analytics is None):
+        analytics = analyze_users(index, np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64))
+    elapsed = time.perf_counter() - start
+    jobs.echo_timings(timings, elapsed)
+    recipe_names = dict(db.session.query(Recipe.id, Recipe.name))
+    ingredient_names = dict(db.session.query(ingredient_keys.c.id, ingredient_keys.c.name))
+
+    click.echo("Analyzed {} Users and {} Recipes in {:.1f}s.".format(len(analytics.user_ids), len(analytics.recipe_ids), elapsed))
+    unmade = np.nonzero((analytics.makers == 0) & (analytics.sizes > 0))[0]
+    click.echo("\nRecipes nobody can make: {}, closest to being made:".format(len(unmade)))
+    for index in unmade[np.argsort(-analytics.one_away[unmade], kind='stable')][:top]:
+        click.echo("  {:<40} {:>8} Users one Ingredient away".format(recipe_names[analytics.recipe_ids[index]], analytics.one_away[index]))
+    click.echo("\nIngredients that would unlock the most Recipes:")
+    for index in np.argsort(-analytics.unlocks, kind='stable')[:top]:
+        if(analytics.unlocks[index]):
+            click.echo("  {:<40} {:>8} Recipes for {} Users".format(ingredient_names[analytics.ingredient_ids[index]],
+                                                                  analytics.unlocks[index], analytics.unlocked_users[index]))
+    click.echo("\nMakeable Recipes per User:")
+    if(len(analytics.makeable)):
+        for label, value in (('min', analytics.makeable.min()), ('median', np.median(analytics.makeable)),
+                             ('mean', analytics.makeable.mean()), ('p95', np.percentile(analytics.makeable, 95)),
+                             ('max', analytics.makeable.max())):
+            click.echo("  {:<8} {:>10.1f}".format(label, value))
+    if(output):
+        write_report(analytics, output)
+        click.echo("\nWrote the report to {}.".format(output))
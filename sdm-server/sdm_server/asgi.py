@@ -0,0 +1,259 @@
+# This file provides an asynchronous (ASGI) variant of the read-heavy
+# SDM endpoints. It shares the ORM models and JWT authentication of the
+# Flask application, but issues its queries through an async database
+# driver so that a worker is never blocked while waiting on the database.
+#
+# Serve it with an ASGI server, e.g.:
+#     uvicorn sdm_server.asgi:application --port 5001
+import json
+import os
+from operator import itemgetter
+from databases import Database
+from sqlalchemy import select, and_
+from sdm_server import app, matches, writebehind
+from sdm_server.models import (User, Recipe, Ingredients, Inventory, Custom_Ingredients,
+                               ingredient_keys, recipe_ingredients, user_ingredients, custom_user_ingredients)
+from sdm_server.validators import decode_authorization_header
+
+def get_async_database_uri(uri):
+    """
+    Translates a Flask-SQLAlchemy database URI into a URI the async driver
+    understands. Flask-SQLAlchemy resolves relative SQLite paths against the
+    application package, so the same is done here to make both the synchronous
+    and asynchronous application open the same database file.
+    Parameters
+    ----------
+    uri : str
+        The SQLALCHEMY_DATABASE_URI of the Flask application.
+    Returns
+    -------
+    uri : str
+        An equivalent URI for the async driver.
+    """
+    if(uri.startswith('sqlite:///') and uri != 'sqlite:///:memory:'):
+        path = uri[len('sqlite:///'):]
+        if(not os.path.isabs(path)):
+            path = os.path.join(app.root_path, path)
+        return 'sqlite:///' + path
+    # mysqlclient is synchronous; the async path uses aiomysql against the same server.
+    if(uri.startswith('mysql+mysqldb://')):
+        return 'mysql://' + uri[len('mysql+mysqldb://'):]
+    return uri
+
+# The async endpoints read the database directly and would not see updates buffered by the Flask application.
+writebehind.require_single_process("the asynchronous endpoints read the database directly")
+
+database = Database(app.config.get('ASYNC_DATABASE_URI') or get_async_database_uri(app.config['SQLALCHEMY_DATABASE_URI']))
+
+INVALID_TOKEN = {"message": "Invalid authentication token. Please log in and try again."}
+ALLOWED_ORIGIN = 'http://localhost:3000'
+ALLOWED_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+async def get_user(user_uuid):
+    """
+    Asynchronously fetches the User row matching a decoded JWT subject.
+    Parameters
+    ----------
+    user_uuid : str
+        The user UUID decoded from the Authorization header.
+    Returns
+    -------
+    user : Record or None
+        The matching row of the User table, or None if no User matches.
+    """
+    query = select([User.__table__]).where(User.user_uuid == user_uuid)
+    return await database.fetch_one(query)
+
+async def get_recipe_rows(recipe_ids=None):
+    """
+    Fetches every Recipe together with the names of its Ingredients in a
+    single query, instead of one query per Recipe.
+    Parameters
+    ----------
+    recipe_ids : Select
+        An optional select of Recipe ids that limits the Recipes fetched,
+        e.g. from matches.fully_matched_ids.
+    Returns
+    -------
+    recipes : List
+        A List of dictionaries with the keys 'name', 'instructions' and
+        'ingredients', where 'ingredients' is a List of (id, name) tuples.
+    """
+    # Recipes link to ingredient keys, which name Ingredients and Custom Ingredients alike.
+    joined = Recipe.__table__.outerjoin(recipe_ingredients, recipe_ingredients.c.recipe_id == Recipe.id) \
+                             .outerjoin(ingredient_keys, ingredient_keys.c.id == recipe_ingredients.c.ingredient_id)
+    query = select([Recipe.id, Recipe.name, Recipe.instructions, ingredient_keys.c.id.label('ingredient_id'),
+                    ingredient_keys.c.name.label('ingredient_name')]).select_from(joined)
+    if(recipe_ids is not None):
+        query = query.where(Recipe.id.in_(recipe_ids))
+    recipes = {}
+    for row in await database.fetch_all(query):
+        recipe = recipes.setdefault(row['id'], {'name': row['name'], 'instructions': row['instructions'], 'ingredients': []})
+        if(row['ingredient_id'] is not None):
+            recipe['ingredients'].append((row['ingredient_id'], row['ingredient_name']))
+    return list(recipes.values())
+
+def format_recipe(recipe):
+    """
+    Converts a recipe row into the JSON format used by the Flask endpoints.
+    Parameters
+    ----------
+    recipe : dict
+        A recipe as returned by get_recipe_rows.
+    Returns
+    -------
+    recipe : dict
+        The Recipe formatted with capitalized ingredient names.
+    """
+    return {'name': recipe['name'],
+            'instructions': recipe['instructions'],
+            'ingredients': [name.capitalize() for _, name in recipe['ingredients']]}
+
+async def all_recipes(user):
+    """
+    Async equivalent of GET /api/all-recipes.
+    """
+    recipes = [format_recipe(recipe) for recipe in await get_recipe_rows()]
+    return {"recipes": sorted(recipes, key=itemgetter('name'))}
+
+async def filtered_recipes(user):
+    """
+    Async equivalent of GET /api/filtered-recipes. Every Ingredient required
+    by a Recipe must be in the User's cabinet.
+    """
+    recipes = [format_recipe(recipe) for recipe in await get_recipe_rows(matches.fully_matched_ids(user['id']))]
+    return {"recipes": sorted(recipes, key=itemgetter('name'))}
+
+async def partial_filter(user):
+    """
+    Async equivalent of GET /api/partial-filter. At least one Ingredient
+    required by a Recipe must be in the User's cabinet.
+    """
+    recipes = [format_recipe(recipe) for recipe in await get_recipe_rows(matches.partially_matched_ids(user['id']))]
+    return {"recipes": sorted(recipes, key=itemgetter('name'))}
+
+async def user_ingredients_view(user):
+    """
+    Async equivalent of GET /api/user-ingredients. The quantities and favorites
+    of default ingredients are joined in from the Inventory table in the same query.
+    """
+    joined = user_ingredients.join(Ingredients.__table__, Ingredients.id == user_ingredients.c.ingredient_id) \
+                             .outerjoin(Inventory.__table__, and_(Inventory.user == user_ingredients.c.user_id,
+                                                                  Inventory.ingredient == Ingredients.id))
+    query = select([Ingredients.name, Ingredients.ingredient_type, Inventory.quantity, Inventory.favorite]) \
+            .select_from(joined).where(user_ingredients.c.user_id == user['id'])
+    default_ingredients = []
+    for row in await database.fetch_all(query):
+        default_ingredients.append({'name': row['name'].capitalize(),
+                                    'type': row['ingredient_type'].capitalize(),
+                                    'quantity': row['quantity'] or 0,
+                                    'favorite': str(bool(row['favorite']))})
+
+    joined = custom_user_ingredients.join(Custom_Ingredients.__table__, Custom_Ingredients.id == custom_user_ingredients.c.ingredient_id)
+    query = select([Custom_Ingredients.name, Custom_Ingredients.ingredient_type, custom_user_ingredients.c.quantity,
+                    custom_user_ingredients.c.favorite]).select_from(joined).where(custom_user_ingredients.c.user_id == user['id'])
+    custom_ingredients = []
+    for row in await database.fetch_all(query):
+        custom_ingredients.append({'name': row['name'].capitalize(),
+                                   'type': row['ingredient_type'].capitalize(),
+                                   'quantity': row['quantity'],
+                                   'favorite': str(bool(row['favorite']))})
+
+    return {"ingredients": {'default': sorted(default_ingredients, key=itemgetter('name')),
+                            'custom': sorted(custom_ingredients, key=itemgetter('name'))}}
+
+# The supported asynchronous endpoints. Only GET and HEAD requests (and their
+# CORS preflight) are served, every write still goes through the Flask application.
+routes = {
+    '/api/all-recipes': all_recipes,
+    '/api/filtered-recipes': filtered_recipes,
+    '/api/partial-filter': partial_filter,
+    '/api/user-ingredients': user_ingredients_view,
+}
+
+async def send_json(send, body, status, origin=None, head=False):
+    """
+    Sends a complete JSON response over an ASGI connection. The body of a
+    response to a HEAD request is left out, its headers are kept.
+    Parameters
+    ----------
+    send : callable
+        The ASGI send callable.
+    body : dict
+        The object to serialize as the response body.
+    status : int
+        The HTTP status code.
+    origin : bytes
+        The request Origin header, echoed back when it is the allowed frontend origin.
+    head : bool
+        True if the request is a HEAD request.
+    """
+    payload = json.dumps(body).encode('UTF-8')
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(payload)).encode('ascii'))]
+    if(origin == ALLOWED_ORIGIN.encode('ascii')):
+        headers.append((b'access-control-allow-origin', origin))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else payload})
+
+async def send_preflight(send, headers):
+    """
+    Answers a CORS preflight (OPTIONS) request like the Flask application
+    does: the allowed frontend origin may use the read methods with the
+    headers it asked for.
+    Parameters
+    ----------
+    send : callable
+        The ASGI send callable.
+    headers : dict
+        The request headers.
+    """
+    response_headers = [(b'content-length', b'0')]
+    if(headers.get(b'origin') == ALLOWED_ORIGIN.encode('ascii')):
+        response_headers += [(b'access-control-allow-origin', headers[b'origin']),
+                             (b'access-control-allow-methods', ', '.join(ALLOWED_METHODS).encode('ascii'))]
+        if(b'access-control-request-headers' in headers):
+            response_headers.append((b'access-control-allow-headers', headers[b'access-control-request-headers']))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def application(scope, receive, send):
+    """
+    The ASGI application entry point. Lifespan events open and close the
+    async database connection pool; HTTP requests are authenticated with the
+    same JWT validation as the @login_required decorator and dispatched to
+    the matching async endpoint. WebSocket connections are refused.
+    """
+    if(scope['type'] == 'lifespan'):
+        while True:
+            message = await receive()
+            if(message['type'] == 'lifespan.startup'):
+                await database.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif(message['type'] == 'lifespan.shutdown'):
+                await database.disconnect()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if(scope['type'] == 'websocket'):
+        await receive()
+        return await send({'type': 'websocket.close'})
+    if(scope['type'] != 'http'):
+        return
+
+    headers = dict(scope['headers'])
+    origin = headers.get(b'origin')
+    method = scope['method']
+    head = method == 'HEAD'
+    view = routes.get(scope['path'])
+    if(not view):
+        return await send_json(send, {"message": "Not found"}, 404, origin, head)
+    if(method == 'OPTIONS'):
+        return await send_preflight(send, headers)
+    if(method not in ALLOWED_METHODS):
+        return await send_json(send, {"message": "Method not allowed"}, 405, origin, head)
+
+    user_uuid = decode_authorization_header(headers.get(b'authorization', b'').decode('latin-1'))
+    user = await get_user(user_uuid) if user_uuid else None
+    if(not user):
+        return await send_json(send, INVALID_TOKEN, 401, origin, head)
+    await send_json(send, await view(user), 200, origin, head)
@@ -0,0 +1,249 @@
+# This file keeps a read-only copy of the catalog (Recipes, Ingredients and
+# the Recipe links) in memory, for the read endpoints. The Custom Ingredients
+# that Recipes link to are part of the catalog too, read in the same select
+# as the Ingredients, but are not listed as Ingredients. Loading the catalog
+# as ORM instances costs an identity map entry and attribute instrumentation
+# per row, and every listing then copied the instances into dictionaries and
+# capitalized every name again. The copy holds compact records instead:
+#
+#     - CatalogIngredient and CatalogRecipe use __slots__, so a record has no
+#       __dict__ and holds only its fields.
+#     - Display names are capitalized once, and the Ingredient types are
+#       interned, so the records of one type share a single string.
+#     - The Ingredients are kept sorted by display name and the Recipes by
+#       name, so listings only filter them.
+#
+# The catalog is read with three Core selects once per catalog version and
+# cached, like the other indexes. It is never written to; changes go through
+# the ORM models and touch the 'catalog' Data_Version, which makes the next
+# read build a new copy.
+#
+# VersionedCache holds such per-version values for this file and for the
+# indexes of substitutions.py, shopping.py, similarity.py and resolver.py.
+# Replicas lag behind the primary database and behind each other, so every
+# database keeps a value of its own, keyed by the version read from it.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.catalog --recipes 30000
+import sys
+import threading
+from operator import attrgetter
+from flask import g, has_request_context
+from sqlalchemy import false, select, true
+from sdm_server import db
+from sdm_server.models import *
+
+class CatalogIngredient:
+    '''
+    The CatalogIngredient class is the read-only record of an Ingredient, or
+    of a Custom Ingredient that a Recipe uses.
+
+    id : int, The key of the Ingredient, see models.ingredient_keys.
+
+    name : str, The normalized name, as stored.
+
+    display_name : str, The capitalized name shown to Users.
+
+    type : str, The capitalized, interned Ingredient type.
+    '''
+    __slots__ = ('id', 'name', 'display_name', 'type')
+
+    def __init__(self, id, name, ingredient_type):
+        self.id = id
+        self.name = name
+        self.display_name = name.capitalize()
+        self.type = sys.intern(ingredient_type.capitalize())
+
+class CatalogRecipe:
+    '''
+    The CatalogRecipe class is the read-only record of a Recipe.
+
+    id : int, The primary key of the Recipe.
+
+    name : str, The name of the Recipe.
+
+    instructions : str, The instructions of the Recipe.
+
+    ingredient_ids : tuple, The ids of the Recipe's Ingredients, in the order of their display names.
+
+    ingredient_names : tuple, The display names of the Recipe's Ingredients, in the same order.
+    '''
+    __slots__ = ('id', 'name', 'instructions', 'ingredient_ids', 'ingredient_names')
+
+    def __init__(self, id, name, instructions, ingredients):
+        self.id = id
+        self.name = name
+        self.instructions = instructions
+        ingredients = sorted(ingredients, key=attrgetter('display_name'))
+        self.ingredient_ids = tuple(ingredient.id for ingredient in ingredients)
+        self.ingredient_names = tuple(ingredient.display_name for ingredient in ingredients)
+
+class Catalog:
+    '''
+    The Catalog class holds the records of the catalog for one catalog version.
+
+    version : tuple, The (version, updated_at) of the catalog the records were read for.
+
+    ingredients : Dictionary, Maps an Ingredient key to its CatalogIngredient, including the Custom Ingredients that Recipes use.
+
+    recipes : Dictionary, Maps a Recipe id to its CatalogRecipe.
+
+    recipe_ids : Dictionary, Maps a Recipe name to its id.
+
+    sorted_ingredients : tuple, The CatalogIngredients of the Ingredients, without Custom Ingredients, sorted by display name.
+
+    sorted_recipes : tuple, The CatalogRecipes sorted by name.
+    '''
+    def __init__(self, version, ingredients, recipes, links):
+        self.version = version
+        # The last column of a row tells whether it is an Ingredient, rather than a Custom Ingredient.
+        self.ingredients = {row[0]: CatalogIngredient(*row[:3]) for row in ingredients}
+        self.sorted_ingredients = tuple(sorted((self.ingredients[row[0]] for row in ingredients if row[3]),
+                                               key=attrgetter('display_name')))
+        linked = {}
+        for recipe_id, ingredient_id in links:
+            linked.setdefault(recipe_id, []).append(self.ingredients[ingredient_id])
+        self.recipes = {recipe_id: CatalogRecipe(recipe_id, name, instructions, linked.get(recipe_id, ()))
+                        for recipe_id, name, instructions in recipes}
+        self.recipe_ids = {recipe.name: recipe_id for recipe_id, recipe in self.recipes.items()}
+        self.sorted_recipes = tuple(sorted(self.recipes.values(), key=attrgetter('name')))
+
+    def find_recipes(self, recipe_ids):
+        """
+        Returns the CatalogRecipes of a set of Recipe ids, sorted by name. Ids that are not in
+        the catalog, e.g. of Recipes created after it was read, are ignored.
+        """
+        return sorted((self.recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in self.recipes),
+                      key=attrgetter('name'))
+
+    @staticmethod
+    def listing(recipe):
+        """
+        Returns a new dictionary with the 'name', 'instructions' and 'ingredients' of a
+        CatalogRecipe, as listed by the endpoints. It is new, so that callers can add to it.
+        """
+        return {'name': recipe.name, 'instructions': recipe.instructions, 'ingredients': list(recipe.ingredient_names)}
+
+    def recipe_listings(self, recipe_ids=None):
+        """
+        Returns the listings of Recipes, sorted by name.
+        Parameters
+        ----------
+        recipe_ids : iterable
+            Optionally only list these Recipes.
+        Returns
+        -------
+        recipes : List
+            A List of dictionaries as returned by listing().
+        """
+        recipes = self.sorted_recipes if recipe_ids is None else self.find_recipes(recipe_ids)
+        return [self.listing(recipe) for recipe in recipes]
+
+def build_catalog(version):
+    """
+    Reads the Ingredients, Recipes, Recipe links and the Custom Ingredients
+    that Recipes link to into a Catalog.
+    """
+    custom = (select([Custom_Ingredients.key_id, Custom_Ingredients.name, Custom_Ingredients.ingredient_type, false()])
+              .where(Custom_Ingredients.key_id.in_(select([recipe_ingredients.c.ingredient_id])))
+              .where(~Custom_Ingredients.key_id.in_(select([Ingredients.id]))))
+    ingredients = db.session.execute(select([Ingredients.id, Ingredients.name, Ingredients.ingredient_type, true()])
+                                     .union_all(custom)).fetchall()
+    recipes = db.session.execute(select([Recipe.id, Recipe.name, Recipe.instructions]))
+    links = db.session.execute(select([recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id]))
+    return Catalog(version, ingredients, recipes, links)
+
+class VersionedCache:
+    '''
+    The VersionedCache class caches a value built from the catalog, such as
+    an index, for the current catalog version of each database the requests
+    read from.
+
+    lock : Lock, Held while a value is looked up or built.
+
+    entries : Dictionary, Maps a database to the (version, value) cached for it.
+
+    rebuilding : Dictionary, Maps a database to the thread building its next value in the background.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.rebuilding = {}
+
+    @staticmethod
+    def get_source():
+        """
+        Returns the key of the database the current request reads from: the URL of its
+        replica, or 'primary'.
+        """
+        replica = g.get('read_replica') if has_request_context() else None
+        return str(replica.url) if replica is not None else 'primary'
+
+    def get(self, build, version=None, background=None):
+        """
+        Returns the value of a catalog version, building it only if the
+        version has changed since the value was last built.
+        Parameters
+        ----------
+        build : function
+            Called as build(version) to build the value.
+        version : object
+            The version to return the value of, by default the (version,
+            updated_at) of the catalog read from the current database. The
+            time of the change is part of the version, so that a version
+            number that is reused after a rolled back transaction is not
+            mistaken for the cached one.
+        background : function
+            Optionally called as background(version) when a cached value is
+            outdated. It returns a function that builds the new value, which
+            is run by a background thread while the outdated value is
+            returned. The first value is always built right away.
+        Returns
+        -------
+        value : object
+            The cached value.
+        """
+        if(version is None):
+            version, = Data_Version.lookup('catalog')
+        source = self.get_source()
+        with self.lock:
+            entry = self.entries.get(source)
+            if(entry is None or (background is None and entry[0] != version)):
+                entry = self.entries[source] = (version, build(version))
+            elif(entry[0] != version and source not in self.rebuilding):
+                thread = threading.Thread(target=self.rebuild, args=(source, version, background(version)), daemon=True)
+                self.rebuilding[source] = thread
+                thread.start()
+            return entry[1]
+
+    def rebuild(self, source, version, build):
+        """
+        Builds the value of a newer version in a background thread and caches it.
+        """
+        try:
+            value = build()
+            with self.lock:
+                self.entries[source] = (version, value)
+        finally:
+            with self.lock:
+                del self.rebuilding[source]
+
+    def wait(self):
+        """
+        Waits until the values being built in the background, if any, are cached.
+        """
+        with self.lock:
+            threads = list(self.rebuilding.values())
+        for thread in threads:
+            thread.join()
+
+catalogs = VersionedCache()
+
+def get_catalog():
+    """
+    Returns the Catalog of the current catalog version, reading it only if
+    the catalog has changed since it was last read. Listings reuse the
+    version that responses.conditional_get looked up for their ETag.
+    """
+    versions = g.get('data_versions', {}) if has_request_context() else {}
+    return catalogs.get(build_catalog, versions.get('catalog'))
@@ -0,0 +1,162 @@
+# This file defines the database engine profiles of the SDM backend. The
+# engine options are chosen from the database URI when the engine is
+# created, so they also apply when the URI is changed after import, e.g.
+# by the tests or the benchmarks.
+#
+# MySQL (production) uses a bounded connection pool that checks connections
+# before use and recycles them before the server's wait_timeout closes them.
+# SQLite (development) uses a small pool of connections in WAL mode, so that
+# readers are not blocked by a writer, and waits for locks instead of
+# failing with 'database is locked'. In-memory SQLite keeps the single
+# shared connection Flask-SQLAlchemy gives it.
+#
+# Every option can be overridden through SQLALCHEMY_ENGINE_OPTIONS, and the
+# SQLite pragmas through SQLITE_PRAGMAS.
+#
+# Read-only requests can be served by replicas of the database, listed in
+# SQLALCHEMY_REPLICA_URIS. A request reads from a replica only after
+# ProfiledSQLAlchemy.use_replicas() was called for it; everything else,
+# including every flush, goes to the primary database.
+import os
+import random
+import threading
+from datetime import datetime, timedelta
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+
+MYSQL_PROFILE = {
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_timeout': 10,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+}
+
+SQLITE_PROFILE = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_timeout': 10,
+}
+
+# Applied to every new SQLite connection, in order.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('mmap_size', 268435456),
+)
+
+def is_file_sqlite(sa_url):
+    """
+    Checks if a database URL points to an SQLite database file.
+    """
+    return sa_url.drivername.startswith('sqlite') and sa_url.database not in (None, '', ':memory:')
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+    Applies PRAGMA statements to a new SQLite connection.
+    Parameters
+    ----------
+    dbapi_connection : sqlite3.Connection
+        The connection that was just opened.
+    pragmas : List
+        A List of (name, value) tuples.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA {}={}'.format(name, value))
+    cursor.close()
+
+class RoutingSession(SignallingSession):
+    '''
+    The RoutingSession class sends the queries of requests that were routed
+    to the replicas to the replica engine chosen for the request. Flushes always
+    go to the primary database, because replicas are read-only.
+    '''
+    def get_bind(self, mapper=None, clause=None):
+        if(not self._flushing and has_request_context() and g.get('read_replica')):
+            return g.read_replica
+        return super().get_bind(mapper, clause)
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    '''
+    The ProfiledSQLAlchemy class applies the engine profile matching the
+    database URI on top of the defaults of Flask-SQLAlchemy. Pooled engines
+    use InstrumentedQueuePool, which reports checkout waits and pool
+    saturation to /metrics.
+    '''
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        from sdm_server.metrics import InstrumentedQueuePool
+        if(sa_url.drivername.startswith('mysql')):
+            options.update(MYSQL_PROFILE)
+            options['poolclass'] = InstrumentedQueuePool
+        elif(is_file_sqlite(sa_url)):
+            options.update(SQLITE_PROFILE)
+            options['poolclass'] = InstrumentedQueuePool
+            # Pooled connections are handed to whichever thread serves the next request.
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def __init__(self, *args, **kwargs):
+        self.replica_engines = {}
+        self.replica_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replica_engines(self, app=None):
+        """
+        Returns the engines of the replicas listed in SQLALCHEMY_REPLICA_URIS.
+        The engines are created on first use with the same profiles as the
+        primary engine.
+        """
+        app = self.get_app(app)
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or ()
+        with self.replica_lock:
+            for uri in uris:
+                if(uri not in self.replica_engines):
+                    sa_url = make_url(uri)
+                    options = {}
+                    self.apply_pool_defaults(app, options)
+                    self.apply_driver_hacks(app, sa_url, options)
+                    options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+                    self.replica_engines[uri] = self.create_engine(sa_url, options)
+            return [self.replica_engines[uri] for uri in uris]
+
+    def use_replicas(self, last_written=None):
+        """
+        Routes the remaining queries of the current request to a randomly
+        chosen replica. Every query of the request goes to the same replica,
+        so that they read the same state. Replicas lag behind the primary
+        database, so a request that depends on data written within
+        READ_YOUR_WRITES_SECONDS stays on the primary, and Users always see
+        their own changes.
+        Parameters
+        ----------
+        last_written : datetime
+            When the data the request reads was last written (UTC), or None
+            if it was never written.
+        Returns
+        -------
+        routed : bool
+            True if the request now reads from the replicas.
+        """
+        app = self.get_app()
+        window = timedelta(seconds=app.config.get('READ_YOUR_WRITES_SECONDS', 5))
+        if(last_written is not None and datetime.utcnow() - last_written < window):
+            return False
+        engines = self.get_replica_engines(app)
+        if(engines):
+            g.read_replica = random.choice(engines)
+        return bool(engines)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        engine.pool.metrics_name = os.path.basename(sa_url.database or '')
+        if(is_file_sqlite(sa_url)):
+            pragmas = self.get_app().config.get('SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+            event.listen(engine, 'connect', lambda dbapi_connection, record: set_sqlite_pragmas(dbapi_connection, pragmas))
+        return engine
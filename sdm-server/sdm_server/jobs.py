@@ -0,0 +1,173 @@
+# This file runs bulk jobs over every User on a pool of worker processes.
+# Matching is CPU-bound Python, so threads would share one core; processes
+# do not.
+#
+# The Users are split into shards of consecutive ids. Data that every shard
+# needs, such as a Recipe index, is built once in the parent and handed to
+# each worker when it starts. With the fork start method the workers inherit
+# it copy-on-write instead of receiving a copy. Shard results are merged in
+# the parent in the order of the shards, and only a few shards per worker
+# are handed out ahead, so memory holds the merged result and the results of
+# those shards, not one result per shard.
+#
+# A job is a function(shared, user_ids) returning the result of one shard,
+# and a function(result, shard_result) merging two results. The first is
+# sent to the workers, so it must be defined at module level (or be a
+# functools.partial of such a function).
+import multiprocessing
+import os
+import statistics
+import time
+import click
+from collections import deque
+from sqlalchemy.pool import StaticPool
+from sdm_server import app, db
+from sdm_server.models import *
+
+# The number of worker processes; None uses every core.
+app.config.setdefault('JOB_WORKERS', None)
+# The number of Users per shard.
+app.config.setdefault('JOB_SHARD_SIZE', 5000)
+
+class ShardTiming:
+    '''
+    The ShardTiming class describes one finished shard.
+
+    index : int, The position of the shard.
+
+    users : int, The number of Users in the shard.
+
+    seconds : float, The time the worker spent on the shard.
+
+    worker : int, The process id of the worker.
+    '''
+    def __init__(self, index, users, seconds, worker):
+        self.index = index
+        self.users = users
+        self.seconds = seconds
+        self.worker = worker
+
+# The shared data of the job, set in every worker by init_worker.
+shared_data = None
+
+def release_connections():
+    """
+    Closes the session and pooled connections of this process before the
+    workers are forked, so that they inherit no open connection. An
+    in-memory SQLite database only exists in its single connection, which
+    is kept.
+    """
+    db.session.remove()
+    if(not isinstance(db.engine.pool, StaticPool)):
+        db.engine.dispose()
+
+def init_worker(shared, in_worker=False):
+    global shared_data
+    shared_data = shared
+    if(in_worker):
+        # A connection inherited from the parent must neither be used nor closed here: closing
+        # or rolling it back would talk to the server over the parent's socket. The session
+        # registry and the pool are replaced without touching them, so that every worker opens
+        # connections of its own.
+        db.session.registry.clear()
+        if(not isinstance(db.engine.pool, StaticPool)):
+            db.engine.pool = db.engine.pool.recreate()
+
+def run_shard(function, index, user_ids, in_worker=False):
+    """
+    Runs a job function on one shard, timing it.
+    """
+    start = time.perf_counter()
+    try:
+        result = function(shared_data, user_ids)
+    finally:
+        # A worker's session must not keep a transaction open between shards.
+        if(in_worker):
+            db.session.remove()
+    return ShardTiming(index, len(user_ids), time.perf_counter() - start, os.getpid()), result
+
+def get_shards(user_ids, shard_size):
+    """
+    Splits the sorted User ids into Lists of at most shard_size consecutive ids.
+    """
+    user_ids = sorted(user_ids)
+    return [user_ids[first:first + shard_size] for first in range(0, len(user_ids), shard_size)]
+
+def run_sharded(function, merge, shared=None, user_ids=None, workers=None, shard_size=None, progress=None):
+    """
+    Runs a job over the shards of the Users and merges the shard results.
+    Parameters
+    ----------
+    function : function
+        Called as function(shared, user_ids) for every shard, returns its result.
+    merge : function
+        Called as merge(result, shard_result), returns the merged result.
+    shared : object
+        Read-only data passed to every call of function.
+    user_ids : iterable
+        The Users to run the job for. Defaults to every User.
+    workers : int
+        The number of worker processes. Defaults to JOB_WORKERS. With one
+        worker, the shards are run in this process.
+    shard_size : int
+        The number of Users per shard. Defaults to JOB_SHARD_SIZE.
+    progress : function
+        Called as progress(timing, done, total) after every shard.
+    Returns
+    -------
+    result : object
+        The merged result, None if there are no Users.
+    timings : List
+        The ShardTiming of every shard.
+    """
+    if(user_ids is None):
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+    shards = get_shards(user_ids, shard_size or app.config['JOB_SHARD_SIZE'])
+    workers = min(workers or app.config['JOB_WORKERS'] or os.cpu_count() or 1, max(1, len(shards)))
+    result, timings = None, []
+
+    def collect(finished):
+        nonlocal result
+        timing, shard_result = finished
+        result = shard_result if result is None else merge(result, shard_result)
+        timings.append(timing)
+        if(progress):
+            progress(timing, len(timings), len(shards))
+
+    if(workers == 1):
+        init_worker(shared)
+        try:
+            for index, shard in enumerate(shards):
+                collect(run_shard(function, index, shard))
+        finally:
+            init_worker(None)
+        return result, timings
+
+    release_connections()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(shared, True)) as pool:
+        pending = deque()
+        for index, shard in enumerate(shards):
+            pending.append(pool.apply_async(run_shard, (function, index, shard, True)))
+            if(len(pending) >= 2 * workers):
+                collect(pending.popleft().get())
+        while(pending):
+            collect(pending.popleft().get())
+    return result, timings
+
+def echo_progress(timing, done, total):
+    """
+    Prints the progress of a job after a shard finished; the progress argument of run_sharded.
+    """
+    click.echo("Shard {}/{}: {} Users in {:.2f}s (worker {}), {:.0%} done.".format(
+        timing.index + 1, total, timing.users, timing.seconds, timing.worker, done / total))
+
+def echo_timings(timings, elapsed):
+    """
+    Prints a summary of the shard timings of a job that took elapsed seconds.
+    """
+    if(not timings):
+        return
+    seconds = [timing.seconds for timing in timings]
+    users = sum(timing.users for timing in timings)
+    click.echo("{} shards in {:.1f}s, {:.0f} Users/s. Shard time: mean {:.2f}s, max {:.2f}s, total {:.1f}s.".format(
+        len(timings), elapsed, users / elapsed if elapsed else 0, statistics.mean(seconds), max(seconds), sum(seconds)))
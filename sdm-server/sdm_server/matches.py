@@ -0,0 +1,282 @@
+# This file maintains the user_recipe_match table, which stores for every
+# User how many of each Recipe's Ingredients are in the User's cabinet.
+# With it, the filtered and partial recipe listings are indexed reads of a
+# User's rows instead of a join over the whole cabinet and catalog.
+#
+# The table is updated in the same transaction as the change that affects it:
+#
+#     - Adding Ingredients to a cabinet increments the rows of only the
+#       Recipes that use them, and removing Ingredients decrements them.
+#     - Changing the Ingredients of a Recipe recomputes that Recipe's rows.
+#     - Custom Ingredients count as the key of their name, which Recipes can
+#       link to and which is shared with the Ingredient of the same name (see
+#       models.cabinet_keys). Changing the Custom Ingredients of a User
+#       recomputes that User's rows. The shared catalog is not touched.
+#
+# Writes that bypass the ORM session must call rebuild() afterwards.
+#
+# Usage (from the sdm-server directory):
+#     FLASK_APP=sdm_server flask match-rebuild
+#     FLASK_APP=sdm_server flask match-check --workers 4
+import operator
+import sys
+import click
+from sqlalchemy import event, inspect, select, func, literal, exists, and_
+from flask_sqlalchemy import SignallingSession
+from sdm_server import app, db, jobs
+from sdm_server.models import *
+from sdm_server.models import get_relinked_recipes, cabinet_keys, custom_cabinet_keys
+
+def live_matched_counts(user_ids=None, recipe_ids=None):
+    """
+    Selects the matched counts computed from the cabinet keys and the Recipe
+    links, i.e. what the user_recipe_match table should contain.
+    Parameters
+    ----------
+    user_ids : iterable
+        Optionally limit the counts to these Users.
+    recipe_ids : iterable
+        Optionally limit the counts to these Recipes.
+    Returns
+    -------
+    select : Select
+        A select of (user_id, recipe_id, matched_count) rows.
+    """
+    cabinet = cabinet_keys(user_ids).alias('cabinet')
+    query = select([cabinet.c.user_id, recipe_ingredients.c.recipe_id, func.count().label('matched_count')]) \
+        .select_from(recipe_ingredients.join(cabinet, cabinet.c.ingredient_id == recipe_ingredients.c.ingredient_id)) \
+        .group_by(cabinet.c.user_id, recipe_ingredients.c.recipe_id)
+    if(recipe_ids is not None):
+        query = query.where(recipe_ingredients.c.recipe_id.in_(sorted(recipe_ids)))
+    return query
+
+def rebuild(connection, user_ids=None, recipe_ids=None):
+    """
+    Recomputes rows of the user_recipe_match table from scratch.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the statements.
+    user_ids : iterable
+        Optionally rebuild only the rows of these Users.
+    recipe_ids : iterable
+        Optionally rebuild only the rows of these Recipes.
+    """
+    delete = user_recipe_match.delete()
+    if(user_ids is not None):
+        delete = delete.where(user_recipe_match.c.user_id.in_(sorted(user_ids)))
+    if(recipe_ids is not None):
+        delete = delete.where(user_recipe_match.c.recipe_id.in_(sorted(recipe_ids)))
+    connection.execute(delete)
+    connection.execute(user_recipe_match.insert().from_select(
+        ['user_id', 'recipe_id', 'matched_count'], live_matched_counts(user_ids, recipe_ids)))
+
+def apply_cabinet_change(connection, user_id, ingredient_ids, delta, skip_recipe_ids=()):
+    """
+    Updates a User's rows after Ingredients were added to or removed from the
+    cabinet. Only the Recipes that use those Ingredients are touched.
+    Ingredients that a Custom Ingredient of the User resolves to were
+    counted before and still are, so they are skipped.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the statements.
+    user_id : int
+        The primary key of the User.
+    ingredient_ids : iterable
+        The ids of the Ingredients that were added or removed.
+    delta : int
+        1 if the Ingredients were added, -1 if they were removed.
+    skip_recipe_ids : iterable
+        Recipes whose rows are rebuilt separately and must not be updated.
+    """
+    ingredient_ids = sorted(ingredient_ids)
+    links = recipe_ingredients.alias('links')
+    custom = select([custom_cabinet_keys([user_id]).alias('custom').c.ingredient_id])
+    posting = and_(links.c.ingredient_id.in_(ingredient_ids), ~links.c.ingredient_id.in_(custom))
+    if(skip_recipe_ids):
+        posting = and_(posting, ~links.c.recipe_id.in_(sorted(skip_recipe_ids)))
+    row = and_(user_recipe_match.c.user_id == user_id, user_recipe_match.c.recipe_id == links.c.recipe_id)
+    if(delta > 0):
+        # Recipes that did not share an Ingredient with the cabinet yet get a row first. A concurrent
+        # change of the same User may insert the same row, which is then kept and incremented.
+        missing = select([literal(user_id), links.c.recipe_id, literal(0)]).where(posting) \
+            .where(~exists().where(row)).distinct()
+        insert = user_recipe_match.insert().prefix_with('OR IGNORE', dialect='sqlite').prefix_with('IGNORE', dialect='mysql')
+        connection.execute(insert.from_select(['user_id', 'recipe_id', 'matched_count'], missing))
+    # Every Recipe changes by the number of its Ingredients that were added or removed.
+    changed = select([func.count()]).where(posting).where(links.c.recipe_id == user_recipe_match.c.recipe_id).as_scalar()
+    connection.execute(user_recipe_match.update()
+                       .where(user_recipe_match.c.user_id == user_id)
+                       .where(user_recipe_match.c.recipe_id.in_(select([links.c.recipe_id]).where(posting)))
+                       .values(matched_count=user_recipe_match.c.matched_count + delta * changed))
+    if(delta < 0):
+        connection.execute(user_recipe_match.delete().where(user_recipe_match.c.user_id == user_id)
+                           .where(user_recipe_match.c.matched_count <= 0))
+
+def fully_matched_ids(user_id):
+    """
+    Selects the ids of the Recipes whose Ingredients are all in a User's cabinet,
+    from the user_recipe_match table. Recipes without Ingredients match every cabinet.
+    Parameters
+    ----------
+    user_id : int
+        The primary key of the User.
+    Returns
+    -------
+    select : Select
+        A select of a single recipe id column, usable as a subquery.
+    """
+    matched = select([Recipe.id]) \
+        .select_from(Recipe.__table__.join(user_recipe_match, user_recipe_match.c.recipe_id == Recipe.id)) \
+        .where(user_recipe_match.c.user_id == user_id) \
+        .where(user_recipe_match.c.matched_count == Recipe.ingredient_count)
+    return matched.union(select([Recipe.id]).where(Recipe.ingredient_count == 0))
+
+def partially_matched_ids(user_id):
+    """
+    Selects the ids of the Recipes with at least one Ingredient in a User's
+    cabinet, from the user_recipe_match table.
+    Parameters
+    ----------
+    user_id : int
+        The primary key of the User.
+    Returns
+    -------
+    select : Select
+        A select of a single recipe id column, usable as a subquery.
+    """
+    return select([user_recipe_match.c.recipe_id]).where(user_recipe_match.c.user_id == user_id)
+
+def check(connection, user_ids=None):
+    """
+    Compares the user_recipe_match table against the matching of validators.py,
+    done in Python: a Recipe is fully matched if its Ingredients are a subset
+    of the cabinet keys (see validators.get_cabinet_keys), and partially
+    matched if they share a key.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the queries.
+    user_ids : iterable
+        Optionally check only these Users. Defaults to every User.
+    Returns
+    -------
+    problems : List
+        A List of dictionaries describing each inconsistency, empty if the
+        table is consistent.
+    """
+    if(user_ids is None):
+        user_ids = [user_id for (user_id,) in connection.execute(select([User.id]))]
+    recipes = {recipe_id: set() for (recipe_id,) in connection.execute(select([Recipe.id]))}
+    for recipe_id, ingredient_id in connection.execute(select([recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id])):
+        recipes[recipe_id].add(ingredient_id)
+    cabinets = {}
+    for user_id, ingredient_id in connection.execute(cabinet_keys(user_ids)):
+        cabinets.setdefault(user_id, set()).add(ingredient_id)
+    problems = []
+    for user_id in sorted(user_ids):
+        cabinet = cabinets.get(user_id, set())
+        stored = {row.recipe_id: row.matched_count for row in connection.execute(
+            select([user_recipe_match]).where(user_recipe_match.c.user_id == user_id))}
+        expected = {recipe_id: len(ingredients & cabinet) for recipe_id, ingredients in recipes.items()
+                    if not ingredients.isdisjoint(cabinet)}
+        for recipe_id in sorted(set(stored) | set(expected)):
+            if(stored.get(recipe_id) != expected.get(recipe_id)):
+                problems.append({'user_id': user_id, 'recipe_id': recipe_id, 'problem': 'matched_count',
+                                 'stored': stored.get(recipe_id), 'expected': expected.get(recipe_id)})
+        fully_matched = {recipe_id for recipe_id, ingredients in recipes.items() if ingredients <= cabinet}
+        for listing, materialized, expected in [('filtered', fully_matched_ids, fully_matched),
+                                                ('partial', partially_matched_ids, set(expected))]:
+            stored = {recipe_id for (recipe_id,) in connection.execute(materialized(user_id))}
+            if(stored != expected):
+                problems.append({'user_id': user_id, 'problem': listing,
+                                 'missing': sorted(expected - stored), 'unexpected': sorted(stored - expected)})
+    return problems
+
+@event.listens_for(SignallingSession, 'before_flush')
+def collect_match_changes(session, flush_context, instances):
+    """
+    Record the cabinet, Custom Ingredient and Recipe changes of this flush.
+    Rows of deleted Users and Recipes are removed right away, before their
+    rows are deleted.
+    """
+    changes = session.info.setdefault('match_changes', {'cabinet': set(), 'recipes': set(), 'users': set(), 'custom': set()})
+    changes['recipes'].update(get_relinked_recipes(session))
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, User):
+            if instance in session.deleted and instance.id is not None:
+                session.execute(user_recipe_match.delete().where(user_recipe_match.c.user_id == instance.id))
+                continue
+            history = inspect(instance).attrs['ingredients'].history
+            changes['cabinet'].update((instance, ingredient, 1) for ingredient in history.added or ())
+            changes['cabinet'].update((instance, ingredient, -1) for ingredient in history.deleted or ())
+        elif isinstance(instance, Ingredients):
+            history = inspect(instance).attrs['owned_by'].history
+            changes['cabinet'].update((user, instance, 1) for user in history.added or ())
+            changes['cabinet'].update((user, instance, -1) for user in history.deleted or ())
+        elif isinstance(instance, Custom_Inventory):
+            # The User of a new entry is only known once it is flushed.
+            if instance in session.new or instance in session.deleted:
+                changes['custom'].add(instance)
+        elif isinstance(instance, Custom_Ingredients):
+            if instance not in session.new and (instance in session.deleted
+                                                or inspect(instance).attrs['name'].history.has_changes()):
+                changes['users'].update(instance.owned_by)
+        elif isinstance(instance, Recipe) and instance in session.deleted and instance.id is not None:
+            session.execute(user_recipe_match.delete().where(user_recipe_match.c.recipe_id == instance.id))
+
+@event.listens_for(SignallingSession, 'after_flush')
+def update_matches(session, flush_context):
+    """
+    Apply the changes collected before the flush to user_recipe_match. The
+    Recipes whose links changed and the Users whose Custom Ingredients
+    changed are rebuilt, and the cabinet changes are applied to every other
+    Recipe and User, so that no change is counted twice.
+    """
+    changes = session.info.pop('match_changes', None)
+    if(not changes):
+        return
+    connection = session.connection()
+    recipe_ids = {recipe.id for recipe in changes['recipes'] if recipe.id is not None}
+    deleted = {instance.id for instance in session.deleted if isinstance(instance, User)}
+    user_ids = {user.id for user in changes['users']} | {inventory.user for inventory in changes['custom']}
+    user_ids -= deleted | {None}
+    grouped = {}
+    for user, ingredient, delta in changes['cabinet']:
+        if(user in session.deleted or user.id is None or ingredient.id is None or user.id in user_ids):
+            continue
+        grouped.setdefault((user.id, delta), set()).add(ingredient.id)
+    for (user_id, delta), ingredient_ids in sorted(grouped.items()):
+        apply_cabinet_change(connection, user_id, ingredient_ids, delta, recipe_ids)
+    if(recipe_ids):
+        rebuild(connection, recipe_ids=recipe_ids)
+    if(user_ids):
+        rebuild(connection, user_ids)
+
+@app.cli.command('match-rebuild')
+@click.option('--user', 'user_ids', type=int, multiple=True, help="Only rebuild the rows of this User id.")
+def match_rebuild_command(user_ids):
+    """Rebuild the user_recipe_match table."""
+    with db.engine.begin() as connection:
+        rebuild(connection, user_ids or None)
+    click.echo("Rebuilt user_recipe_match for {}.".format('{} Users'.format(len(user_ids)) if user_ids else 'every User'))
+
+def check_shard(shared, user_ids):
+    """
+    Checks the rows of a shard of Users through db.session. Used with jobs.run_sharded().
+    """
+    return check(db.session, user_ids)
+
+@app.cli.command('match-check')
+@click.option('--user', 'user_ids', type=int, multiple=True, help="Only check the rows of this User id.")
+@click.option('--workers', type=int, help="The number of worker processes, JOB_WORKERS by default.")
+def match_check_command(user_ids, workers):
+    """Check user_recipe_match against the live recipe matching."""
+    problems, _ = jobs.run_sharded(check_shard, operator.add, user_ids=user_ids or None, workers=workers)
+    problems = problems or []
+    for problem in problems:
+        click.echo(', '.join('{}={}'.format(key, value) for key, value in problem.items()))
+    click.echo("{} inconsistencies found.".format(len(problems)))
+    if problems:
+        sys.exit(1)
@@ -0,0 +1,296 @@
+# This file extracts structured measurements from the free text instructions
+# of Recipes ("Blend 1/4 cup Ice, 1/2 cup papaya juice, and 2 TBSP ...") and
+# stores them in the recipe_measurements table. The instructions are parsed
+# once, when a Recipe is created or its instructions or Ingredients change,
+# so reading the amounts never involves the parser.
+#
+# Amounts are normalized to cups for volumes and to pieces for everything
+# else. Inventory quantities are compared against them as is, i.e. a quantity
+# of 2 means two cups or two pieces, depending on how the Recipes measure
+# the Ingredient. Quantities are decimals, so a serving uses up exactly its
+# amount, and a User can make floor(quantity / amount) servings. Amounts and
+# quantities are kept to QUANTITY_PLACES decimal places, so that subtracting
+# amounts does not accumulate floating point errors. Ingredients in the
+# cabinet without an Inventory entry have no quantity to count: they never
+# limit the servings and are left alone when a Recipe is made.
+#
+# Usage (from the sdm-server directory):
+#     FLASK_APP=sdm_server flask measurements-import
+import math
+import re
+from fractions import Fraction
+import click
+from sqlalchemy import event, inspect, select, func, and_
+from flask_sqlalchemy import SignallingSession
+from sdm_server import app, db
+from sdm_server.models import *
+from sdm_server.models import get_relinked_recipes
+
+# Volume units and their size in cups.
+VOLUME_UNITS = {'cup': 1.0, 'c': 1.0, 'tablespoon': 1 / 16, 'tbsp': 1 / 16, 'tbs': 1 / 16,
+                'teaspoon': 1 / 48, 'tsp': 1 / 48, 'ounce': 1 / 8, 'oz': 1 / 8, 'ml': 1 / 236.6,
+                'dash': 1 / 384, 'pinch': 1 / 768}
+
+# Amounts and Inventory quantities are rounded to this many decimal places, e.g. 0.0208 cups for a teaspoon.
+QUANTITY_PLACES = 4
+# floor(quantity / amount) is computed in floating point, where e.g. 0.3 / 0.1 falls just below 3.
+SERVINGS_TOLERANCE = 1e-9
+
+# Units that count pieces of an Ingredient. They may also follow the name, as in '5 Mango slices'.
+COUNT_UNITS = {'slice', 'cube', 'chunk', 'piece', 'sprig', 'wedge', 'scoop'}
+
+QUANTITY = r'\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?'
+FRACTIONS = {'\u00bc': ' 1/4', '\u00bd': ' 1/2', '\u00be': ' 3/4', '\u2153': ' 1/3', '\u2154': ' 2/3', '\u215b': ' 1/8'}
+
+# Items are separated by commas, sentences, or an 'and'/'with' that is followed by the next quantity.
+ITEM_SEPARATOR = re.compile(r'[,;]|\.(?=\s+[A-Z]|\s*$)|\s+(?:and|with)\s+(?=(?:{})|an?\s)'.format(QUANTITY))
+# An item is measured from its first quantity on, e.g. 'the juice of 1 lime'. Of a range such as
+# '3 to 4 tablespoons' the lower bound is used.
+ITEM = re.compile(r'(?:^|\s)(?:(?P<number>{0})(?:\s*(?:to|-)\s*(?:{0}))?\s*|(?P<article>an?)\s+)(?P<rest>.+)$'.format(QUANTITY))
+
+def singular(word):
+    """
+    Returns a naive singular form of an English word, so that 'Strawberries'
+    in the instructions matches the Ingredient 'strawberry'.
+    """
+    if(len(word) > 4 and word.endswith('ies')):
+        return word[:-3] + 'y'
+    if(word.endswith(('ches', 'shes', 'sses', 'xes', 'oes'))):
+        return word[:-2]
+    if(len(word) > 3 and word.endswith('s') and not word.endswith('ss')):
+        return word[:-1]
+    return word
+
+def normalize(text):
+    """
+    Lowercases a text, drops punctuation and makes every word singular.
+    """
+    return ' '.join(singular(word) for word in re.findall(r"[\w']+", text.lower()))
+
+def parse_quantity(text):
+    """
+    Converts a quantity such as '2', '1/4', '1 1/2' or '3.5' to a float.
+    """
+    return float(sum(Fraction(part) for part in text.split()))
+
+def parse_items(instructions):
+    """
+    Splits instructions into measured items.
+    Parameters
+    ----------
+    instructions : str
+        The instructions of a Recipe.
+    Returns
+    -------
+    items : List
+        A List of (text, amount, unit) tuples, where text names one or more
+        Ingredients, amount is normalized to cups or pieces and unit is
+        'cup' or 'piece'. Items without a quantity, e.g. 'sugar to taste',
+        are left out.
+    """
+    for fraction, text in FRACTIONS.items():
+        instructions = instructions.replace(fraction, text)
+    items = []
+    for item in ITEM_SEPARATOR.split(instructions):
+        match = ITEM.search(item.strip().lower())
+        if(not match):
+            continue
+        amount = parse_quantity(match.group('number')) if match.group('number') else 1.0
+        words = match.group('rest').split()
+        first = singular(words[0].rstrip('.')) if words else None
+        unit = 'piece'
+        if(first in VOLUME_UNITS):
+            amount *= VOLUME_UNITS[first]
+            unit = 'cup'
+            words.pop(0)
+        elif(first in COUNT_UNITS):
+            words.pop(0)
+        elif(len(words) > 1 and singular(words[-1]) in COUNT_UNITS):
+            words.pop()
+        if(words and words[0] == 'of'):
+            words.pop(0)
+        if(words and amount > 0):
+            items.append((' '.join(words), amount, unit))
+    return items
+
+def parse_instructions(instructions, ingredients):
+    """
+    Extracts the amount of each of a Recipe's Ingredients from its instructions.
+    Parameters
+    ----------
+    instructions : str
+        The instructions of the Recipe.
+    ingredients : dict
+        Maps the ids of the Recipe's Ingredients to their names.
+    Returns
+    -------
+    measurements : dict
+        Maps Ingredient ids to (amount, unit) tuples. Ingredients whose
+        amount is not given in the instructions are not present.
+    """
+    names = sorted(((' {} '.format(normalize(name)), ingredient_id) for ingredient_id, name in ingredients.items()),
+                   key=lambda name: -len(name[0]))
+    measurements = {}
+    for text, amount, unit in parse_items(instructions):
+        # '1/2 cup each vanilla yogurt and milk' gives every listed Ingredient the same amount.
+        each = text.startswith('each ')
+        for part in re.split(r'\s+and\s+|\s+or\s+', text[5:]) if each else [text]:
+            part = ' {} '.format(normalize(part))
+            # The longest Ingredient name wins, so 'coconut milk' is not read as 'coconut'.
+            ingredient_id = next((ingredient_id for name, ingredient_id in names if name in part), None)
+            if(ingredient_id is None):
+                continue
+            if(ingredient_id in measurements):
+                previous, previous_unit = measurements[ingredient_id]
+                if(previous_unit == unit):
+                    measurements[ingredient_id] = (previous + amount, unit)
+            else:
+                measurements[ingredient_id] = (amount, unit)
+    return measurements
+
+def store(connection, recipe_ids=None):
+    """
+    Parses the instructions of Recipes and replaces their rows in the
+    recipe_measurements table.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the statements.
+    recipe_ids : iterable
+        Optionally only store the measurements of these Recipes.
+    Returns
+    -------
+    stored : int
+        The number of measurements written.
+    """
+    recipes = select([Recipe.id, Recipe.instructions])
+    links = select([recipe_ingredients.c.recipe_id, ingredient_keys.c.id, ingredient_keys.c.name]) \
+        .select_from(recipe_ingredients.join(ingredient_keys, ingredient_keys.c.id == recipe_ingredients.c.ingredient_id))
+    delete = recipe_measurements.delete()
+    if(recipe_ids is not None):
+        recipe_ids = sorted(recipe_ids)
+        recipes = recipes.where(Recipe.id.in_(recipe_ids))
+        links = links.where(recipe_ingredients.c.recipe_id.in_(recipe_ids))
+        delete = delete.where(recipe_measurements.c.recipe_id.in_(recipe_ids))
+    ingredients = {}
+    for recipe_id, ingredient_id, name in connection.execute(links):
+        ingredients.setdefault(recipe_id, {})[ingredient_id] = name
+    rows = []
+    for recipe_id, instructions in connection.execute(recipes):
+        for ingredient_id, (amount, unit) in parse_instructions(instructions, ingredients.get(recipe_id, {})).items():
+            rows.append({'recipe_id': recipe_id, 'ingredient_id': ingredient_id,
+                         'amount': round(amount, QUANTITY_PLACES), 'unit': unit})
+    connection.execute(delete)
+    if(rows):
+        connection.execute(recipe_measurements.insert(), rows)
+    return len(rows)
+
+def get_servings(user_id, recipe_ids):
+    """
+    Computes how many servings of each Recipe a User can make with the
+    quantities in the User's Inventory, i.e. how many times consume() would
+    succeed: each Ingredient allows floor(quantity / amount) servings.
+    The computation is a single grouped query over the measurements of every
+    selected Recipe.
+
+    Ingredients without a measurement, or without an Inventory entry, do not
+    limit the servings.
+    Parameters
+    ----------
+    user_id : int
+        The primary key of the User.
+    recipe_ids : Select
+        A select of Recipe ids, e.g. from matches.fully_matched_ids.
+    Returns
+    -------
+    servings : dict
+        Maps Recipe ids to the number of servings. Recipes without any
+        limiting Ingredient are not present.
+    """
+    inventory = Inventory.__table__
+    ratio = func.min(inventory.c.quantity / recipe_measurements.c.amount)
+    query = select([recipe_measurements.c.recipe_id, ratio]) \
+        .select_from(recipe_measurements.join(inventory, and_(inventory.c.ingredient == recipe_measurements.c.ingredient_id,
+                                                               inventory.c.user == user_id))) \
+        .where(and_(recipe_measurements.c.recipe_id.in_(recipe_ids), recipe_measurements.c.amount > 0)) \
+        .group_by(recipe_measurements.c.recipe_id)
+    return {recipe_id: max(0, int(math.floor(value + SERVINGS_TOLERANCE))) for recipe_id, value in db.session.execute(query)}
+
+def consume(connection, user_id, recipe_id):
+    """
+    Decrements the Inventory quantities of a User by the amounts of one
+    serving of a Recipe, with a single UPDATE that only changes rows whose
+    quantity covers the amount. Measured Ingredients without an Inventory
+    entry are not decremented. The caller must roll back if not every
+    Inventory entry was decremented, and commit otherwise.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the statements.
+    user_id : int
+        The primary key of the User.
+    recipe_id : int
+        The primary key of the Recipe.
+    Returns
+    -------
+    used : dict
+        Maps the id of every measured Ingredient of the Recipe that has an Inventory entry to
+        the amount used up.
+    decremented : int
+        The number of Inventory entries decremented.
+    """
+    inventory = Inventory.__table__
+    rows = connection.execute(select([recipe_measurements.c.ingredient_id, recipe_measurements.c.amount])
+                              .select_from(recipe_measurements.join(inventory, and_(
+                                  inventory.c.ingredient == recipe_measurements.c.ingredient_id, inventory.c.user == user_id)))
+                              .where(recipe_measurements.c.recipe_id == recipe_id))
+    used = {ingredient_id: needed for ingredient_id, needed in rows}
+    if(not used):
+        return used, 0
+    needed = select([recipe_measurements.c.amount]).where(and_(recipe_measurements.c.recipe_id == recipe_id,
+                                                recipe_measurements.c.ingredient_id == inventory.c.ingredient)).as_scalar()
+    result = connection.execute(inventory.update()
+                                .where(and_(inventory.c.user == user_id, inventory.c.ingredient.in_(sorted(used)),
+                                            inventory.c.quantity >= needed))
+                                .values(quantity=func.round(inventory.c.quantity - needed, QUANTITY_PLACES)))
+    return used, result.rowcount
+
+@event.listens_for(SignallingSession, 'before_flush')
+def collect_measured_recipes(session, flush_context, instances):
+    """
+    Record the Recipes whose instructions or Ingredients change in this flush.
+    Rows of deleted Recipes and Ingredients are removed before the rows they reference.
+    """
+    recipes = session.info.setdefault('measured_recipes', set())
+    recipes.update(get_relinked_recipes(session))
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Recipe):
+            if instance in session.deleted:
+                if instance.id is not None:
+                    session.execute(recipe_measurements.delete().where(recipe_measurements.c.recipe_id == instance.id))
+            elif instance in session.new or inspect(instance).attrs['instructions'].history.has_changes():
+                recipes.add(instance)
+        elif isinstance(instance, Ingredients) and instance in session.deleted and instance.id is not None:
+            session.execute(recipe_measurements.delete().where(recipe_measurements.c.ingredient_id == instance.id))
+
+@event.listens_for(SignallingSession, 'after_flush')
+def store_measurements(session, flush_context):
+    """
+    Parse the Recipes collected before the flush, once their Ingredient links are written.
+    """
+    recipes = session.info.pop('measured_recipes', None)
+    recipe_ids = {recipe.id for recipe in recipes or () if recipe.id is not None and recipe not in session.deleted}
+    if(recipe_ids):
+        store(session.connection(), recipe_ids)
+
+@app.cli.command('measurements-import')
+@click.option('--recipe', 'recipe_ids', type=int, multiple=True, help="Only parse the Recipe with this id.")
+def measurements_import_command(recipe_ids):
+    """Parse the instructions of every Recipe into recipe_measurements."""
+    with db.engine.begin() as connection:
+        stored = store(connection, recipe_ids or None)
+        links = select([func.count()]).select_from(recipe_ingredients)
+        if(recipe_ids):
+            links = links.where(recipe_ingredients.c.recipe_id.in_(recipe_ids))
+        linked = connection.execute(links).scalar()
+    click.echo("Stored {} measurements, {} Recipe Ingredients have no amount.".format(stored, linked - stored))
@@ -0,0 +1,270 @@
+# This file provides request and database instrumentation for the SDM
+# backend. Every request records its latency, status code and the number
+# of SQL statements it executed, and the collected metrics are exposed in
+# the Prometheus text format by the /metrics endpoint. Pooled database
+# engines also report how long requests wait for a connection and how
+# close the pool is to being exhausted.
+import logging
+import os
+import threading
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sdm_server import app
+
+# The level of the per-request log, e.g. WARNING to turn it off.
+app.config.setdefault('REQUEST_LOG_LEVEL', os.environ.get('SDM_REQUEST_LOG_LEVEL', 'INFO'))
+
+request_log = logging.getLogger('sdm_server.requests')
+request_log.setLevel(app.config['REQUEST_LOG_LEVEL'])
+# The root logger only shows warnings unless the server configures logging, so
+# the request log has its own handler and does not pass its records on.
+if(not request_log.handlers):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    request_log.addHandler(handler)
+    request_log.propagate = False
+
+# Every metric adds itself to the registry when it is created.
+registry = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+    '''
+    The Metric class is the base of the metric types below. A metric has a
+    name, a help text, and optional label names. Each distinct combination
+    of label values is tracked as its own series. All updates are guarded by
+    a lock, because Flask serves requests from multiple threads.
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.append(self)
+
+    def key(self, labels):
+        """
+        Returns the series key for a set of label values.
+        """
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        """
+        Formats a series key (and any extra label pairs) as a Prometheus label set.
+        """
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if(not pairs):
+            return ''
+        escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+    def samples(self):
+        """
+        Yields the (suffix, labels, value) samples of the metric.
+        """
+        for key, value in sorted(self.series.items()):
+            yield '', self.format_labels(key), value
+
+    def render(self):
+        """
+        Renders the metric in the Prometheus text exposition format.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for suffix, labels, value in self.samples():
+                lines.append('{}{}{} {}'.format(self.name, suffix, labels, value if isinstance(value, int) else repr(float(value))))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    '''
+    A monotonically increasing value, e.g. the number of requests served.
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+class Gauge(Metric):
+    '''
+    A value that can go up and down, e.g. the number of in-flight requests.
+    '''
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[self.key(labels)] = value
+
+class Histogram(Metric):
+    '''
+    A distribution of observed values counted into cumulative buckets,
+    e.g. request latencies in seconds.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, observations, total = self.series.get(key, ([0] * len(self.buckets), 0, 0.0))
+            for i, bound in enumerate(self.buckets):
+                if(value <= bound):
+                    counts[i] += 1
+            self.series[key] = (counts, observations + 1, total + value)
+
+    def samples(self):
+        for key, (counts, observations, total) in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', self.format_labels(key, [('le', repr(float(bound)))]), count
+            # Every observation falls into the +Inf bucket, which therefore equals _count.
+            yield '_bucket', self.format_labels(key, [('le', '+Inf')]), observations
+            yield '_sum', self.format_labels(key), total
+            yield '_count', self.format_labels(key), observations
+
+REQUEST_LATENCY = Histogram('sdm_request_duration_seconds', 'Request latency in seconds.', ['method', 'route'])
+REQUESTS = Counter('sdm_requests_total', 'Requests served.', ['method', 'route', 'status'])
+IN_FLIGHT = Gauge('sdm_requests_in_flight', 'Requests currently being served.')
+DB_QUERIES = Counter('sdm_db_queries_total', 'SQL statements executed.', ['route'])
+DB_TIME = Counter('sdm_db_query_seconds_total', 'Time spent executing SQL statements, in seconds.', ['route'])
+REQUEST_QUERIES = Histogram('sdm_request_db_queries', 'SQL statements executed per request.', ['route'],
+                            buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+POOL_WAIT = Histogram('sdm_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled database connection, in seconds.',
+                      ['database'], buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0))
+POOL_TIMEOUTS = Counter('sdm_db_pool_checkout_timeouts_total', 'Checkouts that gave up waiting for a pooled connection.', ['database'])
+POOL_CHECKED_OUT = Gauge('sdm_db_pool_checked_out', 'Pooled database connections currently in use.', ['database'])
+POOL_CAPACITY = Gauge('sdm_db_pool_capacity', 'Maximum number of pooled database connections (pool size plus overflow).', ['database'])
+POOL_SATURATION = Gauge('sdm_db_pool_saturation', 'Fraction of the pool capacity currently in use.', ['database'])
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    A QueuePool that records the time spent waiting for each connection and
+    the number of connections in use. A saturation that stays near 1 with
+    growing checkout waits means there are more workers than connections.
+    '''
+    metrics_name = ''
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc(database=self.metrics_name)
+            raise
+        POOL_WAIT.observe(time.perf_counter() - start, database=self.metrics_name)
+        self.record_usage()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self.record_usage()
+
+    def record_usage(self):
+        capacity = self.size() + max(self._max_overflow, 0)
+        checked_out = self.checkedout()
+        POOL_CHECKED_OUT.set(checked_out, database=self.metrics_name)
+        POOL_CAPACITY.set(capacity, database=self.metrics_name)
+        POOL_SATURATION.set(checked_out / capacity if capacity else 0.0, database=self.metrics_name)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_name = self.metrics_name
+        # QueuePool.recreate does not pass on pool_pre_ping.
+        pool._pre_ping = self._pre_ping
+        return pool
+
+def render_metrics():
+    """
+    Renders every registered metric in the Prometheus text exposition format.
+    Returns
+    -------
+    metrics : str
+        The metrics document served by /metrics.
+    """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+def current_route():
+    """
+    Returns the route pattern of the current request, e.g. '/api/all-recipes'.
+    The pattern is used instead of the path so that URL parameters do not
+    create a new series per value.
+    """
+    if(request.url_rule is not None):
+        return request.url_rule.rule
+    return 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+    IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('metrics_start', None)
+    if(start is None):
+        return response
+    elapsed = time.perf_counter() - start
+    route = current_route()
+    REQUEST_LATENCY.observe(elapsed, method=request.method, route=route)
+    REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    REQUEST_QUERIES.observe(g.query_count, route=route)
+    # The per-request query count makes N+1 query patterns visible in the logs.
+    request_log.info("%s %s %s %.1fms queries=%d db=%.1fms", request.method, request.path, response.status_code,
+                     elapsed * 1000, g.query_count, g.query_time * 1000)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    IN_FLIGHT.dec()
+    # after_request is skipped when the endpoint raised an exception.
+    if(g.pop('metrics_start', None) is not None):
+        REQUESTS.inc(method=request.method, route=current_route(), status=500)
+
+# The start times are keyed by the execution context of the statement, so that a statement
+# that fails, and never reaches after_cursor_execute, can drop its own entry in handle_error.
+# Statements that SQLAlchemy runs without a context, e.g. for column defaults, are keyed by
+# their cursor.
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', {})[context if context is not None else cursor] = time.perf_counter()
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+    conn = exception_context.connection
+    if(conn is not None):
+        for key in (exception_context.execution_context, exception_context.cursor):
+            if(key is not None):
+                conn.info.get('query_start', {}).pop(key, None)
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query_metrics(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop(context if context is not None else cursor)
+    if(has_request_context() and 'query_count' in g):
+        g.query_count += 1
+        g.query_time += elapsed
+        route = current_route()
+    else:
+        route = 'background'
+    DB_QUERIES.inc(route=route)
+    DB_TIME.inc(elapsed, route=route)
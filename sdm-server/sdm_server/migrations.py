@@ -0,0 +1,478 @@
+# This file provides versioned schema migrations for existing SDM databases.
+# A database created from scratch with db.create_all() already has the
+# current schema and is stamped with the latest version. A database created
+# before migrations existed starts at version 0 and is upgraded step by step.
+# Migrations are written in plain SQL that SQLite and MySQL both accept, and
+# do not depend on the current models, so they keep working as models change.
+# The name normalization and MinHash signatures that migrations compute are
+# copied into this file, with the hash parameters pinned to the ones the
+# migration was written for. The one exception is the recipe_measurements
+# table, which holds what the parser of measurements.py reads from the
+# instructions: migration 5 fills it with the current parser, just like
+# 'flask measurements-import', which is rerun whenever the parser changes.
+#
+# Usage (from the sdm-server directory):
+#     FLASK_APP=sdm_server flask db-upgrade
+#     FLASK_APP=sdm_server flask db-version
+#     FLASK_APP=sdm_server flask db-explain
+import random
+import struct
+import sys
+import click
+from sqlalchemy import text
+from sdm_server import app, db
+from sdm_server.models import *
+
+#schema_version holds a single row with the version of the last applied migration.
+schema_version = db.Table('schema_version', db.Column('version', db.Integer, nullable=False))
+
+# The MinHash parameters of the signatures written by migration 6. Databases that use other
+# SIMILARITY_HASHES or SIMILARITY_SEED settings run 'flask similarity-rebuild' after it.
+SIGNATURE_HASHES = 64
+SIGNATURE_SEED = 1
+SIGNATURE_PRIME = (1 << 31) - 1
+
+# The registered migrations, in order. Version N is reached by applying the
+# first N migrations.
+MIGRATIONS = []
+
+def migration(description):
+    """
+    This function serves as a decorator that registers a migration. The
+    decorated function receives a Connection with an open transaction.
+    Parameters
+    ----------
+    description : str
+        A short description of the schema change, shown when it is applied.
+    """
+    def register(f):
+        f.description = description
+        MIGRATIONS.append(f)
+        return f
+    return register
+
+def has_table(connection, name):
+    """
+    Checks if the database contains a table.
+    """
+    return connection.dialect.has_table(connection, name)
+
+def rebuild_association_table(connection, name, left, left_target, right, right_target):
+    """
+    Rebuilds an association table with a composite primary key and an index
+    on the reversed column order. Duplicate rows and rows with a missing side
+    are dropped while the existing rows are copied.
+
+    The new table is created under a temporary name and renamed afterwards,
+    because MySQL requires foreign key names to be unique per database.
+    Parameters
+    ----------
+    connection : Connection
+        The connection to migrate.
+    name : str
+        The name of the association table.
+    left, right : str
+        The two columns, in primary key order.
+    left_target, right_target : str
+        The columns the foreign keys reference, e.g. 'user (id)'.
+    """
+    connection.execute('''
+        CREATE TABLE {name}_new (
+            {left} INTEGER NOT NULL,
+            {right} INTEGER NOT NULL,
+            PRIMARY KEY ({left}, {right}),
+            FOREIGN KEY({left}) REFERENCES {left_target},
+            FOREIGN KEY({right}) REFERENCES {right_target}
+        )'''.format(name=name, left=left, right=right, left_target=left_target, right_target=right_target))
+    connection.execute('''
+        INSERT INTO {name}_new ({left}, {right})
+        SELECT DISTINCT {left}, {right} FROM {name}
+        WHERE {left} IS NOT NULL AND {right} IS NOT NULL'''.format(name=name, left=left, right=right))
+    connection.execute('DROP TABLE {}'.format(name))
+    connection.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(name))
+    connection.execute('CREATE INDEX ix_{0}_{2}_{1} ON {0} ({2}, {1})'.format(name, left, right))
+
+@migration("Create the data_version table")
+def create_data_version(connection):
+    if not has_table(connection, 'data_version'):
+        connection.execute('''
+            CREATE TABLE data_version (
+                name VARCHAR(50) NOT NULL,
+                version INTEGER NOT NULL,
+                updated_at DATETIME NOT NULL,
+                PRIMARY KEY (name)
+            )''')
+
+@migration("Add keys and indexes to the association tables and index custom ingredient names")
+def index_association_tables(connection):
+    rebuild_association_table(connection, 'recipe_ingredients', 'recipe_id', 'recipe (id)', 'ingredient_id', 'ingredients (id)')
+    rebuild_association_table(connection, 'user_ingredients', 'user_id', 'user (id)', 'ingredient_id', 'ingredients (id)')
+    rebuild_association_table(connection, 'custom_user_ingredients', 'user_id', 'user (id)', 'ingredient_id', 'custom_ingredients (id)')
+    connection.execute('CREATE INDEX ix_custom_ingredients_name ON custom_ingredients (name)')
+
+@migration("Add the denormalized ingredient_count to recipe")
+def add_recipe_ingredient_count(connection):
+    connection.execute('ALTER TABLE recipe ADD COLUMN ingredient_count INTEGER NOT NULL DEFAULT 0')
+    connection.execute('''
+        UPDATE recipe SET ingredient_count = (
+            SELECT COUNT(*) FROM recipe_ingredients WHERE recipe_ingredients.recipe_id = recipe.id
+        )''')
+
+@migration("Create and fill the materialized user_recipe_match table")
+def create_user_recipe_match(connection):
+    connection.execute('''
+        CREATE TABLE user_recipe_match (
+            user_id INTEGER NOT NULL,
+            recipe_id INTEGER NOT NULL,
+            matched_count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, recipe_id),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(recipe_id) REFERENCES recipe (id)
+        )''')
+    connection.execute('''
+        INSERT INTO user_recipe_match (user_id, recipe_id, matched_count)
+        SELECT user_ingredients.user_id, recipe_ingredients.recipe_id, COUNT(*)
+        FROM recipe_ingredients JOIN user_ingredients ON user_ingredients.ingredient_id = recipe_ingredients.ingredient_id
+        GROUP BY user_ingredients.user_id, recipe_ingredients.recipe_id''')
+
+@migration("Create the recipe_measurements table and parse the instructions of every Recipe")
+def create_recipe_measurements(connection):
+    from sdm_server.measurements import parse_instructions
+    connection.execute('''
+        CREATE TABLE recipe_measurements (
+            recipe_id INTEGER NOT NULL,
+            ingredient_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            unit VARCHAR(10) NOT NULL,
+            PRIMARY KEY (recipe_id, ingredient_id),
+            FOREIGN KEY(recipe_id) REFERENCES recipe (id),
+            FOREIGN KEY(ingredient_id) REFERENCES ingredients (id)
+        )''')
+    ingredients = {}
+    for recipe_id, ingredient_id, name in connection.execute('''
+            SELECT recipe_ingredients.recipe_id, ingredients.id, ingredients.name
+            FROM recipe_ingredients JOIN ingredients ON ingredients.id = recipe_ingredients.ingredient_id'''):
+        ingredients.setdefault(recipe_id, {})[ingredient_id] = name
+    rows = []
+    for recipe_id, instructions in connection.execute('SELECT id, instructions FROM recipe'):
+        for ingredient_id, (amount, unit) in parse_instructions(instructions, ingredients.get(recipe_id, {})).items():
+            rows.append({'recipe_id': recipe_id, 'ingredient_id': ingredient_id, 'amount': amount, 'unit': unit})
+    if rows:
+        connection.execute(text('''
+            INSERT INTO recipe_measurements (recipe_id, ingredient_id, amount, unit)
+            VALUES (:recipe_id, :ingredient_id, :amount, :unit)'''), rows)
+
+@migration("Create the recipe_signatures table and compute the signature of every Recipe")
+def create_recipe_signatures(connection):
+    connection.execute('''
+        CREATE TABLE recipe_signatures (
+            recipe_id INTEGER NOT NULL,
+            signature BLOB NOT NULL,
+            PRIMARY KEY (recipe_id),
+            FOREIGN KEY(recipe_id) REFERENCES recipe (id)
+        )''')
+    ingredients = {}
+    for recipe_id, ingredient_id in connection.execute('SELECT recipe_id, ingredient_id FROM recipe_ingredients'):
+        ingredients.setdefault(recipe_id, []).append(ingredient_id)
+    rng = random.Random(SIGNATURE_SEED)
+    coefficients = [(rng.randrange(1, SIGNATURE_PRIME), rng.randrange(0, SIGNATURE_PRIME)) for _ in range(SIGNATURE_HASHES)]
+    rows = []
+    for recipe_id, ingredient_ids in ingredients.items():
+        values = [min((a * x + b) % SIGNATURE_PRIME for x in ingredient_ids) for a, b in coefficients]
+        rows.append({'recipe_id': recipe_id, 'signature': struct.pack('<{}I'.format(len(values)), *values)})
+    if rows:
+        connection.execute(text('''
+            INSERT INTO recipe_signatures (recipe_id, signature) VALUES (:recipe_id, :signature)'''), rows)
+
+@migration("Normalize ingredient names and count matching custom ingredients in user_recipe_match")
+def normalize_ingredient_names(connection):
+    # Names are lowercased with their whitespace collapsed, like models.normalize_name did when this was written.
+    normalize_name = lambda name: ' '.join(name.split()).lower()
+    # Ingredient names are unique, so a name is only normalized if no other Ingredient has the result.
+    names = [name for (name,) in connection.execute('SELECT name FROM ingredients')]
+    taken = set(names)
+    for name in names:
+        normalized = normalize_name(name)
+        if normalized != name and normalized not in taken:
+            connection.execute(text('UPDATE ingredients SET name = :normalized WHERE name = :name'),
+                               normalized=normalized, name=name)
+            taken.add(normalized)
+    for (name,) in connection.execute('SELECT DISTINCT name FROM custom_ingredients').fetchall():
+        if normalize_name(name) != name:
+            connection.execute(text('UPDATE custom_ingredients SET name = :normalized WHERE name = :name'),
+                               normalized=normalize_name(name), name=name)
+    # Recount the Users with a Custom Ingredient named like an Ingredient, counting every Ingredient once.
+    resolved = '''
+        SELECT custom_user_ingredients.user_id, ingredients.id AS ingredient_id
+        FROM custom_user_ingredients
+        JOIN custom_ingredients ON custom_ingredients.id = custom_user_ingredients.ingredient_id
+        JOIN ingredients ON ingredients.name = custom_ingredients.name'''
+    connection.execute('''
+        DELETE FROM user_recipe_match WHERE user_id IN (SELECT user_id FROM ({}) AS resolved)'''.format(resolved))
+    connection.execute('''
+        INSERT INTO user_recipe_match (user_id, recipe_id, matched_count)
+        SELECT cabinet.user_id, recipe_ingredients.recipe_id, COUNT(*)
+        FROM recipe_ingredients JOIN (
+            SELECT user_id, ingredient_id FROM user_ingredients UNION {0}
+        ) AS cabinet ON cabinet.ingredient_id = recipe_ingredients.ingredient_id
+        WHERE cabinet.user_id IN (SELECT user_id FROM ({0}) AS resolved)
+        GROUP BY cabinet.user_id, recipe_ingredients.recipe_id'''.format(resolved))
+
+@migration("Intern custom ingredients and move quantities and favorites to custom_user_ingredients")
+def intern_custom_ingredients(connection):
+    # Every name keeps the row with the smallest id, and the links of the other rows move to it.
+    # A User that had several rows of the same name keeps one entry, with the largest quantity
+    # and marked as favorite if any of them was.
+    canonical = '''
+        SELECT custom_ingredients.id AS id, kept.id AS kept_id
+        FROM custom_ingredients JOIN (
+            SELECT name, MIN(id) AS id FROM custom_ingredients GROUP BY name
+        ) AS kept ON kept.name = custom_ingredients.name'''
+    connection.execute('''
+        CREATE TABLE custom_ingredients_new (
+            id INTEGER NOT NULL,
+            name VARCHAR(50) NOT NULL,
+            ingredient_type VARCHAR(50) NOT NULL,
+            PRIMARY KEY (id)
+        )''')
+    connection.execute('''
+        INSERT INTO custom_ingredients_new (id, name, ingredient_type)
+        SELECT id, name, ingredient_type FROM custom_ingredients
+        WHERE id IN (SELECT MIN(id) FROM custom_ingredients GROUP BY name)''')
+    connection.execute('''
+        CREATE TABLE custom_user_ingredients_new (
+            user_id INTEGER NOT NULL,
+            ingredient_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            favorite BOOLEAN NOT NULL,
+            PRIMARY KEY (user_id, ingredient_id),
+            FOREIGN KEY(user_id) REFERENCES user (id),
+            FOREIGN KEY(ingredient_id) REFERENCES custom_ingredients_new (id)
+        )''')
+    connection.execute('''
+        INSERT INTO custom_user_ingredients_new (user_id, ingredient_id, quantity, favorite)
+        SELECT custom_user_ingredients.user_id, canonical.kept_id,
+               MAX(custom_ingredients.quantity), MAX(custom_ingredients.is_favorite)
+        FROM custom_user_ingredients
+        JOIN custom_ingredients ON custom_ingredients.id = custom_user_ingredients.ingredient_id
+        JOIN ({}) AS canonical ON canonical.id = custom_user_ingredients.ingredient_id
+        GROUP BY custom_user_ingredients.user_id, canonical.kept_id'''.format(canonical))
+    connection.execute('DROP TABLE custom_user_ingredients')
+    connection.execute('DROP TABLE custom_ingredients')
+    connection.execute('ALTER TABLE custom_ingredients_new RENAME TO custom_ingredients')
+    connection.execute('ALTER TABLE custom_user_ingredients_new RENAME TO custom_user_ingredients')
+    connection.execute('CREATE UNIQUE INDEX ix_custom_ingredients_name ON custom_ingredients (name)')
+    connection.execute('CREATE INDEX ix_custom_user_ingredients_ingredient_id_user_id '
+                       'ON custom_user_ingredients (ingredient_id, user_id)')
+
+@migration("Create ingredient_keys and link recipes to the keys of ingredients and custom ingredients")
+def create_ingredient_keys(connection):
+    # Ingredients keep their ids as keys, and every Custom Ingredient without an Ingredient of its name
+    # gets a new key. The foreign key from ingredients.id to its key is left out, because ingredients is
+    # referenced by user_ingredients and cannot be rebuilt on MySQL.
+    connection.execute('''
+        CREATE TABLE ingredient_keys (
+            id INTEGER NOT NULL{},
+            name VARCHAR(50) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (name)
+        )'''.format(' AUTO_INCREMENT' if connection.dialect.name == 'mysql' else ''))
+    connection.execute('INSERT INTO ingredient_keys (id, name) SELECT id, name FROM ingredients')
+    connection.execute('''
+        INSERT INTO ingredient_keys (name)
+        SELECT name FROM custom_ingredients WHERE name NOT IN (SELECT name FROM ingredients)''')
+    connection.execute('ALTER TABLE custom_ingredients ADD COLUMN key_id INTEGER REFERENCES ingredient_keys (id)')
+    connection.execute('''
+        UPDATE custom_ingredients SET key_id = (
+            SELECT ingredient_keys.id FROM ingredient_keys WHERE ingredient_keys.name = custom_ingredients.name
+        )''')
+    connection.execute('CREATE INDEX ix_custom_ingredients_key_id ON custom_ingredients (key_id)')
+    rebuild_association_table(connection, 'recipe_ingredients', 'recipe_id', 'recipe (id)', 'ingredient_id', 'ingredient_keys (id)')
+    connection.execute('''
+        CREATE TABLE recipe_measurements_new (
+            recipe_id INTEGER NOT NULL,
+            ingredient_id INTEGER NOT NULL,
+            amount FLOAT NOT NULL,
+            unit VARCHAR(10) NOT NULL,
+            PRIMARY KEY (recipe_id, ingredient_id),
+            FOREIGN KEY(recipe_id) REFERENCES recipe (id),
+            FOREIGN KEY(ingredient_id) REFERENCES ingredient_keys (id)
+        )''')
+    connection.execute('''
+        INSERT INTO recipe_measurements_new (recipe_id, ingredient_id, amount, unit)
+        SELECT recipe_id, ingredient_id, amount, unit FROM recipe_measurements''')
+    connection.execute('DROP TABLE recipe_measurements')
+    connection.execute('ALTER TABLE recipe_measurements_new RENAME TO recipe_measurements')
+
+@migration("Store inventory quantities as decimals and round measured amounts to 4 places")
+def decimal_inventory_quantities(connection):
+    # The measured amounts are rounded like measurements.QUANTITY_PLACES did when this was written.
+    connection.execute('UPDATE recipe_measurements SET amount = ROUND(amount, 4)')
+    if not has_table(connection, 'inventory'):
+        return
+    if connection.dialect.name == 'mysql':
+        connection.execute('ALTER TABLE inventory MODIFY quantity NUMERIC(12, 4) NOT NULL')
+        return
+    # SQLite can not change the type of a column, so the table is copied.
+    connection.execute('''
+        CREATE TABLE inventory_new (
+            user INTEGER NOT NULL,
+            ingredient INTEGER NOT NULL,
+            quantity NUMERIC(12, 4) NOT NULL,
+            favorite BOOLEAN NOT NULL,
+            PRIMARY KEY (user, ingredient),
+            FOREIGN KEY(user) REFERENCES user (id),
+            FOREIGN KEY(ingredient) REFERENCES ingredients (id)
+        )''')
+    connection.execute('''
+        INSERT INTO inventory_new (user, ingredient, quantity, favorite)
+        SELECT user, ingredient, quantity, favorite FROM inventory''')
+    connection.execute('DROP TABLE inventory')
+    connection.execute('ALTER TABLE inventory_new RENAME TO inventory')
+
+def head():
+    """
+    Returns the version reached by applying every migration.
+    """
+    return len(MIGRATIONS)
+
+def get_version(connection):
+    """
+    Returns the schema version of a database, or None if it is not stamped.
+    """
+    if not has_table(connection, 'schema_version'):
+        return None
+    return connection.execute(schema_version.select()).scalar()
+
+def stamp(connection, version):
+    """
+    Records the schema version of a database without running migrations.
+    """
+    schema_version.create(connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert(), version=version)
+
+def upgrade(connection, target=None, echo=None):
+    """
+    Brings a database up to a schema version.
+
+    An empty database is created from the models and stamped with the
+    latest version. A database without a schema version predates the
+    migrations and is treated as version 0. Every migration runs in its own
+    transaction together with the update of the schema version.
+    Parameters
+    ----------
+    connection : Connection
+        The connection of the database to upgrade.
+    target : int
+        The version to upgrade to. Defaults to the latest version.
+    echo : function
+        An optional function that is called with a progress message per migration.
+    Returns
+    -------
+    version : int
+        The schema version after the upgrade.
+    """
+    target = head() if target is None else target
+    version = get_version(connection)
+    if version is None:
+        if not has_table(connection, 'user'):
+            with connection.begin():
+                db.metadata.create_all(connection)
+                stamp(connection, head())
+            return head()
+        version = 0
+    for number in range(version + 1, target + 1):
+        step = MIGRATIONS[number - 1]
+        if echo:
+            echo("Applying migration {}: {}".format(number, step.description))
+        with connection.begin():
+            step(connection)
+            stamp(connection, number)
+    return max(version, target)
+
+# The queries issued on hot paths in validators.py, with representative parameters.
+# Each one must be answered through an index instead of a full table scan.
+HOT_QUERIES = {
+    'cabinet ingredient ids': lambda: db.session.query(user_ingredients.c.ingredient_id)
+                                        .filter(user_ingredients.c.user_id == 1),
+    'owners of an ingredient': lambda: db.session.query(user_ingredients.c.user_id)
+                                         .filter(user_ingredients.c.ingredient_id == 1),
+    'ingredients of a recipe': lambda: db.session.query(recipe_ingredients.c.ingredient_id)
+                                         .filter(recipe_ingredients.c.recipe_id == 1),
+    'recipes using an ingredient': lambda: db.session.query(recipe_ingredients.c.recipe_id)
+                                             .filter(recipe_ingredients.c.ingredient_id == 1),
+    'recipe matches of a user': lambda: db.session.query(user_recipe_match.c.recipe_id)
+                                          .filter(user_recipe_match.c.user_id == 1),
+    'ingredient by name': lambda: Ingredients.query.filter(Ingredients.name == 'apple'),
+    'inventory entry': lambda: Inventory.query.filter(Inventory.user == 1, Inventory.ingredient == 1),
+    'custom ingredient of a user by name': lambda: Custom_Ingredients.query
+                                                       .join(custom_user_ingredients, custom_user_ingredients.c.ingredient_id == Custom_Ingredients.id)
+                                                       .filter(custom_user_ingredients.c.user_id == 1, Custom_Ingredients.name == 'oat milk'),
+    'custom ingredients by name': lambda: Custom_Ingredients.query.filter(Custom_Ingredients.name == 'oat milk'),
+    'custom cabinet keys of a user': lambda: db.session.query(custom_cabinet_keys([1]).alias('custom')),
+}
+
+def explain(connection, query):
+    """
+    Returns the query plan of a query and whether every table is read through an index.
+    Parameters
+    ----------
+    connection : Connection
+        The connection of the database to explain the query on.
+    query : Query
+        The ORM query to explain.
+    Returns
+    -------
+    result : tuple
+        A (plan, uses_indexes) tuple, where plan is a List of plan lines.
+    """
+    sql = str(query.statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'sqlite':
+        plan = [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql)]
+        # SQLite reports full table scans as 'SCAN <table>' and index lookups as 'SEARCH ...'.
+        uses_indexes = not any(line.startswith('SCAN') and 'INDEX' not in line for line in plan)
+    else:
+        rows = [dict(row) for row in connection.execute('EXPLAIN ' + sql)]
+        plan = ['{} type={} key={}'.format(row.get('table'), row.get('type'), row.get('key')) for row in rows]
+        uses_indexes = all(row.get('key') for row in rows)
+    return plan, uses_indexes
+
+def check_query_plans(connection):
+    """
+    Explains every query in HOT_QUERIES.
+    Returns
+    -------
+    results : dict
+        A Dictionary mapping each query name to its (plan, uses_indexes) tuple.
+    """
+    return {name: explain(connection, query()) for name, query in HOT_QUERIES.items()}
+
+@app.cli.command('db-upgrade')
+@click.option('--target', type=int, default=None, help="The schema version to upgrade to.")
+def db_upgrade_command(target):
+    """Upgrade the database schema to the latest version."""
+    with db.engine.connect() as connection:
+        version = upgrade(connection, target, echo=click.echo)
+    click.echo("Database schema is at version {}.".format(version))
+
+@app.cli.command('db-version')
+def db_version_command():
+    """Show the schema version of the database."""
+    with db.engine.connect() as connection:
+        version = get_version(connection)
+    click.echo("Database schema is at version {}, the latest version is {}.".format(
+        'unknown (0)' if version is None else version, head()))
+
+@app.cli.command('db-explain')
+def db_explain_command():
+    """Check that the hot queries in validators.py use indexes."""
+    failed = False
+    with db.engine.connect() as connection:
+        for name, (plan, uses_indexes) in check_query_plans(connection).items():
+            failed = failed or not uses_indexes
+            click.echo("{} {}".format('OK  ' if uses_indexes else 'SCAN', name))
+            for line in plan:
+                click.echo("       " + line)
+    if failed:
+        sys.exit(1)
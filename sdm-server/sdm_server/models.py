@@ -3,6 +3,18 @@
 # and each class member represents a field in that database table.
 from sdm_server import db, app
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect, select, func
+from datetime import datetime
+
+def normalize_name(name):
+    """
+    Returns the normalized form of an Ingredient or Custom Ingredient name:
+    lowercase, with surrounding whitespace removed and inner whitespace
+    collapsed. Names are stored normalized, so that identically named
+    Ingredients and Custom Ingredients compare equal.
+    """
+    return ' '.join(name.split()).lower()
 
 class User(db.Model):
     '''
@@ -24,6 +36,13 @@ class User(db.Model):
     quantities : QueryObject, The quantities of an Ingredient and favorite status of an
     Ingredient. This column is implicitly generated by SQLAlchemy to setup the
     User -> Inventory -> Ingredient relationship.
+
+    custom_quantities : QueryObject, The Custom Ingredients of the User with their quantity
+    and favorite status. This column is implicitly generated by SQLAlchemy to setup the
+    User -> Custom_Inventory -> Custom_Ingredients relationship.
+
+    custom_ingredients : QueryObject, The Custom Ingredients of the User. It is read-only,
+    Custom Ingredients are added to and removed from Users through custom_quantities.
     '''
     id = db.Column(db.Integer, primary_key=True)
     user_uuid = db.Column(db.String(50), unique=True, nullable=False)
@@ -31,6 +50,8 @@ class User(db.Model):
     password = db.Column(db.String(80), nullable=False)
     email = db.Column(db.String(50), unique=True, nullable=False)
     quantities = db.relationship("Inventory", lazy="dynamic")
+    custom_quantities = db.relationship("Custom_Inventory", lazy="dynamic")
+    custom_ingredients = db.relationship("Custom_Ingredients", secondary='custom_user_ingredients', lazy="dynamic", viewonly=True)
 
     def get_reset_token(self, expires=1800):
         """
@@ -81,23 +102,52 @@ class User(db.Model):
             return None
         return User.query.filter_by(user_uuid=uuid).first()
 
-#recipe_ingredients is an intermediary table that tracks relationships between Ingredient and Recipe.
-#It is automatically populated and should not be directly modified.
+#ingredient_keys holds one key per normalized ingredient name. An Ingredient uses the key of its name as its
+#id, and a Custom Ingredient refers to the key of its name, so identically named Ingredients and Custom
+#Ingredients share one key. Recipes link to keys, and are matched against the keys of a cabinet (see cabinet_keys).
+#Keys are created by assign_ingredient_keys and should not be directly modified.
+ingredient_keys = db.Table('ingredient_keys',
+                  db.Column('id', db.Integer, primary_key=True),
+                  db.Column('name', db.String(50), unique=True, nullable=False))
+
+#recipe_ingredients is an intermediary table that tracks relationships between Recipes and ingredient keys,
+#i.e. Ingredients and Custom Ingredients. It is automatically populated and should not be directly modified.
+#The composite primary key prevents duplicate rows and serves lookups by Recipe; the second index serves
+#lookups by Ingredient.
 recipe_ingredients = db.Table('recipe_ingredients',
-                     db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id')),
-                     db.Column('ingredient_id', db.Integer, db.ForeignKey('ingredients.id')))
+                     db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id'), primary_key=True),
+                     db.Column('ingredient_id', db.Integer, db.ForeignKey('ingredient_keys.id'), primary_key=True),
+                     db.Index('ix_recipe_ingredients_ingredient_id_recipe_id', 'ingredient_id', 'recipe_id'))
 
 #user_ingredients is an intermediary table that tracks relationships between Ingredient and User.
-#It is automaticallly populated and should not be directly modified.
+#It is automaticallly populated and should not be directly modified. It is indexed in both column orders.
 user_ingredients = db.Table('user_ingredients',
-                   db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-                   db.Column('ingredient_id', db.Integer, db.ForeignKey('ingredients.id')))
-
-#custom_user_ingredients is an intermediary table that tracks relationships between Custom_Ingredients and
-#User. It is automatically populated and should not be directly modified.
-custom_user_ingredients = db.Table('custom_user_ingredients',
-                   db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
-                   db.Column('ingredient_id', db.Integer, db.ForeignKey('custom_ingredients.id')))
+                   db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                   db.Column('ingredient_id', db.Integer, db.ForeignKey('ingredients.id'), primary_key=True),
+                   db.Index('ix_user_ingredients_ingredient_id_user_id', 'ingredient_id', 'user_id'))
+
+#user_recipe_match is a materialized table that stores, for every User and Recipe that share at least one
+#Ingredient, how many of the Recipe's Ingredients are in the User's cabinet. It is maintained incrementally
+#by matches.py and should not be directly modified. The primary key serves the listings of a User.
+user_recipe_match = db.Table('user_recipe_match',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id'), primary_key=True),
+                    db.Column('matched_count', db.Integer, nullable=False))
+
+#recipe_measurements stores the amount of every Ingredient of a Recipe, parsed from the Recipe's instructions
+#by measurements.py when the Recipe is created or changed. Amounts are normalized to cups for volumes and to
+#pieces for everything else, the unit column records which one applies.
+recipe_measurements = db.Table('recipe_measurements',
+                      db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id'), primary_key=True),
+                      db.Column('ingredient_id', db.Integer, db.ForeignKey('ingredient_keys.id'), primary_key=True),
+                      db.Column('amount', db.Float, nullable=False),
+                      db.Column('unit', db.String(10), nullable=False))
+
+#recipe_signatures stores the MinHash signature of the Ingredients of every Recipe, computed by similarity.py
+#when the Recipe's Ingredients change. The signature is packed into 4 bytes per hash function.
+recipe_signatures = db.Table('recipe_signatures',
+                    db.Column('recipe_id', db.Integer, db.ForeignKey('recipe.id'), primary_key=True),
+                    db.Column('signature', db.LargeBinary, nullable=False))
 
 
 class Recipe (db.Model):
@@ -113,6 +163,10 @@ class Recipe (db.Model):
 
     instructions : Text, The instructions that document how the Recipe is made.
 
+    ingredient_count : Integer, The number of Ingredients the Recipe requires. This
+    field is kept up to date whenever the Recipe's Ingredients change through the
+    session and does not need to be manually set.
+
     ingredients : QueryObject, The Ingredients that the Recipe requires. This
     column is implicitly generated by SQLAlchemy to setup the Recipe -> Ingredients
     relationship.
@@ -120,6 +174,77 @@ class Recipe (db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     instructions = db.Column(db.Text, nullable=False)
+    ingredient_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @staticmethod
+    def fully_matched_ids(user_id):
+        """
+        Select the ids of the Recipes whose Ingredients are all in a User's cabinet.
+
+        The Recipe's Ingredients that are in the cabinet, including the ones
+        resolved from Custom Ingredients (see cabinet_keys), are counted per
+        Recipe, and only Recipes where that count equals ingredient_count are kept.
+        Recipes without Ingredients match every cabinet.
+
+        Parameters
+        ----------
+        user_id : int
+            The primary key of the User.
+
+        Returns
+        -------
+        Select
+            A select of a single recipe id column, usable as a subquery.
+        """
+        cabinet = cabinet_keys([user_id]).alias('cabinet')
+        matched = select([Recipe.id]) \
+            .select_from(Recipe.__table__
+                         .join(recipe_ingredients, recipe_ingredients.c.recipe_id == Recipe.id)
+                         .join(cabinet, cabinet.c.ingredient_id == recipe_ingredients.c.ingredient_id)) \
+            .group_by(Recipe.id, Recipe.ingredient_count) \
+            .having(func.count() == Recipe.ingredient_count)
+        return matched.union(select([Recipe.id]).where(Recipe.ingredient_count == 0))
+
+    @staticmethod
+    def partially_matched_ids(user_id):
+        """
+        Select the ids of the Recipes with at least one Ingredient in a User's cabinet.
+
+        Parameters
+        ----------
+        user_id : int
+            The primary key of the User.
+
+        Returns
+        -------
+        Select
+            A select of a single recipe id column, usable as a subquery.
+        """
+        cabinet = cabinet_keys([user_id]).alias('cabinet')
+        return select([recipe_ingredients.c.recipe_id]) \
+            .select_from(recipe_ingredients.join(cabinet, cabinet.c.ingredient_id == recipe_ingredients.c.ingredient_id)) \
+            .distinct()
+
+    @staticmethod
+    def update_ingredient_counts(connection, recipe_ids=None):
+        """
+        Recount the Ingredients of Recipes from the recipe_ingredients table.
+
+        This is done automatically when links are changed through the session.
+        Code that writes recipe_ingredients directly must call it afterwards.
+
+        Parameters
+        ----------
+        connection : Connection or Session
+            Where to execute the update.
+        recipe_ids : iterable
+            The ids of the Recipes to recount. Defaults to every Recipe.
+        """
+        count = select([func.count()]).where(recipe_ingredients.c.recipe_id == Recipe.id).as_scalar()
+        update = Recipe.__table__.update().values(ingredient_count=count)
+        if recipe_ids is not None:
+            update = update.where(Recipe.id.in_(sorted(recipe_ids)))
+        connection.execute(update)
 		
 class Ingredients(db.Model):
     '''
@@ -127,8 +252,8 @@ class Ingredients(db.Model):
     the appropriate database structure to maintain ingredients. The model defines 
     the following schema:
 
-    id : primary_key, This field is automatically set and does not need to be
-    manually set or adjusted.
+    id : primary_key, The key of the Ingredient's name in ingredient_keys. This field is
+    automatically set and does not need to be manually set or adjusted.
         
     name : String(50), The name of an individual ingredient.
 
@@ -138,41 +263,55 @@ class Ingredients(db.Model):
     owned_by : QueryObject, The Users that own this Ingredient. This column is
     implicitly generated by SQLAlchemy to setup the Ingredient -> User relationship.
     '''
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, db.ForeignKey('ingredient_keys.id'), primary_key=True, autoincrement=False)
     name = db.Column(db.String(50), unique=True, nullable=False)
     ingredient_type = db.Column(db.String(50), unique=False, nullable=False)
     quantity = db.Column(db.Integer, unique=False, nullable=False)
     is_favorite = db.Column(db.Boolean, nullable=False, default=False)
-    used_in = db.relationship('Recipe', secondary=recipe_ingredients, backref=db.backref('ingredients', lazy='dynamic'))
+    used_in = db.relationship('Recipe', secondary=recipe_ingredients,
+                              primaryjoin=lambda: Ingredients.id == recipe_ingredients.c.ingredient_id,
+                              secondaryjoin=lambda: Recipe.id == recipe_ingredients.c.recipe_id,
+                              foreign_keys=[recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id],
+                              backref=db.backref('ingredients', lazy='dynamic'))
     owned_by = db.relationship('User', secondary=user_ingredients, backref=db.backref('ingredients', lazy='dynamic'))
 
 class Custom_Ingredients(db.Model):
     '''
     The Custom_Ingredients class defines the ORM model that is translated by SQLAlchemy into
-    the appropriate database structure to maintain custom ingredients. The model defines 
-    the following schema:
+    the appropriate database structure to maintain custom ingredients. Custom Ingredients are
+    interned: every name is stored once and shared by all Users that added it, the quantities
+    and favorites of each User are kept in Custom_Inventory. The model defines the following schema:
 
     id : primary_key, This field is automatically set and does not need to be
     manually set or adjusted.
 
-    name : String(50), The name of an individual ingredient.
+    name : String(50), The name of an individual ingredient, normalized with normalize_name.
+    The name is unique and indexed.
 
-    ingredient_type : String(50), The type of an individual ingredient.
+    key_id : ForeignKey, The key of the name in ingredient_keys, shared with the Ingredient
+    of the same name if there is one. Recipes are matched against it, see cabinet_keys. This
+    field is automatically set and does not need to be manually set or adjusted.
 
-    quantity : Integer, The amount of an individual ingredient.
+    ingredient_type : String(50), The type of an individual ingredient, as given by the
+    first User that added it.
 
-    is_favorite : Boolean, True if the ingredient is a favorite, False otherwise.
+    used_in : QueryObject, The Recipes that use this Custom Ingredient, through its key.
 
-    owned_by : QueryObject, the User that owns this Custom Ingredient. This column is
+    owned_by : QueryObject, the Users that own this Custom Ingredient. This column is
     implicitly generated by SQLAlchemy to setup the Custom_Ingredient -> User relationship.
+    It is read-only, Custom Ingredients are added to and removed from Users through
+    Custom_Inventory.
     '''
     __tablename__ = "custom_ingredients"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), unique=False, nullable=False)
+    name = db.Column(db.String(50), unique=True, nullable=False, index=True)
+    key_id = db.Column(db.Integer, db.ForeignKey('ingredient_keys.id'), nullable=False, index=True)
     ingredient_type = db.Column(db.String(50), unique=False, nullable=False)
-    quantity = db.Column(db.Integer, unique=False, nullable=False)
-    is_favorite = db.Column(db.Boolean, nullable=False, default=False)
-    owned_by = db.relationship('User', secondary=custom_user_ingredients, backref=db.backref('custom_ingredients', lazy='dynamic'))
+    used_in = db.relationship('Recipe', secondary=recipe_ingredients,
+                              primaryjoin=lambda: Custom_Ingredients.key_id == recipe_ingredients.c.ingredient_id,
+                              secondaryjoin=lambda: Recipe.id == recipe_ingredients.c.recipe_id,
+                              foreign_keys=[recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id])
+    owned_by = db.relationship('User', secondary='custom_user_ingredients', viewonly=True)
 
 class Inventory(db.Model):
     '''
@@ -185,7 +324,8 @@ class Inventory(db.Model):
 
     ingredient : ForeignKey, The Ingredient instance that should be associated to a User.
 
-    quantity : Integer, The quantity of the Ingredient instance.
+    quantity : Numeric, The quantity of the Ingredient instance, in the cups or pieces that
+    Recipes measure it in (see measurements.py). It is read as a float.
 
     favorite : Boolean, True if the Ingredient instance is a favorite, False otherwise.
 
@@ -193,6 +333,250 @@ class Inventory(db.Model):
     '''
     user = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
     ingredient = db.Column(db.Integer, db.ForeignKey('ingredients.id'), primary_key=True)
-    quantity = db.Column(db.Integer, unique=False, nullable=False)
+    quantity = db.Column(db.Numeric(12, 4, asdecimal=False), unique=False, nullable=False)
     favorite = db.Column(db.Boolean, unique=False, nullable=False)
-    owned_ingredient = db.relationship("Ingredients")
\ No newline at end of file
+    owned_ingredient = db.relationship("Ingredients")
+
+class Custom_Inventory(db.Model):
+    '''
+    The Custom_Inventory class defines the ORM Model that is used translated by SQLAlchemy into
+    the appropriate database structure to associate Users with the shared Custom Ingredients.
+    Like Inventory, it keeps the quantities and favorites of each User. The table is indexed in
+    both column orders. The following schema is defined:
+
+    user : ForeignKey, The User instance that owns the Custom Ingredient.
+
+    ingredient : ForeignKey, The Custom Ingredient instance that is owned by the User.
+
+    quantity : Integer, The quantity of the Custom Ingredient instance.
+
+    favorite : Boolean, True if the Custom Ingredient instance is a favorite, False otherwise.
+
+    owned_ingredient : QueryObject, The Custom Ingredient instance associated to the User instance.
+    '''
+    __tablename__ = "custom_user_ingredients"
+    __table_args__ = (db.Index('ix_custom_user_ingredients_ingredient_id_user_id', 'ingredient_id', 'user_id'),)
+    user = db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    ingredient = db.Column('ingredient_id', db.Integer, db.ForeignKey('custom_ingredients.id'), primary_key=True)
+    quantity = db.Column(db.Integer, unique=False, nullable=False, default=0)
+    favorite = db.Column(db.Boolean, unique=False, nullable=False, default=False)
+    owned_ingredient = db.relationship("Custom_Ingredients")
+
+#custom_user_ingredients is the table of Custom_Inventory, which associates Users with Custom_Ingredients.
+custom_user_ingredients = Custom_Inventory.__table__
+
+def custom_cabinet_keys(user_ids=None):
+    """
+    Selects the keys of the Custom Ingredients of Users.
+
+    Every normalized name has one key in ingredient_keys, shared by the
+    Ingredient and the Custom Ingredient of that name. Custom Ingredients
+    are interned, so identically named Custom Ingredients of different
+    Users share one key. A Recipe that links to the key of a Custom
+    Ingredient is satisfied by it, whether or not the catalog has an
+    Ingredient of that name, e.g. one added to the catalog later.
+
+    Parameters
+    ----------
+    user_ids : iterable
+        Optionally only select the keys of these Users.
+
+    Returns
+    -------
+    Select
+        A select of (user_id, ingredient_id) rows.
+    """
+    query = select([custom_user_ingredients.c.user_id, Custom_Ingredients.key_id.label('ingredient_id')]) \
+        .select_from(custom_user_ingredients
+                     .join(Custom_Ingredients.__table__, Custom_Ingredients.id == custom_user_ingredients.c.ingredient_id))
+    if user_ids is not None:
+        query = query.where(custom_user_ingredients.c.user_id.in_(sorted(user_ids)))
+    return query
+
+def cabinet_keys(user_ids=None):
+    """
+    Selects the Ingredient keys in the cabinets of Users: the Ingredients in
+    the cabinet and the ones its Custom Ingredients resolve to, each once.
+    Recipes are matched against these keys.
+
+    Parameters
+    ----------
+    user_ids : iterable
+        Optionally only select the keys of these Users.
+
+    Returns
+    -------
+    Select
+        A select of distinct (user_id, ingredient_id) rows, usable as a subquery.
+    """
+    query = select([user_ingredients.c.user_id, user_ingredients.c.ingredient_id])
+    if user_ids is not None:
+        query = query.where(user_ingredients.c.user_id.in_(sorted(user_ids)))
+    return query.union(custom_cabinet_keys(user_ids))
+
+class Data_Version(db.Model):
+    '''
+    The Data_Version class defines the ORM model that is translated by SQLAlchemy into
+    the appropriate database structure to track when cached representations of the data
+    become stale. Every write to a tracked scope increments its version. The model defines
+    the following schema:
+
+    name : primary_key, String(50), The tracked scope. 'catalog' covers Recipes and
+    Ingredients, 'user-<id>' covers the cabinet, inventory and custom ingredients of a User.
+
+    version : Integer, A counter that is incremented on every change to the scope.
+
+    updated_at : DateTime, The UTC time of the last change to the scope.
+    '''
+    __tablename__ = "data_version"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def user_scope(user):
+        """
+        Returns the name of the scope that tracks a User's own data.
+        """
+        return 'user-{}'.format(user.id)
+
+    @staticmethod
+    def touch(name, session=None):
+        """
+        Increment the version of a scope.
+
+        The change is added to the session but not committed, so it is written
+        in the same transaction as the change that caused it.
+
+        Parameters
+        ----------
+        name : str
+            The name of the scope to increment.
+        session : Session
+            An optional session to use instead of db.session.
+        """
+        session = session or db.session
+        data_version = session.query(Data_Version).get(name)
+        if not data_version:
+            data_version = Data_Version(name=name, version=0)
+            session.add(data_version)
+        data_version.version += 1
+        data_version.updated_at = datetime.utcnow()
+
+    @staticmethod
+    def lookup(*names):
+        """
+        Look up the current state of one or more scopes.
+
+        Parameters
+        ----------
+        *names : *args
+            The names of the scopes to look up.
+
+        Returns
+        -------
+        List
+            A List of (version, updated_at) tuples in the order of the passed in names.
+            Scopes that were never written are reported as (0, None).
+        """
+        rows = {row.name: row for row in Data_Version.query.filter(Data_Version.name.in_(names))}
+        return [(rows[name].version, rows[name].updated_at) if name in rows else (0, None) for name in names]
+
+@event.listens_for(SignallingSession, 'before_flush')
+def touch_catalog_version(session, flush_context, instances):
+    """
+    Increment the 'catalog' Data_Version whenever a Recipe or Ingredient is
+    created, deleted, has a column changed or has its Recipe links changed.
+    Adding an Ingredient to a User's cabinet does not change the catalog.
+    """
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Custom_Ingredients):
+            # Custom Ingredients are in the catalog once a Recipe uses them.
+            if inspect(instance).attrs['used_in'].history.has_changes():
+                Data_Version.touch('catalog', session)
+                return
+            continue
+        if not isinstance(instance, (Recipe, Ingredients)):
+            continue
+        links = 'used_in' if isinstance(instance, Ingredients) else 'ingredients'
+        if (instance in session.new or instance in session.deleted
+                or session.is_modified(instance, include_collections=False)
+                or inspect(instance).attrs[links].history.has_changes()):
+            Data_Version.touch('catalog', session)
+            return
+
+def get_relinked_recipes(session):
+    """
+    Returns the Recipes whose Ingredient links change in the pending flush of
+    a session, including the Recipes of deleted Ingredients. Deleted Recipes
+    are not included.
+    """
+    recipes = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Recipe) and instance not in session.deleted:
+            if inspect(instance).attrs['ingredients'].history.has_changes():
+                recipes.add(instance)
+        elif isinstance(instance, (Ingredients, Custom_Ingredients)):
+            history = inspect(instance).attrs['used_in'].history
+            recipes.update(history.added or ())
+            recipes.update(history.deleted or ())
+            if isinstance(instance, Ingredients) and instance in session.deleted:
+                recipes.update(instance.used_in)
+    return {recipe for recipe in recipes if recipe not in session.deleted}
+
+def get_ingredient_key(session, name):
+    """
+    Returns the key of a normalized name in ingredient_keys, creating it if the
+    name has none yet.
+    """
+    key = session.execute(select([ingredient_keys.c.id]).where(ingredient_keys.c.name == name)).scalar()
+    if key is None:
+        key = session.execute(ingredient_keys.insert().values(name=name)).inserted_primary_key[0]
+    return key
+
+@event.listens_for(SignallingSession, 'before_flush')
+def assign_ingredient_keys(session, flush_context, instances):
+    """
+    Give new Ingredients and Custom Ingredients the key of their name. An
+    Ingredient added under the name of a Custom Ingredient takes over its
+    key, so the Recipes and cabinets that use the key keep matching. A
+    renamed Ingredient keeps its id and renames its key, a renamed Custom
+    Ingredient moves to the key of its new name.
+    """
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Ingredients):
+            if instance in session.new and instance.id is None:
+                instance.id = get_ingredient_key(session, instance.name)
+            elif instance not in session.new and inspect(instance).attrs['name'].history.has_changes():
+                session.execute(ingredient_keys.update().where(ingredient_keys.c.id == instance.id).values(name=instance.name))
+        elif isinstance(instance, Custom_Ingredients):
+            if instance in session.new or inspect(instance).attrs['name'].history.has_changes():
+                instance.key_id = get_ingredient_key(session, instance.name)
+
+@event.listens_for(SignallingSession, 'before_flush')
+def collect_recounted_recipes(session, flush_context, instances):
+    """
+    Remember the Recipes whose Ingredient links change in this flush, so that
+    their ingredient_count can be updated once the links are written.
+    """
+    session.info.setdefault('recount_recipes', set()).update(get_relinked_recipes(session))
+
+@event.listens_for(SignallingSession, 'after_flush')
+def recount_recipe_ingredients(session, flush_context):
+    """
+    Update the ingredient_count of the Recipes collected before the flush.
+    """
+    recipes = session.info.pop('recount_recipes', set())
+    recipe_ids = {recipe.id for recipe in recipes if recipe not in session.deleted and recipe.id is not None}
+    if recipe_ids:
+        Recipe.update_ingredient_counts(session.connection(), recipe_ids)
+        session.info.setdefault('recounted_recipes', set()).update(recipe for recipe in recipes if recipe.id in recipe_ids)
+
+@event.listens_for(SignallingSession, 'after_flush_postexec')
+def expire_recounted_recipes(session, flush_context):
+    """
+    Expire the updated ingredient_count. Recipes inserted by the flush are only
+    persistent once it has finished, so this can not be done in after_flush.
+    """
+    for recipe in session.info.pop('recounted_recipes', ()):
+        session.expire(recipe, ['ingredient_count'])
@@ -0,0 +1,228 @@
+# This file resolves the Ingredient names that Users type to Ingredients of
+# the catalog, so that typos, plurals and spacing do not make an Ingredient
+# go missing. A name is resolved in four steps:
+#
+#     - The normalized name (see models.normalize_name) is looked up as is.
+#     - The name is folded: every word is made singular and the spaces are
+#       dropped, so that 'Strawberries' and 'oatmilk' find 'strawberry' and
+#       'oat milk'. The folded name is looked up.
+#     - Every name one edit away (an insertion, deletion or substitution of
+#       a letter, or a swap of adjacent letters) is looked up. Ties go to the
+#       name sharing the most trigrams.
+#     - Longer names may be further away. The names sharing the most
+#       trigrams at about the same positions are shortlisted, and the closest
+#       one within the allowed edits is taken. An edit changes at most three
+#       trigrams, so names sharing too few trigrams are never compared, and a
+#       name with too few trigrams in the catalog is rejected before any are
+#       counted.
+#
+# Short names are only resolved by the first two steps, as one edit turns
+# them into too many other names. Requests that write to the cabinet only
+# apply the first two steps as well: the last two also resolve names that
+# are not in the catalog at all to a similar one, so their match is only
+# returned as a suggestion. The index is built from the Ingredients
+# table once per catalog version and cached, so resolving a name does not
+# query the database. Most names are resolved by the first three steps,
+# which take a few hundred dictionary lookups.
+#
+# Usage (from the sdm-server directory):
+#     python -m benchmarks.resolver --ingredients 50000
+from collections import Counter
+from sdm_server import app, db
+from sdm_server.catalog import VersionedCache
+from sdm_server.measurements import singular
+from sdm_server.models import *
+
+# The largest number of edits between a name and the Ingredient it resolves to.
+app.config.setdefault('RESOLVER_MAX_EDITS', 2)
+# The number of Ingredients sharing the most trigrams that are compared with a name.
+app.config.setdefault('RESOLVER_CANDIDATES', 10)
+# Folded names with fewer letters must match exactly.
+app.config.setdefault('RESOLVER_MIN_LENGTH', 4)
+
+def fold(name):
+    """
+    Returns the folded form of a name: normalized, every word singular, without spaces.
+    """
+    return ''.join(singular(word) for word in normalize_name(name).split())
+
+def trigrams(folded):
+    """
+    Returns the set of trigrams of a folded name, padded so that its start and end count.
+    """
+    padded = '  ' + folded + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def positioned_trigrams(folded):
+    """
+    Returns the (trigram, position) pairs of a folded name, padded as in trigrams().
+    """
+    padded = '  ' + folded + ' '
+    return [(padded[i:i + 3], i) for i in range(len(padded) - 2)]
+
+def single_edits(folded, alphabet):
+    """
+    Returns the set of strings one edit away from a folded name, using the letters of alphabet.
+    """
+    splits = [(folded[:i], folded[i:]) for i in range(len(folded) + 1)]
+    edits = {left + right[1:] for left, right in splits if right}
+    edits.update(left + right[1] + right[0] + right[2:] for left, right in splits if len(right) > 1)
+    edits.update(left + letter + right[1:] for left, right in splits if right for letter in alphabet)
+    edits.update(left + letter + right for left, right in splits for letter in alphabet)
+    edits.discard(folded)
+    return edits
+
+def allowed_edits(folded):
+    """
+    Returns the number of edits allowed for a folded name: none below RESOLVER_MIN_LENGTH
+    letters, otherwise one per three letters, at least one and at most RESOLVER_MAX_EDITS.
+    """
+    if(len(folded) < app.config['RESOLVER_MIN_LENGTH']):
+        return 0
+    return min(app.config['RESOLVER_MAX_EDITS'], max(1, len(folded) // 3))
+
+def edit_distance(first, second, limit):
+    """
+    Returns the optimal string alignment distance of two strings, i.e. the number of
+    insertions, deletions, substitutions and swaps of adjacent characters that turn one into
+    the other, or limit + 1 as soon as it is known to exceed limit.
+    """
+    if(abs(len(first) - len(second)) > limit):
+        return limit + 1
+    previous, current = None, list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if(cost and i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]):
+                current[j] = min(current[j], before[j - 2] + 1)
+        if(min(current) > limit):
+            return limit + 1
+    return current[-1]
+
+class NameIndex:
+    '''
+    The NameIndex class holds the names of the catalog's Ingredients for one
+    catalog version, indexed for resolve().
+
+    version : tuple, The (version, updated_at) of the catalog the index was built for.
+
+    ids : List, The Ingredient ids; an Ingredient's position in the index is its position here.
+
+    names : List, The normalized names of the Ingredients.
+
+    folded : List, The folded names of the Ingredients.
+
+    exact : Dictionary, Maps a normalized name to its position.
+
+    by_folded : Dictionary, Maps a folded name to the position of the first Ingredient with it.
+
+    alphabet : str, The letters of the folded names.
+
+    trigrams : set, The trigrams of the folded names.
+
+    postings : Dictionary, Maps a (trigram, position) pair to the positions of the Ingredients whose folded
+               name has the trigram at that position.
+    '''
+    def __init__(self, version, ingredients):
+        self.version = version
+        self.ids, self.names, self.folded = [], [], []
+        self.exact, self.by_folded, self.postings = {}, {}, {}
+        for position, (ingredient_id, name) in enumerate(sorted(ingredients, key=lambda item: item[1])):
+            folded = fold(name)
+            self.ids.append(ingredient_id)
+            self.names.append(name)
+            self.folded.append(folded)
+            self.exact[name] = position
+            self.by_folded.setdefault(folded, position)
+            for trigram, offset in positioned_trigrams(folded):
+                self.postings.setdefault((trigram, offset), []).append(position)
+        self.alphabet = ''.join(sorted(set(''.join(self.by_folded))))
+        self.trigrams = {trigram for trigram, _ in self.postings}
+
+    def resolve(self, name, fuzzy=True):
+        """
+        Resolves a name typed by a User to an Ingredient of the catalog.
+        Parameters
+        ----------
+        name : str
+            The name to resolve.
+        fuzzy : bool
+            Whether names within the allowed edits are resolved too, or only
+            the normalized and folded names.
+        Returns
+        -------
+        ingredient : tuple
+            The (id, name) of the Ingredient, or None if no Ingredient is close enough.
+        """
+        position = self.exact.get(normalize_name(name))
+        if(position is None):
+            folded = fold(name)
+            position = self.by_folded.get(folded)
+            if(position is None and folded and fuzzy):
+                position = self.closest(folded)
+        return None if position is None else (self.ids[position], self.names[position])
+
+    def closest(self, folded):
+        """
+        Returns the position of the Ingredient whose folded name is closest to a folded name,
+        or None if none is within the allowed edits.
+        """
+        limit = allowed_edits(folded)
+        position = self.one_edit_away(folded) if limit else None
+        if(position is None and limit > 1):
+            position = self.shortlisted(folded, limit)
+        return position
+
+    def one_edit_away(self, folded):
+        """
+        Returns the position of the Ingredient one edit away from a folded name that shares the
+        most trigrams with it, or None if there is none.
+        """
+        candidates = {self.by_folded[edit] for edit in single_edits(folded, self.alphabet) if edit in self.by_folded}
+        query = trigrams(folded)
+        return min(candidates, key=lambda position: (-len(query & trigrams(self.folded[position])), self.names[position]),
+                   default=None)
+
+    def shortlisted(self, folded, limit):
+        """
+        Returns the position of the Ingredient closest to a folded name among the
+        RESOLVER_CANDIDATES sharing the most trigrams with it, or None if none is within limit
+        edits. Edits move the trigrams after them by at most limit positions, so only the
+        postings of nearby positions are counted. Every edit changes at most three trigrams, so a
+        name within limit edits shares all but 3 * limit of the trigrams of the folded name.
+        """
+        grams = positioned_trigrams(folded)
+        needed = len(grams) - 3 * limit
+        if(sum(trigram in self.trigrams for trigram, _ in grams) < needed):
+            return None
+        shared = Counter()
+        for trigram, offset in grams:
+            for moved in range(offset - limit, offset + limit + 1):
+                shared.update(self.postings.get((trigram, moved), ()))
+        best, best_key = None, None
+        for position, count in shared.most_common(app.config['RESOLVER_CANDIDATES']):
+            if(count < needed):
+                break
+            distance = edit_distance(folded, self.folded[position], limit)
+            # Fewer edits win, then more shared trigrams, then the name.
+            key = (distance, -count, self.names[position])
+            if(distance <= limit and (best_key is None or key < best_key)):
+                best, best_key = position, key
+        return best
+
+def build_index(version):
+    """
+    Reads the names of the Ingredients into a NameIndex.
+    """
+    return NameIndex(version, db.session.query(Ingredients.id, Ingredients.name).all())
+
+indexes = VersionedCache()
+
+def get_index():
+    """
+    Returns the NameIndex of the current catalog version, building it only
+    if the catalog has changed since it was last built.
+    """
+    return indexes.get(build_index)
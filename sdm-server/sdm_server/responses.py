@@ -0,0 +1,152 @@
+# This file provides response post-processing shared by the API endpoints.
+# It negotiates gzip/brotli compression for large JSON bodies and implements
+# conditional GET (ETag and Last-Modified) for the list endpoints, so that
+# unchanged listings are answered with 304 Not Modified before any body is built.
+import gzip
+from datetime import datetime
+from functools import wraps
+from flask import g, request, make_response
+from sdm_server import app, db
+from sdm_server.models import Data_Version
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional, gzip is always available.
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed, because the compression
+# overhead outweighs the bandwidth saved.
+app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+app.config.setdefault('COMPRESS_LEVEL', 6)
+app.config.setdefault('COMPRESS_MIMETYPES', ['application/json'])
+
+def choose_encoding(accept_encoding):
+    """
+    Picks the best supported content coding from an Accept-Encoding header.
+    Parameters
+    ----------
+    accept_encoding : MIMEAccept
+        The parsed Accept-Encoding header of the request.
+    Returns
+    -------
+    encoding : str or None
+        'br' or 'gzip' if the client accepts it, None otherwise.
+    """
+    if(brotli and accept_encoding['br']):
+        return 'br'
+    if(accept_encoding['gzip']):
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses eligible responses with the best coding the client accepts.
+    Only complete 200 responses with a configured mimetype and a body of at
+    least COMPRESS_MIN_SIZE bytes are compressed.
+    Parameters
+    ----------
+    response : Response
+        The response produced by the endpoint.
+    Returns
+    -------
+    response : Response
+        The same response, compressed when eligible.
+    """
+    if(response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    body = response.get_data()
+    if(not encoding or len(body) < app.config['COMPRESS_MIN_SIZE']):
+        return response
+
+    if(encoding == 'br'):
+        body = brotli.compress(body, quality=app.config['COMPRESS_LEVEL'])
+    else:
+        body = gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL'])
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag would have to change with the encoding; weak ETags
+    # (as used by conditional_get) stay valid for every representation.
+    return response
+
+def get_cache_validators(user, scopes):
+    """
+    Computes the ETag and Last-Modified values of a listing from the data
+    versions it depends on, without building the listing itself.
+    Parameters
+    ----------
+    user : User
+        The authenticated User.
+    scopes : tuple
+        The scopes the listing depends on, 'catalog' and/or 'user'.
+    Returns
+    -------
+    validators : tuple
+        An (etag, last_modified) tuple. last_modified is None if none of
+        the scopes was ever written.
+    """
+    names = [Data_Version.user_scope(user) if scope == 'user' else scope for scope in scopes]
+    versions = Data_Version.lookup(*names)
+    # The listing itself is built from the same versions, e.g. by catalog.get_catalog.
+    g.data_versions = dict(zip(names, versions))
+    # The user id is part of the tag, because the same URL returns different
+    # listings to different Users.
+    etag = '{}-{}'.format(user.id, '-'.join(str(version) for version, _ in versions))
+    timestamps = [updated_at for _, updated_at in versions if updated_at]
+    last_modified = max(timestamps) if timestamps else None
+    return etag, last_modified
+
+def conditional_get(*scopes):
+    """
+    This function serves as a decorator for list endpoints. It must be
+    applied below @login_required so that the User instance is passed in.
+    A weak ETag and a Last-Modified header are added to every response. If
+    the request's If-None-Match or If-Modified-Since header shows that the
+    client's copy is still current, a 304 response is returned and the
+    decorated endpoint is never called. Otherwise the endpoint reads from
+    the replicas, if any are configured and the listing was not written
+    within the read-your-writes window. The ETag and Last-Modified of a
+    listing read from a replica are those of the replica, which may lag.
+
+    Last-Modified has a resolution of one second, so it is only sent once
+    the second of the last write has passed (RFC 7232, 2.2.2). Otherwise a
+    second write within the same second would be answered with 304.
+    Parameters
+    ----------
+    *scopes : *args
+        The data scopes the listing depends on: 'catalog', 'user', or both.
+    Returns
+    -------
+    decorator : function
+        The decorator to apply to the endpoint.
+    """
+    def decorator(f):
+        @wraps(f)
+        def _conditional(user, *args, **kwargs):
+            etag, last_modified = get_cache_validators(user, scopes)
+            if(request.if_none_match):
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                                and last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None))
+            if(not_modified):
+                response = make_response('', 304)
+            else:
+                # The versions were read from the primary database. The listing itself
+                # can come from a replica unless it changed within the last moments,
+                # then the validators are read again from the same replica.
+                if(db.use_replicas(last_modified)):
+                    etag, last_modified = get_cache_validators(user, scopes)
+                response = make_response(f(user, *args, **kwargs))
+            if(response.status_code in (200, 304)):
+                response.set_etag(etag, weak=True)
+                if(last_modified and last_modified < datetime.utcnow().replace(microsecond=0)):
+                    response.last_modified = last_modified.replace(microsecond=0)
+            return response
+        return _conditional
+    return decorator
@@ -9,6 +9,8 @@ from flask_mail import Message
 from sdm_server import app, db, mail
 from sdm_server.models import User
 from sdm_server.validators import *
+from sdm_server.metrics import render_metrics
+from sdm_server.responses import conditional_get
 
 @app.route('/')
 def index():
@@ -25,6 +27,20 @@ def index():
     """
     return jsonify({"message": "Please reference API documentation to view supported endpoints"}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    This endpoint exposes the collected request and database metrics
+    in the Prometheus text format. It is intended to be scraped by the
+    monitoring system and does not require authentication.
+    Returns
+    -------
+    metrics : text/plain
+        Per-route latency histograms, status code counters, in-flight
+        requests and SQL statement counts and durations.
+    """
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/api/login', methods=['POST'])
 @cross_origin(origin='localhost')
 def login():
@@ -162,6 +178,7 @@ def authenticate(user):
 @app.route('/api/all-ingredients', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('catalog', 'user')
 def get_all_ingredients(user):
     """
     This endpoint returns all ingredients stored in the database.
@@ -208,6 +225,12 @@ def update_ingredient(user):
         A JSON formatted error message is required parameters are missing.
     message : JSON
         A JSON formatted success message if the update was successful. 
+    resolved : JSON
+        Maps the sent name to the canonical name of the ingredient that was
+        updated, or to null if it matched no ingredient.
+    suggested : JSON
+        Maps the sent name to the closest ingredient if it matched none and
+        one is a few edits away. The suggested ingredient is not updated.
     """
     name = request.get_json().get('name')
     quantity = request.get_json().get('quantity')
@@ -215,12 +238,14 @@ def update_ingredient(user):
 
     if(entry_is_null(name, quantity, is_favorite)):
         return jsonify({"error": "Provide name, quantity and isFavorite"}), 401
-    update_database_ingredients(user, name, quantity, is_favorite)
-    return jsonify({"message": "Ok"}), 200
+    resolved, suggested = update_database_ingredients(user, name, quantity, is_favorite)
+    return jsonify({"message": "Ok", "resolved": {name: resolved},
+                    "suggested": {name: suggested} if suggested else {}}), 200
 
 @app.route('/api/custom-ingredients', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('user')
 def get_all_custom_ingredients(user):
     """
     This endpoint returns all of the User's custom ingredients stored in the database.
@@ -310,6 +335,7 @@ def delete_custom(user):
 @app.route('/api/user-ingredients', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('catalog', 'user')
 def get_user_ingredients(user):
     """
     This endpoint returns all ingredients that a user has added
@@ -350,11 +376,19 @@ def add_user_ingredients(user):
     message : JSON
         A success message, listing all ingredients that were added.
         Or a fail message, specifying no valid ingredients were sent.
+    resolved : JSON
+        Maps every sent name to the canonical name of the ingredient it
+        resolved to, correcting plurals and spacing, or to null if it
+        matched no ingredient.
+    suggested : JSON
+        Maps the sent names that matched no ingredient to the closest
+        ingredient a few edits away, if any. Suggested ingredients are not
+        added to the cabinet.
     """
     ingredients = request.get_json().get('ingredients', '')
-    message = add_ingredients(user, ingredients)
+    message, resolved, suggested = add_ingredients(user, ingredients)
     if message:
-        return jsonify({"message": message}), 200
+        return jsonify({"message": message, "resolved": resolved, "suggested": suggested}), 200
     return jsonify({"message": "No valid ingredients"}), 400
 
 @app.route('/api/user-ingredients', methods=['DELETE'])
@@ -388,6 +422,7 @@ def delete_user_ingredients(user):
 @app.route('/api/all-recipes', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('catalog')
 def get_all_recipes(user):
     """
     This endpoint returns all recipes stored in the database.
@@ -409,6 +444,7 @@ def get_all_recipes(user):
 @app.route('/api/filtered-recipes', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('catalog', 'user')
 def get_filtered_recipes(user):
     """
     This endpoint returns all Recipes stored in the database,
@@ -417,21 +453,217 @@ def get_filtered_recipes(user):
     in the cabinet are returned. The Authorization header must be set
     and contain the user's JWT. The user instance is implicitly passed in
     by the @login_required decorator after a JWT is successfully decoded.
+    With ?substitutions=true, Recipes that the User could make by
+    substituting equivalent Ingredients (e.g. lime juice for lemon juice)
+    are returned as well. Every Recipe then lists its 'substitutions'.
     Parameters
     ----------
     token : JSONWebToken
         A JSONWebToken setn in the Authorization header.
+    substitutions : str
+        Optional query argument, 'true' to include substituted Recipes.
     Returns
     -------
     recipes : JSON
         A JSON formatted listing of filtered database recipes.
     """
     recipes = get_all_filtered_database_recipes(user)
+    if(request.args.get('substitutions', '').lower() in ('true', '1')):
+        for recipe in recipes:
+            recipe['substitutions'] = {}
+        recipes = sorted(recipes + get_substituted_recipes(user), key=itemgetter('name'))
+    return jsonify({"recipes": recipes}), 200
+
+@app.route('/api/recipe-servings', methods=['GET'])
+@cross_origin(origin='localhost')
+@login_required
+@conditional_get('catalog', 'user')
+def get_servings(user):
+    """
+    This endpoint returns how many servings of each Recipe the User can
+    make with the quantities in the cabinet. Only Recipes that the User
+    could currently make are returned. The Authorization header must be
+    set and contain the user's JWT. The user instance is implicitly passed
+    in by the @login_required decorator after a JWT is successfully decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    Returns
+    -------
+    recipes : JSON
+        A JSON formatted listing of Recipe names and servings.
+    """
+    recipes = get_recipe_servings(user)
+    return jsonify({"recipes": recipes}), 200
+
+@app.route('/api/shopping-list/optimize', methods=['GET'])
+@cross_origin(origin='localhost')
+@login_required
+@conditional_get('catalog', 'user')
+def optimize_shopping_list(user):
+    """
+    This endpoint suggests which Ingredients the User should buy next.
+    Up to 'budget' Ingredients that are not in the cabinet are picked so
+    that as many Recipes as possible become makeable. The Authorization
+    header must be set and contain the user's JWT. The user instance is
+    implicitly passed in by the @login_required decorator after a JWT is
+    successfully decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    budget : int
+        Query argument, the largest number of Ingredients to suggest.
+    Returns
+    -------
+    error : JSON
+        A JSON formatted error message if the budget is missing or invalid.
+    ingredients : JSON
+        A JSON formatted listing of the suggested Ingredients, in the order
+        they should be bought, each with the Recipes that it unlocks.
+    """
+    budget = request.args.get('budget', type=int)
+    if(budget is None or not 0 < budget <= app.config['SHOPPING_LIST_MAX_BUDGET']):
+        return jsonify({"error": "'budget' must be a number between 1 and {}.".format(app.config['SHOPPING_LIST_MAX_BUDGET'])}), 400
+    ingredients = get_shopping_list_suggestions(user, budget)
+    return jsonify({"ingredients": ingredients}), 200
+
+@app.route('/api/shopping-list', methods=['POST'])
+@cross_origin(origin='localhost')
+@login_required
+def create_shopping_list(user):
+    """
+    This endpoint builds the shopping list for a set of Recipes. The
+    Ingredients that the Recipes need and that are missing from the User's
+    cabinet are returned once each, grouped by ingredient type. The
+    Authorization header must be set and contain the user's JWT. The user
+    instance is implicitly passed in by the @login_required decorator after
+    a JWT is successfully decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    recipes : JSON
+        A JSON formatted list of Recipe names, sent in the request body.
+    Returns
+    -------
+    error : JSON
+        A JSON formatted error message if no Recipes were sent.
+    ingredients : JSON
+        A JSON formatted dictionary of ingredient types, each listing the
+        Ingredients to buy and the Recipes that need them.
+    """
+    data = request.get_json()
+    recipes = data.get('recipes') if isinstance(data, dict) else None
+    if(not recipes or not isinstance(recipes, list) or not all(isinstance(name, str) for name in recipes)):
+        return jsonify({"error": "'recipes' must be a list of recipe names."}), 400
+    ingredients = get_shopping_list(user, recipes)
+    return jsonify({"ingredients": ingredients}), 200
+
+@app.route('/api/recipes/<name>/make', methods=['POST'])
+@cross_origin(origin='localhost')
+@login_required
+def make_drink(user, name):
+    """
+    This endpoint records that the User made one serving of the named
+    Recipe, decrementing the quantities of its Ingredients in the cabinet.
+    Either every quantity is decremented or none is. The Authorization
+    header must be set and contain the user's JWT. The user instance is
+    implicitly passed in by the @login_required decorator after a JWT is
+    successfully decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    name : str
+        The name of the Recipe, part of the URL.
+    Returns
+    -------
+    error : JSON
+        A JSON formatted error message if the Recipe does not exist, or if Ingredients are
+        missing from the cabinet or their quantities are too low, listing them.
+    made : JSON
+        The Recipe name and the Ingredients that were used up, with the quantity used and
+        the quantity left.
+    """
+    made, missing = make_recipe(user, name)
+    if(missing):
+        return jsonify({"error": "Not enough ingredients to make the recipe.", "missing": missing}), 409
+    if(made is None):
+        return jsonify({"error": "Recipe not found."}), 404
+    return jsonify(made), 200
+
+@app.route('/api/recipes/<name>/similar', methods=['GET'])
+@cross_origin(origin='localhost')
+@login_required
+@conditional_get('catalog')
+def get_similar(user, name):
+    """
+    This endpoint returns the Recipes whose Ingredients are most similar to
+    those of the named Recipe. The similarity is estimated, so Recipes that
+    are only slightly similar may be missing. The Authorization header must
+    be set and contain the user's JWT. The user instance is implicitly
+    passed in by the @login_required decorator after a JWT is successfully
+    decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    name : str
+        The name of the Recipe, part of the URL.
+    limit : int
+        Query argument, the largest number of Recipes to return. Defaults to 10.
+    Returns
+    -------
+    error : JSON
+        A JSON formatted error message if the Recipe does not exist or the limit is invalid.
+    recipes : JSON
+        A JSON formatted listing of the similar Recipes, most similar first,
+        each with its estimated similarity.
+    """
+    limit = request.args.get('limit', 10, type=int)
+    if(not 0 < limit <= app.config['SIMILARITY_MAX_LIMIT']):
+        return jsonify({"error": "'limit' must be a number between 1 and {}.".format(app.config['SIMILARITY_MAX_LIMIT'])}), 400
+    recipes = get_similar_recipes(name, limit)
+    if(recipes is None):
+        return jsonify({"error": "Recipe not found."}), 404
     return jsonify({"recipes": recipes}), 200
 
+@app.route('/api/recommendations', methods=['GET'])
+@cross_origin(origin='localhost')
+@login_required
+@conditional_get('catalog', 'user')
+def get_recipe_recommendations(user):
+    """
+    This endpoint recommends Recipes that the User cannot make yet, grouped
+    by the makeable Recipe they are similar to ("because you can make X").
+    The Authorization header must be set and contain the user's JWT. The
+    user instance is implicitly passed in by the @login_required decorator
+    after a JWT is successfully decoded.
+    Parameters
+    ----------
+    token : JSONWebToken
+        A JSONWebToken sent in the Authorization header.
+    limit : int
+        Query argument, the largest number of makeable Recipes to list. Defaults to 5.
+    Returns
+    -------
+    error : JSON
+        A JSON formatted error message if the limit is invalid.
+    recommendations : JSON
+        A JSON formatted listing of makeable Recipes and the Recipes recommended because of them.
+    """
+    limit = request.args.get('limit', 5, type=int)
+    if(not 0 < limit <= app.config['SIMILARITY_MAX_LIMIT']):
+        return jsonify({"error": "'limit' must be a number between 1 and {}.".format(app.config['SIMILARITY_MAX_LIMIT'])}), 400
+    recommendations = get_recommendations(user, limit)
+    return jsonify({"recommendations": recommendations}), 200
+
 @app.route('/api/partial-filter', methods=['GET'])
 @cross_origin(origin='localhost')
 @login_required
+@conditional_get('catalog', 'user')
 def get_partial_filter(user):
     """
     This endpoint returns all Recipes stored in the database,
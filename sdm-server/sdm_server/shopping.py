@@ -0,0 +1,175 @@
+# This file suggests what to buy next. Given a budget of k Ingredients, the
+# optimizer picks Ingredients that are not in a User's cabinet so that as
+# many Recipes as possible become makeable.
+#
+# Picking the best k Ingredients is a maximum coverage problem, which is
+# solved greedily: the Ingredient that completes the most Recipes is bought
+# first. A Recipe is only completed by the last of its missing Ingredients,
+# so the gain of an Ingredient is the number of Recipes that miss only that
+# Ingredient. Buying an Ingredient can only raise the gains of the others,
+# so the gains are kept in a heap and updated lazily: a purchase touches
+# only the Recipes that use the Ingredient, and outdated heap entries are
+# skipped when they surface. The missing counts themselves are derived from
+# the Recipe lists of the cabinet's Ingredients, without reading every
+# Recipe. If no single Ingredient completes a Recipe, the optimizer starts on
+# the cheapest set of Ingredients that completes one, and goes back to the
+# heap after every Ingredient it buys, since that purchase may have given
+# another Ingredient a gain. The candidate sets are kept in one heap per
+# number of missing Ingredients, built when that number is first needed and
+# updated by every purchase, so a pick does not rescan the catalog.
+#
+# The Recipe/Ingredient index the optimizer works on is built once per
+# catalog version and cached, like the substitution closure.
+import heapq
+from collections import Counter
+from itertools import chain
+from sdm_server import app, db
+from sdm_server.catalog import VersionedCache
+from sdm_server.models import *
+
+# The largest budget a request may ask for.
+app.config.setdefault('SHOPPING_LIST_MAX_BUDGET', 25)
+
+class CatalogIndex:
+    '''
+    The CatalogIndex class holds the Ingredients of every Recipe, and the
+    Recipes of every Ingredient, for one catalog version.
+
+    version : tuple, The (version, updated_at) of the catalog the index was built for.
+
+    ingredients : Dictionary, Maps a Recipe id to a tuple of its Ingredient ids.
+
+    recipes : Dictionary, Maps an Ingredient id to a tuple of the ids of the Recipes that use it.
+
+    sizes : Dictionary, Maps a number of Ingredients to the ids of the Recipes with that many Ingredients.
+    '''
+    def __init__(self, version, ingredients):
+        self.version = version
+        self.ingredients = ingredients
+        recipes, sizes = {}, {}
+        for recipe_id, ingredient_ids in ingredients.items():
+            sizes.setdefault(len(ingredient_ids), []).append(recipe_id)
+            for ingredient_id in ingredient_ids:
+                recipes.setdefault(ingredient_id, []).append(recipe_id)
+        self.recipes = {ingredient_id: tuple(recipe_ids) for ingredient_id, recipe_ids in recipes.items()}
+        self.sizes = sizes
+
+def build_index(version):
+    """
+    Reads the Recipe/Ingredient links of the catalog into a CatalogIndex.
+    """
+    ingredients = {}
+    for recipe_id, ingredient_id in db.session.query(recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id):
+        ingredients.setdefault(recipe_id, []).append(ingredient_id)
+    return CatalogIndex(version, {recipe_id: tuple(ingredient_ids) for recipe_id, ingredient_ids in ingredients.items()})
+
+indexes = VersionedCache()
+
+def get_index():
+    """
+    Returns the CatalogIndex of the current catalog version, building it
+    only if the catalog has changed since it was last built.
+    """
+    return indexes.get(build_index)
+
+def count_missing(index, cabinet):
+    """
+    Counts the missing Ingredients of the Recipes that share an Ingredient
+    with a cabinet, by counting the cabinet's hits on the Recipe lists of
+    the index. Every other Recipe misses all of its Ingredients.
+    Parameters
+    ----------
+    index : CatalogIndex
+        The index of the catalog.
+    cabinet : set
+        The ids of the Ingredients in the User's cabinet.
+    Returns
+    -------
+    missing : Dictionary
+        Maps the ids of the Recipes that share an Ingredient with the cabinet
+        to their number of missing Ingredients.
+    """
+    hits = Counter(chain.from_iterable(index.recipes.get(ingredient_id, ()) for ingredient_id in cabinet))
+    return {recipe_id: len(index.ingredients[recipe_id]) - count for recipe_id, count in hits.items()}
+
+def optimize(index, cabinet, budget):
+    """
+    Picks up to budget Ingredients outside a cabinet that complete the most Recipes.
+    Parameters
+    ----------
+    index : CatalogIndex
+        The index of the catalog.
+    cabinet : set
+        The ids of the Ingredients in the User's cabinet.
+    budget : int
+        The largest number of Ingredients to pick.
+    Returns
+    -------
+    picks : List
+        A List of (ingredient_id, recipe_ids) tuples in the order the
+        Ingredients were picked, where recipe_ids are the Recipes that the
+        Ingredient completes.
+    """
+    owned = set(cabinet)
+    missing = count_missing(index, owned)
+    size = lambda recipe_id: missing.get(recipe_id, len(index.ingredients[recipe_id]))
+    last_missing = lambda recipe_id: next(i for i in index.ingredients[recipe_id] if i not in owned)
+    gains = Counter(last_missing(recipe_id) for recipe_id, count in missing.items() if count == 1)
+    gains.update(index.ingredients[recipe_id][0] for recipe_id in index.sizes.get(1, ()) if recipe_id not in missing)
+    heap = [(-gain, ingredient_id) for ingredient_id, gain in gains.items()]
+    heapq.heapify(heap)
+    picks = []
+    # Maps a number of missing Ingredients to a heap of the Recipes that miss that many, cheapest set first.
+    bundles = {}
+
+    def bundle_entry(recipe_id):
+        ingredient_ids = tuple(sorted(i for i in index.ingredients[recipe_id] if i not in owned))
+        return (-sum(len(index.recipes[i]) for i in ingredient_ids), ingredient_ids, recipe_id)
+
+    def bundle_heap(count):
+        if(count not in bundles):
+            recipe_ids = [recipe_id for recipe_id in index.sizes.get(count, ()) if recipe_id not in missing]
+            recipe_ids.extend(recipe_id for recipe_id, missed in missing.items() if missed == count)
+            bundles[count] = [bundle_entry(recipe_id) for recipe_id in recipe_ids]
+            heapq.heapify(bundles[count])
+        return bundles[count]
+
+    def buy(ingredient_id):
+        owned.add(ingredient_id)
+        gains.pop(ingredient_id, None)
+        completed = []
+        for recipe_id in index.recipes.get(ingredient_id, ()):
+            count = size(recipe_id) - 1
+            missing[recipe_id] = count
+            if(count == 0):
+                completed.append(recipe_id)
+            elif(count == 1):
+                other = last_missing(recipe_id)
+                gains[other] += 1
+                heapq.heappush(heap, (-gains[other], other))
+            elif(count in bundles):
+                heapq.heappush(bundles[count], bundle_entry(recipe_id))
+        picks.append((ingredient_id, sorted(completed)))
+
+    while(len(picks) < budget):
+        # Skip heap entries of bought Ingredients and entries whose gain has since grown.
+        while(heap and gains.get(heap[0][1]) != -heap[0][0]):
+            heapq.heappop(heap)
+        if(heap):
+            buy(heapq.heappop(heap)[1])
+            continue
+        # No Ingredient completes a Recipe on its own. Start on the smallest set that completes one,
+        # preferring sets of Ingredients that are used by many Recipes, and buy its most used Ingredient.
+        bundle = None
+        for count in range(2, budget - len(picks) + 1):
+            candidates = bundle_heap(count)
+            # Skip entries of Recipes that have since lost a missing Ingredient.
+            while(candidates and size(candidates[0][2]) != count):
+                heapq.heappop(candidates)
+            if(candidates):
+                bundle = candidates[0][1]
+                break
+        if(bundle is None):
+            break
+        buy(min(bundle, key=lambda i: (-len(index.recipes[i]), i)))
+    return picks
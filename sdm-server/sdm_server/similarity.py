@@ -0,0 +1,250 @@
+# This file finds similar Recipes, i.e. Recipes with a high Jaccard
+# similarity |A & B| / |A | B| of their Ingredient sets. Comparing every
+# pair of Recipes is quadratic in the size of the catalog, so the
+# similarity is approximated with MinHash and locality-sensitive hashing:
+#
+#     - The signature of a Recipe holds, for each of SIMILARITY_HASHES hash
+#       functions, the smallest hash of its Ingredient ids. Two Recipes agree
+#       on a position with a probability equal to their Jaccard similarity,
+#       so the fraction of equal positions estimates it.
+#     - The signature is cut into SIMILARITY_BANDS bands. Recipes that are
+#       equal on a whole band share a bucket and become candidates for each
+#       other. Only the candidates are compared, which is sublinear in the
+#       size of the catalog. Pairs with a similarity below about
+#       (1 / bands) ** (bands / hashes) rarely share a bucket, and the more
+#       similar a pair, the more buckets it shares.
+#
+# Signatures are stored in the recipe_signatures table, and recomputed when
+# the Ingredients of a Recipe change. The buckets are built from the stored
+# signatures once per catalog version and cached. Building them takes over
+# a second for a large catalog, so after a change they are built by a
+# background thread, and lookups use the previous buckets until it is done.
+#
+# Usage (from the sdm-server directory):
+#     FLASK_APP=sdm_server flask similarity-rebuild
+import random
+import struct
+from collections import Counter
+from functools import partial
+from operator import eq
+import click
+from sqlalchemy import event, select
+from flask_sqlalchemy import SignallingSession
+from sdm_server import app, db
+from sdm_server.catalog import VersionedCache
+from sdm_server.models import *
+from sdm_server.models import get_relinked_recipes
+
+# The number of hash functions, which must be a multiple of the number of bands.
+# Changing either requires running similarity-rebuild.
+app.config.setdefault('SIMILARITY_HASHES', 64)
+app.config.setdefault('SIMILARITY_BANDS', 32)
+# The hash functions are drawn from this seed, so that stored signatures stay comparable.
+app.config.setdefault('SIMILARITY_SEED', 1)
+# Recommendations leave out Recipes with a lower estimated similarity.
+app.config.setdefault('SIMILARITY_THRESHOLD', 0.3)
+# The largest number of Recipes recommended because of one makeable Recipe.
+app.config.setdefault('SIMILARITY_GROUP_SIZE', 5)
+# The largest number of makeable Recipes that recommendations are looked up for.
+app.config.setdefault('SIMILARITY_SOURCES', 20)
+# With a limit of k, the k * SIMILARITY_SHORTLIST Recipes sharing the most buckets are compared.
+app.config.setdefault('SIMILARITY_SHORTLIST', 8)
+# The largest number of similar Recipes a request may ask for.
+app.config.setdefault('SIMILARITY_MAX_LIMIT', 50)
+
+# Hashes are computed modulo a Mersenne prime below 2 ** 32, so that each fits in 4 bytes.
+PRIME = (1 << 31) - 1
+
+def get_coefficients(count, seed):
+    """
+    Returns the (a, b) coefficients of count hash functions (a * x + b) % PRIME.
+    """
+    rng = random.Random(seed)
+    return [(rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(count)]
+
+def signature(ingredient_ids, coefficients):
+    """
+    Returns the MinHash signature of a non-empty set of Ingredient ids as a tuple.
+    """
+    return tuple(min((a * x + b) % PRIME for x in ingredient_ids) for a, b in coefficients)
+
+def pack(values):
+    """
+    Packs a signature into 4 bytes per hash.
+    """
+    return struct.pack('<{}I'.format(len(values)), *values)
+
+def unpack(data):
+    """
+    Unpacks a signature packed by pack().
+    """
+    return struct.unpack('<{}I'.format(len(data) // 4), data)
+
+def store(connection, recipe_ids=None):
+    """
+    Computes and writes the signatures of Recipes to recipe_signatures.
+    Recipes without Ingredients have no signature.
+    Parameters
+    ----------
+    connection : Connection or Session
+        Where to execute the statements.
+    recipe_ids : iterable
+        Optionally only store the signatures of these Recipes.
+    Returns
+    -------
+    stored : int
+        The number of signatures written.
+    """
+    links = select([recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id])
+    delete = recipe_signatures.delete()
+    if(recipe_ids is not None):
+        recipe_ids = sorted(recipe_ids)
+        links = links.where(recipe_ingredients.c.recipe_id.in_(recipe_ids))
+        delete = delete.where(recipe_signatures.c.recipe_id.in_(recipe_ids))
+    ingredients = {}
+    for recipe_id, ingredient_id in connection.execute(links):
+        ingredients.setdefault(recipe_id, []).append(ingredient_id)
+    coefficients = get_coefficients(app.config['SIMILARITY_HASHES'], app.config['SIMILARITY_SEED'])
+    rows = [{'recipe_id': recipe_id, 'signature': pack(signature(ingredient_ids, coefficients))}
+            for recipe_id, ingredient_ids in ingredients.items()]
+    connection.execute(delete)
+    if(rows):
+        connection.execute(recipe_signatures.insert(), rows)
+    return len(rows)
+
+class SimilarityIndex:
+    '''
+    The SimilarityIndex class holds the signatures and LSH buckets of the
+    catalog for one catalog version.
+
+    version : tuple, The (version, updated_at) of the catalog the index was built for.
+
+    signatures : Dictionary, Maps a Recipe id to its signature.
+
+    bands : int, The number of bands the signatures are cut into.
+
+    buckets : Dictionary, Maps a (band, band values) key to the ids of the Recipes in the bucket.
+    '''
+    def __init__(self, version, signatures, bands):
+        self.version = version
+        self.signatures = signatures
+        self.bands = bands
+        self.buckets = {}
+        for recipe_id, values in signatures.items():
+            for key in self.keys(values):
+                self.buckets.setdefault(key, []).append(recipe_id)
+
+    def keys(self, values):
+        """
+        Returns the bucket keys of a signature, one per band.
+        """
+        rows = len(values) // self.bands
+        return [(band, values[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def similar(self, recipe_id, limit=None, threshold=0.0, exclude=()):
+        """
+        Returns the candidates of a Recipe with their estimated similarity.
+        With a limit, only the candidates that share the most buckets with
+        the Recipe are compared with it.
+        Parameters
+        ----------
+        recipe_id : int
+            The primary key of the Recipe.
+        limit : int
+            Optionally return only the most similar candidates.
+        threshold : float
+            Leave out candidates with a lower estimated similarity.
+        exclude : iterable
+            Ids of Recipes to leave out.
+        Returns
+        -------
+        similar : List
+            A List of (recipe_id, similarity) tuples, most similar first.
+        """
+        values = self.signatures.get(recipe_id)
+        if(values is None):
+            return []
+        shared = Counter()
+        for key in self.keys(values):
+            shared.update(self.buckets[key])
+        del shared[recipe_id]
+        for excluded in exclude:
+            shared.pop(excluded, None)
+        # The number of shared buckets grows with the similarity, so it is a cheap first ranking.
+        candidates = shared if limit is None else [candidate for candidate, _ in
+                                                   shared.most_common(limit * app.config['SIMILARITY_SHORTLIST'])]
+        hashes = len(values)
+        scored = []
+        for candidate in candidates:
+            similarity = sum(map(eq, values, self.signatures[candidate])) / hashes
+            if(similarity >= threshold):
+                scored.append((candidate, similarity))
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+def read_signatures():
+    """
+    Reads the stored signatures as a List of (recipe_id, packed signature) rows.
+    """
+    return db.session.execute(select([recipe_signatures.c.recipe_id, recipe_signatures.c.signature])).fetchall()
+
+def build_index(version, rows, hashes, bands):
+    """
+    Unpacks signatures read by read_signatures() into a SimilarityIndex.
+    Signatures of a different length, stored before SIMILARITY_HASHES
+    changed, are skipped.
+    """
+    signatures = {}
+    for recipe_id, data in rows:
+        values = unpack(data)
+        if(len(values) == hashes):
+            signatures[recipe_id] = values
+    return SimilarityIndex(version, signatures, bands)
+
+indexes = VersionedCache()
+
+def get_index():
+    """
+    Returns the SimilarityIndex of the catalog. The first index is built
+    right away. When the catalog has changed since, the signatures are read
+    again and the new index is built in the background, while the index of
+    the previous version is returned. Until it is replaced, that index
+    misses new Recipes and may list deleted ones.
+    """
+    hashes, bands = app.config['SIMILARITY_HASHES'], app.config['SIMILARITY_BANDS']
+    return indexes.get(lambda version: build_index(version, read_signatures(), hashes, bands),
+                       background=lambda version: partial(build_index, version, read_signatures(), hashes, bands))
+
+def wait_for_index():
+    """
+    Waits until the index being built in the background, if any, replaced the cached index.
+    """
+    indexes.wait()
+
+@event.listens_for(SignallingSession, 'before_flush')
+def collect_signed_recipes(session, flush_context, instances):
+    """
+    Record the Recipes whose Ingredients change in this flush. Rows of
+    deleted Recipes are removed before the Recipes are.
+    """
+    session.info.setdefault('signed_recipes', set()).update(get_relinked_recipes(session))
+    for instance in session.deleted:
+        if isinstance(instance, Recipe) and instance.id is not None:
+            session.execute(recipe_signatures.delete().where(recipe_signatures.c.recipe_id == instance.id))
+
+@event.listens_for(SignallingSession, 'after_flush')
+def store_signatures(session, flush_context):
+    """
+    Recompute the signatures of the Recipes collected before the flush, once their links are written.
+    """
+    recipes = session.info.pop('signed_recipes', None)
+    recipe_ids = {recipe.id for recipe in recipes or () if recipe.id is not None and recipe not in session.deleted}
+    if(recipe_ids):
+        store(session.connection(), recipe_ids)
+
+@app.cli.command('similarity-rebuild')
+def similarity_rebuild_command():
+    """Recompute the MinHash signature of every Recipe."""
+    with db.engine.begin() as connection:
+        stored = store(connection)
+    click.echo("Stored {} Recipe signatures.".format(stored))
@@ -0,0 +1,144 @@
+# This file provides ingredient substitutions. Ingredients are grouped into
+# equivalence groups (any citrus juice, any milk, ...), configured through
+# SUBSTITUTION_GROUPS. Every Ingredient can be substituted by any other
+# Ingredient it shares a group with, directly or through other groups.
+#
+# The groups are resolved against the catalog into a closure that maps each
+# Ingredient to all of its substitutes. The closure is built once per
+# catalog version and cached, so that matching a Recipe against a cabinet
+# is a dictionary lookup per Ingredient.
+from fnmatch import fnmatchcase
+from sdm_server import app, db
+from sdm_server.catalog import VersionedCache
+from sdm_server.models import Ingredients, Data_Version
+
+# Every group lists the ingredient names that belong to it. Names may use
+# shell-style wildcards and are matched case-insensitively. If 'types' is
+# given, only Ingredients of those ingredient types belong to the group.
+app.config.setdefault('SUBSTITUTION_GROUPS', {
+    'citrus juice': {'types': ['liquid'], 'members': ['lemon juice', '*lime*juice', 'orange juice', 'grapefruit juice',
+                                                      'tangerine juice', 'clementine juice', 'yuzu juice']},
+    'milk': {'types': ['liquid'], 'members': ['milk', 'almond milk', 'coconut milk', 'nut milk', 'oat milk',
+                                              'rice milk', 'soy milk', 'cashew milk']},
+    'yogurt': {'members': ['yogurt', 'plain yogurt', 'greek yogurt', 'vanilla yogurt']},
+    'liquid sweetener': {'members': ['honey', 'maple syrup', 'agave nectar', 'agave syrup', 'simple syrup']},
+    'sugar': {'members': ['sugar', 'brown sugar', 'white sugar', 'cane sugar', 'coconut sugar', 'raw sugar']},
+})
+
+class SubstitutionClosure:
+    '''
+    The SubstitutionClosure class holds the resolved substitutes of every
+    grouped Ingredient for one catalog version.
+
+    version : tuple, The (version, updated_at) of the catalog the closure was built for.
+
+    groups : dict, The SUBSTITUTION_GROUPS configuration the closure was built from.
+
+    substitutes : Dictionary, Maps an Ingredient id to a frozenset of the ids
+    of its substitutes. Ingredients without substitutes are not present.
+
+    names : Dictionary, Maps the id of every grouped Ingredient to its name.
+    '''
+    def __init__(self, version, groups, substitutes, names):
+        self.version = version
+        self.groups = groups
+        self.substitutes = substitutes
+        self.names = names
+
+    def cover(self, cabinet):
+        """
+        Finds the Ingredients that a cabinet can stand in for.
+        Parameters
+        ----------
+        cabinet : set
+            The ids of the Ingredients in a User's cabinet.
+        Returns
+        -------
+        substitute_for : Dictionary
+            Maps the id of every Ingredient that is not in the cabinet, but
+            has a substitute in it, to the id of that substitute.
+        """
+        substitute_for = {}
+        for ingredient_id in sorted(cabinet):
+            for substitute_id in self.substitutes.get(ingredient_id, ()):
+                if(substitute_id not in cabinet):
+                    substitute_for.setdefault(substitute_id, ingredient_id)
+        return substitute_for
+
+def resolve_group(group, ingredients):
+    """
+    Returns the ids of the Ingredients that belong to an equivalence group.
+    Parameters
+    ----------
+    group : dict
+        The group configuration, with 'members' and optional 'types'.
+    ingredients : List
+        A List of (id, name, ingredient_type) tuples of the catalog.
+    Returns
+    -------
+    ingredient_ids : List
+        The ids of the matching Ingredients.
+    """
+    types = {ingredient_type.lower() for ingredient_type in group.get('types', ())}
+    members = [member.lower() for member in group['members']]
+    return [ingredient_id for ingredient_id, name, ingredient_type in ingredients
+            if (not types or ingredient_type.lower() in types)
+            and any(fnmatchcase(name.lower(), member) for member in members)]
+
+def build_closure(version, groups):
+    """
+    Resolves the equivalence groups against the catalog and computes the
+    substitutes of every Ingredient. Groups that share an Ingredient are
+    merged, so substitution is transitive.
+    Parameters
+    ----------
+    version : tuple
+        The current (version, updated_at) of the catalog.
+    groups : dict
+        The SUBSTITUTION_GROUPS configuration.
+    Returns
+    -------
+    closure : SubstitutionClosure
+        The closure for the catalog version.
+    """
+    ingredients = db.session.query(Ingredients.id, Ingredients.name, Ingredients.ingredient_type).all()
+    names = {ingredient_id: name for ingredient_id, name, _ in ingredients}
+    # Union-find over the Ingredient ids, every group joins its members.
+    parent = {}
+    def find(ingredient_id):
+        while parent[ingredient_id] != ingredient_id:
+            parent[ingredient_id] = parent[parent[ingredient_id]]
+            ingredient_id = parent[ingredient_id]
+        return ingredient_id
+    for group in groups.values():
+        members = resolve_group(group, ingredients)
+        for ingredient_id in members:
+            parent.setdefault(ingredient_id, ingredient_id)
+        for ingredient_id in members[1:]:
+            parent[find(ingredient_id)] = find(members[0])
+    components = {}
+    for ingredient_id in parent:
+        components.setdefault(find(ingredient_id), set()).add(ingredient_id)
+    substitutes = {}
+    for component in components.values():
+        for ingredient_id in component:
+            if(len(component) > 1):
+                substitutes[ingredient_id] = frozenset(component - {ingredient_id})
+    return SubstitutionClosure(version, groups, substitutes, {ingredient_id: names[ingredient_id] for ingredient_id in parent})
+
+closures = VersionedCache()
+
+def get_closure():
+    """
+    Returns the substitution closure of the current catalog version. The
+    closure is rebuilt only when the catalog or the groups have changed
+    since it was last built.
+    Returns
+    -------
+    closure : SubstitutionClosure
+        The closure for the current catalog version.
+    """
+    version, = Data_Version.lookup('catalog')
+    groups = app.config['SUBSTITUTION_GROUPS']
+    # Equal groups resolve to the same closure, so they are part of the cached version.
+    return closures.get(lambda key: build_closure(version, groups), (version, groups))
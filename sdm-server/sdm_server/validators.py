@@ -2,7 +2,7 @@
 # Its primary purpose is to validate the data received by API
 # endpoints to ensure that requests are properly formatted
 # and contain all expected parameters and objects.
-from sdm_server import app, db, mail
+from sdm_server import app, catalog, db, mail, matches, measurements, resolver, shopping, similarity, substitutions, writebehind
 from sdm_server.models import *
 from functools import wraps
 from flask import request, jsonify
@@ -10,6 +10,9 @@ from flask_mail import Message
 from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime, timedelta
 from operator import itemgetter
+from heapq import merge
+from sqlalchemy import select, func, case, and_
+from sqlalchemy.exc import IntegrityError
 import jwt
 import uuid
 
@@ -176,9 +179,9 @@ def validate_and_reset(new_pass,token):
 
 def get_all_database_ingredients(user):
     """
-    This method queries the database for Ingredients and Custom_Ingredients and
-    returns a dictionary containing lists of all database ingredients. The lists
-    are sorted alphabetically.
+    This method lists the Ingredients of the catalog (see catalog.py) and the
+    User's Custom_Ingredients, and returns a dictionary containing lists of all
+    database ingredients. The lists are sorted alphabetically.
     Parameters
     ----------
     user : User
@@ -190,28 +193,16 @@ def get_all_database_ingredients(user):
         The two primary keys are 'default' and 'custom'
     """
     ingredients = {}
+    cabinet = get_user_ingredient_ids(user)
+    # User's cabinet ingredients will be added afterwards, so avoid
+    # duplicating the entries by only adding the ingredients not in the cabinet.
+    default_ingredients = [{'name': ingredient.display_name, 'type': ingredient.type, 'quantity': 0, 'favorite': "False"}
+                           for ingredient in catalog.get_catalog().sorted_ingredients if ingredient.id not in cabinet]
 
-    custom_ingredients = []
-    default_ingredients = []
-    for default_ingredient in Ingredients.query.all():
-        # User's cabinet ingredients will be added afterwards, so avoid
-        # duplicating the entries by only adding the ingredients not in the cabinet.
-        if(default_ingredient not in user.ingredients):
-            ingredient = {}
-            ingredient['name'] =  default_ingredient.name.capitalize()
-            ingredient['type'] = default_ingredient.ingredient_type.capitalize()
-            ingredient['quantity'] = 0
-            ingredient['favorite'] = "False"
-            default_ingredients.append(ingredient)
-    
     user_cabinet = get_all_user_ingredients(user)
-    if(user_cabinet.get('default')):
-        default_ingredients.extend(user_cabinet.get('default'))
-    if(user_cabinet.get('custom')):
-        custom_ingredients.extend(user_cabinet.get('custom'))
-    
-    ingredients['default'] = sorted(default_ingredients, key=itemgetter('name'))
-    ingredients['custom'] = sorted(custom_ingredients, key=itemgetter('name'))
+    # Both lists are sorted by name already.
+    ingredients['default'] = list(merge(default_ingredients, user_cabinet['default'], key=itemgetter('name')))
+    ingredients['custom'] = user_cabinet['custom']
     return ingredients
 
 def get_all_database_custom_ingredients(user):
@@ -242,7 +233,11 @@ def update_database_ingredients(user, name, quantity, isFavorite):
     matching 'name'. The method searches for 'name' in Ingredients (default)
     and Custom_Ingredients, updating the quantity and favorite as appropriate. The
     ingredient will be automatically added to the User's cabinet when the quantity
-    is increased above 0.
+    is increased above 0. A name that matches neither exactly is resolved to an
+    Ingredient by its folded name, see resolver.py. A name that is only a misspelling
+    away from an Ingredient is not updated, the Ingredient is suggested instead.
+    When write-behind is enabled, updates of Ingredients already in the cabinet
+    are buffered, see writebehind.py.
     Parameters
     ----------
     user : User
@@ -253,21 +248,46 @@ def update_database_ingredients(user, name, quantity, isFavorite):
         The quantity to update the ingredient with.
     isFavorite : str
         'True' if the ingredient is a favorite, 'False' otherwise.
+    Returns
+    -------
+    name : str
+        The name of the ingredient that was updated, or None if no ingredient matched.
+    suggested : str
+        The name of the closest Ingredient if no ingredient matched, or None.
     """
     is_favorite = isFavorite != 'False'
-    ingredient = Ingredients.query.filter_by(name=name.lower()).first()
+    ingredient = Ingredients.query.filter_by(name=normalize_name(name)).first()
+    suggested = None
+    # A name that is neither a default ingredient nor one of the user's custom
+    # ingredients may be a plural or respaced default ingredient.
+    if(not ingredient and not get_custom_inventory_entry(user, name)):
+        index = resolver.get_index()
+        match = index.resolve(name, fuzzy=False)
+        ingredient = Ingredients.query.get(match[0]) if match else None
+        # A misspelled name may be another ingredient altogether, so it is only suggested.
+        if(not match):
+            suggestion = index.resolve(name)
+            suggested = suggestion[1].capitalize() if suggestion else None
     # If the ingredient is not found, it is not a default ingredient and
     # the user's custom ingredients should be updated instead.
     if(not ingredient):
-        update_custom_database_ingredients(user, name, quantity, isFavorite)
+        return update_custom_database_ingredients(user, name, quantity, isFavorite), suggested
     else:
+        canonical = ingredient.name
         # If the user has previously updated the ingredient quantity or favorite, there
         # will be an existing relationship setup to track the association. Update the
         # association with new values.
         existing_ingredient = user.quantities.filter_by(owned_ingredient=ingredient).first()
+        # An update that does not change the cabinet can be buffered and written later.
+        if(existing_ingredient and writebehind.enabled() and ingredient.id in get_user_ingredient_ids(user)):
+            writebehind.buffer.add(user, ingredient.id, quantity, is_favorite)
+            return canonical.capitalize(), None
+        # Pending updates are written first, so that they do not overwrite this one.
+        writebehind.flush_user(user)
         if(existing_ingredient):
             existing_ingredient.quantity = quantity
             existing_ingredient.favorite = is_favorite
+            Data_Version.touch(Data_Version.user_scope(user))
             db.session.commit()
         # Otherwise, create the quantity and favorite association and assign the values
         # that were passed in to the method.
@@ -275,9 +295,11 @@ def update_database_ingredients(user, name, quantity, isFavorite):
             update = Inventory(quantity=quantity, favorite=is_favorite)
             update.owned_ingredient = ingredient
             user.quantities.append(update)
+            Data_Version.touch(Data_Version.user_scope(user))
             db.session.commit()
         # Finally, add the ingredient to the user's cabinet.
-        add_ingredients(user, [ingredient.name])   
+        add_ingredients(user, [canonical])
+        return canonical.capitalize(), None
 
 def update_custom_database_ingredients(user, name, quantity, isFavorite):
     """
@@ -292,41 +314,46 @@ def update_custom_database_ingredients(user, name, quantity, isFavorite):
         The update quantity of the custom ingredient.
     isFavorite : str
         'True' if the custom ingredient is a favorite, 'False' otherwise.
+    Returns
+    -------
+    name : str
+        The name of the custom ingredient that was updated, or None if the
+        User has no custom ingredient of that name.
     """
-    # Custom ingredients are only associated directly with User instances.
-    # The custom ingredient must have previously been created, otherwise no
-    # action will be taken by this method.
-    ingredient = user.custom_ingredients.filter_by(name=name.lower()).first()
-    if(ingredient):
-        ingredient.quantity = quantity
-        ingredient.is_favorite = isFavorite != 'False'
+    # Custom ingredients are shared, the quantity and favorite of each User are kept
+    # in the User's Custom_Inventory entry. The custom ingredient must have previously
+    # been added by the User, otherwise no action will be taken by this method.
+    entry = get_custom_inventory_entry(user, name)
+    if(entry):
+        canonical = entry.owned_ingredient.name
+        if(writebehind.enabled()):
+            writebehind.buffer.add(user, entry.ingredient, quantity, isFavorite != 'False', custom=True)
+            return canonical.capitalize()
+        writebehind.flush_user(user)
+        entry.quantity = quantity
+        entry.favorite = isFavorite != 'False'
+        Data_Version.touch(Data_Version.user_scope(user))
         db.session.commit()
+        return canonical.capitalize()
+    return None
     
 def get_all_database_recipes():
     """
-    This method queries the database for Recipes and returns
-    the query result sorted alphabetically.
+    This method lists every Recipe of the catalog (see catalog.py),
+    sorted alphabetically.
     Returns
     -------
     recipes : List
         A List of Dictionaries containing all database recipes, sorted alphabetically.
     """
-    output = []
-    for recipe in Recipe.query.all():
-        recipes = {}
-        recipes['name'] = recipe.name
-        recipes['instructions'] = recipe.instructions
-        recipes['ingredients'] = []
-        for ingredient in recipe.ingredients.all():
-            recipes['ingredients'].append(ingredient.name.capitalize())
-        output.append(recipes)
-    return sorted(output, key=itemgetter('name'))
+    return catalog.get_catalog().recipe_listings()
 
 def get_all_filtered_database_recipes(user):
     '''
     This method queries the database for Recipes with Ingredients
     that match the User's current Ingredients. Every Ingredient required
-    by the Recipe must be present in the User's Ingredients list.
+    by the Recipe must be present in the User's Ingredients list. The
+    matches are read from the user_recipe_match table, see matches.py.
     Parameters
     ----------
     user : User
@@ -336,29 +363,261 @@ def get_all_filtered_database_recipes(user):
     recipes : List
         A List of dictionaries containing all filtered Recipes, sorted alphabetically.
     '''
-    output = []
-    for recipe in Recipe.query.all():
-        required_ingredients = set(recipe.ingredients.all())
-        user_ingredients = user.ingredients.all()
-        recipes = {}
-        # Check if the Recipe's required ingredients are a subset of the
-        # ingredients in a User's cabinet. If True, every ingredient
-        # required by the Recipe is stored in the User's cabinet.
-        if(required_ingredients.issubset(user_ingredients)):
-            recipes['name'] = recipe.name
-            recipes['instructions'] = recipe.instructions
-            recipes['ingredients'] = []
-            for ingredient in required_ingredients:
-                recipes['ingredients'].append(ingredient.name.capitalize())
-            output.append(recipes)
-    return sorted(output, key=itemgetter('name'))
-        
+    return get_matching_recipes(matches.fully_matched_ids(user.id))
+
+def get_recipe_servings(user):
+    '''
+    This method computes how many servings of every Recipe the User can
+    currently make. Only Recipes whose Ingredients are all in the User's
+    cabinet are considered. The amounts parsed from the Recipe instructions
+    (see measurements.py) are compared against the quantities in the User's
+    Inventory.
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    Returns
+    -------
+    recipes : List
+        A List of dictionaries with the name and servings of each Recipe,
+        sorted alphabetically. The servings are None if no Ingredient of the
+        Recipe has both an amount and an Inventory quantity.
+    '''
+    records = catalog.get_catalog()
+    recipe_ids = matches.fully_matched_ids(user.id)
+    servings = measurements.get_servings(user.id, recipe_ids)
+    matched = {recipe_id for (recipe_id,) in db.session.execute(recipe_ids)}
+    return [{'name': recipe.name, 'servings': servings.get(recipe.id)} for recipe in records.find_recipes(matched)]
+
+def make_recipe(user, name):
+    '''
+    This method records that the User made one serving of a Recipe. Every
+    Ingredient of the Recipe must be in the User's cabinet, and the Inventory
+    quantity of every measured Ingredient must cover its amount (see
+    measurements.py), as counted by get_recipe_servings. Ingredients
+    without an Inventory entry have no quantity and are not decremented. The
+    quantities are decremented together in a single statement, or not at
+    all, so concurrent requests can not overdraw them.
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    name : str
+        The name of the Recipe.
+    Returns
+    -------
+    made : dict
+        The 'recipe' name and the 'ingredients' that were used up, sorted by name, each with
+        its 'name', the quantity 'used' and the remaining 'quantity'. None if the Recipe does
+        not exist.
+    missing : List
+        The Ingredients that are not in the cabinet or whose quantity is too low, sorted by
+        name, each with its 'name', the 'needed' quantity and the current 'quantity'. Empty
+        if the Recipe was made.
+    '''
+    records = catalog.get_catalog()
+    recipe = records.recipes.get(records.recipe_ids.get(name))
+    if(not recipe):
+        return None, []
+    cabinet = get_cabinet_keys(user)
+    absent = [ingredient_id for ingredient_id in recipe.ingredient_ids if ingredient_id not in cabinet]
+    if(absent):
+        return None, [{'name': records.ingredients[ingredient_id].display_name, 'needed': None, 'quantity': 0}
+                      for ingredient_id in absent]
+    savepoint = db.session.begin_nested()
+    used, decremented = measurements.consume(db.session, user.id, recipe.id)
+    inventory = Inventory.__table__
+    remaining = lambda: {ingredient_id: quantity for ingredient_id, quantity in db.session.execute(
+        select([inventory.c.ingredient, inventory.c.quantity])
+        .where(and_(inventory.c.user == user.id, inventory.c.ingredient.in_(sorted(used)))))}
+    # If a quantity was too low, possibly because another request used it up first, nothing is decremented.
+    if(decremented < len(used)):
+        savepoint.rollback()
+        quantities = remaining()
+        db.session.commit()
+        missing = [{'name': records.ingredients[ingredient_id].display_name, 'needed': needed,
+                    'quantity': quantities.get(ingredient_id, 0)}
+                   for ingredient_id, needed in used.items() if quantities.get(ingredient_id, 0) < needed]
+        return None, sorted(missing, key=itemgetter('name'))
+    savepoint.commit()
+    quantities = {}
+    if(used):
+        quantities = remaining()
+        Data_Version.touch(Data_Version.user_scope(user))
+    db.session.commit()
+    ingredients = [{'name': records.ingredients[ingredient_id].display_name, 'used': needed, 'quantity': quantities[ingredient_id]}
+                   for ingredient_id, needed in used.items()]
+    return {'recipe': recipe.name, 'ingredients': sorted(ingredients, key=itemgetter('name'))}, []
+
+def get_similar_recipes(name, limit):
+    '''
+    This method finds the Recipes whose Ingredients are most similar to
+    those of a Recipe. See similarity.py for the approximation.
+    Parameters
+    ----------
+    name : str
+        The name of the Recipe.
+    limit : int
+        The largest number of Recipes to return.
+    Returns
+    -------
+    recipes : List
+        A List of dictionaries containing the similar Recipes, most similar
+        first, each with its estimated 'similarity' between 0 and 1. None if
+        there is no Recipe with the name.
+    '''
+    records = catalog.get_catalog()
+    recipe_id = records.recipe_ids.get(name)
+    if(recipe_id is None):
+        return None
+    similar = dict(similarity.get_index().similar(recipe_id, limit))
+    recipes = []
+    for recipe in records.find_recipes(similar):
+        item = records.listing(recipe)
+        item['similarity'] = round(similar[recipe.id], 2)
+        recipes.append(item)
+    # The sort is stable, so equally similar Recipes stay in alphabetical order.
+    return sorted(recipes, key=lambda item: -item['similarity'])
+
+def get_recommendations(user, limit):
+    '''
+    This method recommends Recipes that the User cannot make yet, because
+    they are similar to Recipes that the User can make. Each recommended
+    Recipe is listed once, under the makeable Recipe it is most similar to.
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    limit : int
+        The largest number of makeable Recipes to list recommendations for.
+    Returns
+    -------
+    recommendations : List
+        A List of dictionaries with the name of a makeable Recipe in
+        'because' and the names and similarity of up to
+        SIMILARITY_GROUP_SIZE recommended Recipes in 'recipes'. The
+        makeable Recipes with the most similar recommendations come first.
+        Only the SIMILARITY_SOURCES makeable Recipes with the most
+        Ingredients are considered.
+    '''
+    records = catalog.get_catalog()
+    index = similarity.get_index()
+    matched = [records.recipes[recipe_id] for (recipe_id,) in db.session.execute(matches.fully_matched_ids(user.id))
+               if recipe_id in records.recipes]
+    counts = {recipe.id: len(recipe.ingredient_ids) for recipe in matched}
+    # Recipes with many Ingredients say the most about a User's taste, and looking up every
+    # makeable Recipe would not scale with large cabinets.
+    sources = sorted(counts, key=lambda recipe_id: (-counts[recipe_id], recipe_id))[:app.config['SIMILARITY_SOURCES']]
+    best = {}
+    for recipe_id in sources:
+        similar = index.similar(recipe_id, app.config['SIMILARITY_GROUP_SIZE'], app.config['SIMILARITY_THRESHOLD'], exclude=counts)
+        for candidate, score in similar:
+            # The similarity index may still list Recipes that were deleted since it was built.
+            if(candidate in records.recipes and score > best.get(candidate, (0.0, None))[0]):
+                best[candidate] = (score, recipe_id)
+    names = {recipe_id: records.recipes[recipe_id].name for recipe_id in set(best) | {because for _, because in best.values()}}
+    groups = {}
+    for candidate, (score, because) in best.items():
+        groups.setdefault(because, []).append({'name': names[candidate], 'similarity': round(score, 2)})
+    for recipes in groups.values():
+        recipes.sort(key=lambda item: (-item['similarity'], item['name']))
+    ranked = sorted(groups.items(), key=lambda group: (-group[1][0]['similarity'], names[group[0]]))
+    return [{'because': names[because], 'recipes': recipes[:app.config['SIMILARITY_GROUP_SIZE']]}
+            for because, recipes in ranked[:limit]]
+
+def get_shopping_list_suggestions(user, budget):
+    '''
+    This method suggests up to budget Ingredients, that are not in the
+    User's cabinet, which together make the most Recipes makeable. See
+    shopping.py for the optimization.
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    budget : int
+        The largest number of Ingredients to suggest.
+    Returns
+    -------
+    ingredients : List
+        A List of dictionaries with the name of each suggested Ingredient,
+        in the order they should be bought, and the names of the Recipes
+        that it makes makeable.
+    '''
+    records = catalog.get_catalog()
+    picks = shopping.optimize(shopping.get_index(), get_cabinet_keys(user), budget)
+    return [{'name': records.ingredients[ingredient_id].display_name,
+             'unlocks': sorted(records.recipes[recipe_id].name for recipe_id in completed)}
+            for ingredient_id, completed in picks]
+
+def get_shopping_list(user, recipe_names):
+    '''
+    This method builds the shopping list for a set of Recipes the User wants
+    to make. Every Ingredient that is missing from the User's cabinet is
+    listed once, together with the Recipes that need it. Ingredients in the
+    cabinet are listed as well if their Inventory quantity is smaller than
+    the total amount the Recipes need (see measurements.py). The Recipe
+    links are read with one query, the cabinet with its Inventory with
+    another, and the names come from the catalog (see catalog.py).
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    recipe_names : List
+        The names of the Recipes to shop for. Names that do not match a
+        Recipe are ignored.
+    Returns
+    -------
+    ingredients : dict
+        A dictionary mapping Ingredient types to the Ingredients to buy,
+        sorted alphabetically. Every Ingredient lists the Recipes that need
+        it, and the amount to buy if it is known.
+    '''
+    records = catalog.get_catalog()
+    recipe_ids = sorted({records.recipe_ids[name] for name in recipe_names if name in records.recipe_ids})
+    if(not recipe_ids):
+        return {}
+    rows = db.session.query(recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id,
+                            recipe_measurements.c.amount, recipe_measurements.c.unit) \
+                     .select_from(recipe_ingredients) \
+                     .outerjoin(recipe_measurements, and_(recipe_measurements.c.recipe_id == recipe_ingredients.c.recipe_id,
+                                                          recipe_measurements.c.ingredient_id == recipe_ingredients.c.ingredient_id)) \
+                     .filter(recipe_ingredients.c.recipe_id.in_(recipe_ids))
+    # The cabinet keys are read together with their Inventory quantities, None if there is none.
+    keys = cabinet_keys([user.id]).alias('cabinet')
+    quantities = dict(db.session.query(keys.c.ingredient_id, Inventory.quantity).select_from(keys)
+                                .outerjoin(Inventory, (Inventory.user == user.id) & (Inventory.ingredient == keys.c.ingredient_id)))
+    needed = {}
+    for recipe_id, ingredient_id, amount, unit in rows:
+        ingredient = records.ingredients.get(ingredient_id)
+        if(ingredient is None):
+            # Linked after the catalog was read; it is listed by the next request.
+            continue
+        item = needed.setdefault(ingredient_id, {'name': ingredient.display_name, 'type': ingredient.type,
+                                                 'recipes': [], 'amount': 0, 'unit': unit})
+        item['recipes'].append(records.recipes[recipe_id].name)
+        # The amount is only known if every Recipe measures the Ingredient in the same unit.
+        if(item['amount'] is not None and amount is not None and unit == item['unit']):
+            item['amount'] += amount
+        else:
+            item['amount'] = item['unit'] = None
+    shopping_list = {}
+    for ingredient_id, item in needed.items():
+        if(ingredient_id in quantities):
+            quantity = quantities[ingredient_id]
+            if(quantity is None or item['amount'] is None or item['amount'] <= quantity):
+                continue
+            item['amount'] -= quantity
+        item['recipes'].sort()
+        shopping_list.setdefault(item.pop('type'), []).append(item)
+    return {ingredient_type: sorted(items, key=itemgetter('name')) for ingredient_type, items in shopping_list.items()}
+
 def get_all_partial_match_recipes(user):
     '''
     This method queries the database for Recipes with Ingredients
     that partially match the User's current Ingredients.  At least one
     of the Ingredients required to make the the Recipe must be present 
-    in the User's Ingredients list.
+    in the User's Ingredients list. The matches are read from the
+    user_recipe_match table, see matches.py.
     Parameters
     ----------
     user : User
@@ -368,21 +627,71 @@ def get_all_partial_match_recipes(user):
     recipes : List
         A List containing all filtered Recipes, sorted alphabetically.
     '''
+    return get_matching_recipes(matches.partially_matched_ids(user.id))
+
+def get_substituted_recipes(user):
+    '''
+    This method queries the database for Recipes that the User can only make
+    by substituting Ingredients. Every Ingredient required by the Recipe must
+    be present in the User's Ingredients list, or have a substitute in it
+    (see substitutions.py), and at least one substitute must be needed.
+    Parameters
+    ----------
+    user : User
+        The User instance.
+    Returns
+    -------
+    recipes : List
+        A List of dictionaries containing the Recipes, sorted alphabetically.
+        Every Recipe has a 'substitutions' Dictionary that maps each missing
+        Ingredient to the cabinet Ingredient that replaces it.
+    '''
+    closure = substitutions.get_closure()
+    cabinet = get_cabinet_keys(user)
+    substitute_for = closure.cover(cabinet)
+    if(not substitute_for):
+        return []
+    # A Recipe qualifies when all of its Ingredients are covered by the
+    # cabinet or a substitute, and at least one of them is a substitute.
+    covered = recipe_ingredients.c.ingredient_id.in_(sorted(cabinet | set(substitute_for)))
+    substituted = case([(recipe_ingredients.c.ingredient_id.in_(sorted(substitute_for)), 1)], else_=0)
+    recipe_ids = select([Recipe.id]) \
+        .select_from(Recipe.__table__.join(recipe_ingredients, recipe_ingredients.c.recipe_id == Recipe.id)) \
+        .where(covered) \
+        .group_by(Recipe.id, Recipe.ingredient_count) \
+        .having(func.count() == Recipe.ingredient_count) \
+        .having(func.sum(substituted) > 0)
+    return get_matching_recipes(recipe_ids, substitute_for)
+
+def get_matching_recipes(recipe_ids, substitute_for=None):
+    """
+    This function lists the Recipes selected by a subquery. Only the ids
+    are read from the database, the Recipes and the names of their
+    Ingredients come from the catalog (see catalog.py).
+    Parameters
+    ----------
+    recipe_ids : Select
+        A select of Recipe ids, e.g. from Recipe.fully_matched_ids.
+    substitute_for : Dictionary
+        Optionally, the substitutes of a cabinet as returned by
+        SubstitutionClosure.cover. Each Recipe then gets a 'substitutions'
+        Dictionary of the Ingredients that were substituted.
+    Returns
+    -------
+    recipes : List
+        A List of dictionaries containing the Recipes, sorted alphabetically.
+    """
+    records = catalog.get_catalog()
+    matched = {recipe_id for (recipe_id,) in db.session.execute(recipe_ids)}
     output = []
-    for recipe in Recipe.query.all():
-        required_ingredients = recipe.ingredients.all()
-        user_ingredients = set(user.ingredients.all())
-        recipes = {}
-        # Check if at least 1 ingredient required by the Recipe is
-        # stored in the User's cabinet.
-        if(not user_ingredients.isdisjoint(required_ingredients)):
-            recipes['name'] = recipe.name
-            recipes['instructions'] = recipe.instructions
-            recipes['ingredients'] = []
-            for ingredient in required_ingredients:
-                recipes['ingredients'].append(ingredient.name.capitalize())
-            output.append(recipes)
-    return sorted(output, key=itemgetter('name'))
+    for recipe in records.find_recipes(matched):
+        item = records.listing(recipe)
+        if(substitute_for is not None):
+            item['substitutions'] = {records.ingredients[ingredient_id].display_name:
+                                     records.ingredients[substitute_for[ingredient_id]].display_name
+                                     for ingredient_id in recipe.ingredient_ids if ingredient_id in substitute_for}
+        output.append(item)
+    return output
 
 def get_all_user_ingredients(user):
     """
@@ -398,61 +707,147 @@ def get_all_user_ingredients(user):
         A Dictionary containing the User's ingredients, sorted alphabetically.
     """
     ingredients = {}
-    if(len(user.ingredients.all()) == 0 and len(user.custom_ingredients.all()) == 0):
-        ingredients['default'] = []
-        ingredients['custom'] = []
-        return ingredients
-    
+    records = catalog.get_catalog()
+    # The quantities and favorites are joined in with the cabinet ingredients, instead of
+    # being queried separately for every ingredient. Ingredients added to the cabinet
+    # without a quantity have no Inventory entry yet. The names come from the catalog.
+    cabinet = db.session.query(user_ingredients.c.ingredient_id, Inventory.quantity, Inventory.favorite) \
+                        .select_from(user_ingredients) \
+                        .outerjoin(Inventory, (Inventory.user == user.id) & (Inventory.ingredient == user_ingredients.c.ingredient_id)) \
+                        .filter(user_ingredients.c.user_id == user.id)
+
     default_ingredients = []
-    for ingredient in user.ingredients:
+    for ingredient_id, quantity, favorite in cabinet:
+        ingredient = records.ingredients.get(ingredient_id)
+        if(ingredient is None):
+            # Added to the catalog after it was read; it is listed by the next request.
+            continue
         current_ingredient = {}
-        inventory = user.quantities.filter_by(owned_ingredient=ingredient).first()
-        current_ingredient['name'] = ingredient.name.capitalize()
-        current_ingredient['type'] = ingredient.ingredient_type.capitalize()
-        current_ingredient['quantity'] = inventory.quantity
-        current_ingredient['favorite'] = str(inventory.favorite)
+        current_ingredient['name'] = ingredient.display_name
+        current_ingredient['type'] = ingredient.type
+        current_ingredient['quantity'] = quantity if quantity is not None else 0
+        current_ingredient['favorite'] = str(bool(favorite))
         default_ingredients.append(current_ingredient)
 
+    custom_cabinet = db.session.query(Custom_Ingredients, Custom_Inventory) \
+                               .join(Custom_Inventory, Custom_Inventory.ingredient == Custom_Ingredients.id) \
+                               .filter(Custom_Inventory.user == user.id)
+
     custom_ingredients = []
-    for ingredient in user.custom_ingredients:
+    for ingredient, entry in custom_cabinet:
         current_ingredient = {}
         current_ingredient['name'] = ingredient.name.capitalize()
         current_ingredient['type'] = ingredient.ingredient_type.capitalize()
-        current_ingredient['quantity'] = ingredient.quantity
-        current_ingredient['favorite'] = str(ingredient.is_favorite)
+        current_ingredient['quantity'] = entry.quantity
+        current_ingredient['favorite'] = str(entry.favorite)
         custom_ingredients.append(current_ingredient)
     
     ingredients['default'] = sorted(default_ingredients, key=itemgetter('name'))
     ingredients['custom'] = sorted(custom_ingredients, key=itemgetter('name'))
     return ingredients
 
+def get_user_ingredient_ids(user):
+    """
+    This function returns the ids of the Ingredients in a User's cabinet
+    with a single query.
+    Parameters
+    ----------
+    user : User
+        The User instance whose cabinet is queried.
+    Returns
+    -------
+    ingredient_ids : set
+        A set containing the id of every Ingredient in the User's cabinet.
+    """
+    rows = db.session.query(user_ingredients.c.ingredient_id).filter(user_ingredients.c.user_id == user.id)
+    return {ingredient_id for (ingredient_id,) in rows}
+
+def get_cabinet_keys(user):
+    """
+    This function returns the Ingredient keys of a User's cabinet with a
+    single query: the Ingredients in the cabinet, and the Ingredients that
+    the User's Custom Ingredients resolve to (see cabinet_keys). Recipes
+    are matched against these keys.
+    Parameters
+    ----------
+    user : User
+        The User instance whose cabinet is queried.
+    Returns
+    -------
+    ingredient_ids : set
+        A set containing the id of every Ingredient the cabinet covers.
+    """
+    return {row.ingredient_id for row in db.session.execute(cabinet_keys([user.id]))}
+
+def get_ingredients_by_name(names):
+    """
+    This function looks up the Ingredients matching a List of names with a
+    single query. Names are normalized with normalize_name before they are
+    matched; names that do not match an Ingredient are ignored.
+    Parameters
+    ----------
+    names : List
+        A List of Ingredient names.
+    Returns
+    -------
+    ingredients : List
+        A List of the matching Ingredients.
+    """
+    return Ingredients.query.filter(Ingredients.name.in_(sorted({normalize_name(name) for name in names}))).all()
+
 def add_ingredients(user, ingredients):
     """
     This function associates the passed-in List of Ingredients to
-    the passed in User instance. Each Ingredient in the List of
-    Ingredients must be valid and exist in the database, or it will
-    not be associated to the User instance.
+    the passed in User instance. Each name is resolved to an Ingredient
+    by its normalized or folded name (see resolver.py), names that resolve
+    to no Ingredient are not associated to the User instance. For those,
+    the closest Ingredient within a few edits is suggested instead.
     Parameters
     ----------
     user : User
         The User instance to add Ingredients to.
     ingredients : List
-        A List of Ingredients to add to the User.
-        Each Ingredient must exist in the database already.
+        A List of Ingredient names to add to the User.
     Returns
     -------
     message : str
         A String success message listing the Ingredients that were added or
         None otherwise.
+    resolved : Dictionary
+        Maps every name to the name of the Ingredient it resolved to, or to
+        None if it resolved to no Ingredient.
+    suggested : Dictionary
+        Maps the names that resolved to no Ingredient to the name of the
+        closest Ingredient, if there is one.
     """
     if (len(ingredients) == 0):
-        return None
-    for ingredient in ingredients:
-        user_ingredient = Ingredients.query.filter_by(name=ingredient.lower()).first()
-        if (user_ingredient and user_ingredient not in user.ingredients):
+        return None, {}, {}
+    found = {ingredient.name: ingredient for ingredient in get_ingredients_by_name(ingredients)}
+    matched = {name: normalize_name(name) if normalize_name(name) in found else None for name in ingredients}
+    # Only names without an exact match are resolved through the index.
+    unmatched = [name for name, match in matched.items() if match is None]
+    suggested = {}
+    if(unmatched):
+        index = resolver.get_index()
+        for name in unmatched:
+            match = index.resolve(name, fuzzy=False)
+            matched[name] = match[1] if match else None
+            # A misspelled name may be another ingredient altogether, so it is only suggested.
+            suggestion = index.resolve(name) if not match else None
+            if(suggestion):
+                suggested[name] = suggestion[1].capitalize()
+        missing = sorted({match for match in matched.values() if match and match not in found})
+        if(missing):
+            found.update((ingredient.name, ingredient) for ingredient in get_ingredients_by_name(missing))
+    cabinet = get_user_ingredient_ids(user)
+    for user_ingredient in found.values():
+        if (user_ingredient.id not in cabinet):
             user.ingredients.append(user_ingredient)
+            cabinet.add(user_ingredient.id)
+    Data_Version.touch(Data_Version.user_scope(user))
     db.session.commit()
-    return "Added {} to user cabinet.".format(', '.join(ingredients))
+    resolved = {name: match.capitalize() if match else None for name, match in matched.items()}
+    return "Added {} to user cabinet.".format(', '.join(ingredients)), resolved, suggested
 
 def delete_ingredients(user, ingredients):
     """
@@ -475,18 +870,73 @@ def delete_ingredients(user, ingredients):
     """
     if(len(ingredients) == 0):
         return None
-    for ingredient in ingredients:
-        user_ingredient = Ingredients.query.filter_by(name=ingredient.lower()).first()
-        if(user_ingredient and user_ingredient in user.ingredients):
+    cabinet = get_user_ingredient_ids(user)
+    for user_ingredient in get_ingredients_by_name(ingredients):
+        if(user_ingredient.id in cabinet):
             user.ingredients.remove(user_ingredient)
+            cabinet.discard(user_ingredient.id)
+    Data_Version.touch(Data_Version.user_scope(user))
     db.session.commit()
     return "Removed {} from user cabinet.".format(', '.join(ingredients))
 
+def get_custom_inventory_entry(user, name):
+    """
+    This function looks up the Custom_Inventory entry that associates a
+    Custom Ingredient to a User, by the name of the Custom Ingredient.
+    Parameters
+    ----------
+    user : User
+        The User instance that owns the custom ingredient.
+    name : str
+        The name of the custom ingredient.
+    Returns
+    -------
+    entry : Custom_Inventory
+        The entry, or None if the User has no custom ingredient of that name.
+    """
+    return user.custom_quantities.join(Custom_Ingredients, Custom_Ingredients.id == Custom_Inventory.ingredient) \
+                                 .filter(Custom_Ingredients.name == normalize_name(name)).first()
+
+def intern_custom_ingredient(name, typeof):
+    """
+    This function returns the shared Custom Ingredient with a name, creating
+    it with the given type if no User has added it yet.
+    Parameters
+    ----------
+    name : str
+        The name of the Custom Ingredient.
+    typeof : str
+        The type of the Custom Ingredient, used if it is created.
+    Returns
+    -------
+    custom_ingredient : Custom_Ingredients
+        The Custom Ingredient.
+    """
+    custom_ingredient = Custom_Ingredients.query.filter_by(name=normalize_name(name)).first()
+    if(custom_ingredient):
+        return custom_ingredient
+    # Another User can add the same name at the same time. The name is unique,
+    # so only one row is created and the other request uses it.
+    try:
+        with db.session.begin_nested():
+            custom_ingredient = Custom_Ingredients(name=normalize_name(name), ingredient_type=typeof)
+            db.session.add(custom_ingredient)
+    except IntegrityError:
+        # A plain read would use the snapshot of the transaction, which on MySQL (REPEATABLE READ)
+        # predates the other request's row. A locking read sees the latest committed rows.
+        custom_ingredient = Custom_Ingredients.query.filter_by(name=normalize_name(name)).with_for_update(read=True).one()
+    return custom_ingredient
+
 def insert_custom_ingredient(user, name, typeof):
     """
-    This method creates a Custom Ingredient and associates it to the 
-    passed in User instance. If the Custom Ingredient is already associated to
-    the User instance, then no action is taken and a JSON success message is returned.
+    This method associates a Custom Ingredient to the passed in User instance.
+    Custom Ingredients are shared between Users: if another User already
+    added a Custom Ingredient with the same name, the User is associated to
+    it and its type is kept, otherwise it is created. The response reports
+    the type of the Custom Ingredient, and says so if it is not the type
+    that was asked for. If the Custom Ingredient is already associated to
+    the User instance, then no action is taken and a JSON success message
+    is returned.
     Parameters
     ----------
     user : User
@@ -498,27 +948,33 @@ def insert_custom_ingredient(user, name, typeof):
     Returns
     -------
     message : JSON
-        A JSON formatted success message.
+        A JSON formatted success message, with the 'type' of the Custom
+        Ingredient if it was added.
     error : JSON
         A JSON formatted error message.
     """
-    custom_ingredient = user.custom_ingredients.filter_by(name=name.lower()).first()
-    default_ingredient = Ingredients.query.filter_by(name=name.lower()).first()
     # If the Custom Ingredient is already associated to the User, take no action.
-    if(custom_ingredient):
+    if(get_custom_inventory_entry(user, name)):
         return jsonify({"message": "'{}' already exists.".format(name)}), 200
     # If the Custom Ingredient matches the name of a default Ingredient, return an error.
-    if(default_ingredient):
+    if(Ingredients.query.filter_by(name=normalize_name(name)).first()):
         return jsonify({"error":"{} is a default ingredient and can not be added as a custom ingredient.".format(name)}), 401
-    else:
-        user.custom_ingredients.append(Custom_Ingredients(name=name.lower(), ingredient_type=typeof, quantity=0, is_favorite=False))
-        db.session.commit()
-        return jsonify({"message": "Added ingredient '{}' of type '{}'".format(name, typeof)}), 200
+    entry = Custom_Inventory(quantity=0, favorite=False)
+    entry.owned_ingredient = intern_custom_ingredient(name, typeof)
+    user.custom_quantities.append(entry)
+    Data_Version.touch(Data_Version.user_scope(user))
+    db.session.commit()
+    kept_type = entry.owned_ingredient.ingredient_type
+    message = "Added ingredient '{}' of type '{}'".format(name, kept_type)
+    if(kept_type.lower() != typeof.lower()):
+        message += ", the type it was first added with"
+    return jsonify({"message": message, "type": kept_type}), 200
 
 def delete_custom_ingredient(user, name):
     """
-    This method deletes the custom ingredient matching 'name' from the 
-    database, and removes it from the user's cabinet.
+    This method removes the custom ingredient matching 'name' from the
+    user's cabinet. The shared Custom Ingredient is kept for the other Users,
+    and for Users that add it again later.
     Parameters
     ----------
     user : User
@@ -526,16 +982,10 @@ def delete_custom_ingredient(user, name):
     name : str
         The name of the custom ingredient to delete.
     """
-    ingredient = user.custom_ingredients.filter_by(name=name.lower()).first()
-    db_ingredient = None
-    if(ingredient):
-        user.custom_ingredients.remove(ingredient)
-        # Find the custom ingredient by id, because other users can create 
-        # custom ingredients with the same name.
-        db_ingredient = Custom_Ingredients.query.filter_by(id=ingredient.id).first()
-    # If the custom ingredient exists in the database, remove it by id.
-    if(db_ingredient):
-        db.session.delete(db_ingredient)
+    entry = get_custom_inventory_entry(user, name)
+    if(entry):
+        db.session.delete(entry)
+        Data_Version.touch(Data_Version.user_scope(user))
     db.session.commit()
 
 def login_required(f):
@@ -561,17 +1011,39 @@ def login_required(f):
     """
     @wraps(f)
     def _verify(*args, **kwargs):
-        headers = request.headers.get('Authorization', '').split()
         invalid = {"message": "Invalid authentication token. Please log in and try again."}
-        if (len(headers) != 2):
+        user_uuid = decode_authorization_header(request.headers.get('Authorization', ''))
+        if not user_uuid:
             return jsonify(invalid), 401
-        try:
-            token = headers[1]
-            user_uuid = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])['sub']
-            user = User.query.filter_by(user_uuid=user_uuid).first()
-            if not user:
-                return jsonify(invalid), 401
-            return f(user, *args, **kwargs)
-        except (jwt.ExpiredSignatureError, jwt.InvalidTokenError) as e:
+        user = User.query.filter_by(user_uuid=user_uuid).first()
+        if not user:
             return jsonify(invalid), 401
+        # The User reads their own buffered updates, see writebehind.py.
+        if(request.endpoint not in writebehind.COALESCED_ENDPOINTS):
+            writebehind.flush_user(user)
+        return f(user, *args, **kwargs)
     return _verify
+
+def decode_authorization_header(header):
+    """
+    This function extracts the bearer JWT from an Authorization header
+    value and decodes it with the application's SECRET_KEY. It performs
+    no database access, so it is shared by the synchronous @login_required
+    decorator and the asynchronous endpoints in sdm_server.asgi.
+    Parameters
+    ----------
+    header : str
+        The raw value of the Authorization header, e.g. 'Bearer <token>'.
+    Returns
+    -------
+    user_uuid : str or None
+        The UUID of the User the token was issued to, or None if the header
+        is malformed or the token is expired or invalid.
+    """
+    headers = header.split()
+    if (len(headers) != 2):
+        return None
+    try:
+        return jwt.decode(headers[1], app.config['SECRET_KEY'], algorithms=['HS256'])['sub']
+    except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, KeyError):
+        return None
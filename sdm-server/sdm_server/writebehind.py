@@ -0,0 +1,301 @@
+# This file buffers the quantity and favorite updates of the cabinet, so
+# that rapid changes (every click of the quantity and favorite controls is a
+# PATCH /api/all-ingredients) are not committed one by one. Buffering is off
+# unless WRITE_BEHIND_ENABLED is set, e.g. with SDM_WRITE_BEHIND=1.
+#
+#     - Only updates of Ingredients that are in the User's cabinet and
+#       already have an Inventory (or Custom_Inventory) entry are buffered.
+#       Every other update changes the cabinet and is written right away.
+#     - A buffered update replaces the pending update of the same User and
+#       Ingredient, so only the latest value is written.
+#     - The pending updates are written every WRITE_BEHIND_SECONDS, in one
+#       transaction, by a background thread.
+#     - Any other request of a User first writes the User's pending updates
+#       (see validators.login_required), or waits for the writer thread if
+#       it is writing them, so Users read their own latest values and their
+#       later changes apply after the buffered ones.
+#     - The pending updates are written when the process exits, including on
+#       SIGTERM if the buffer was enabled when the server started.
+#
+# The buffer lives in the server process, so other processes would read
+# stale values until the updates are flushed. Buffering therefore refuses to
+# start with several worker processes (SERVER_WORKERS, from WEB_CONCURRENCY
+# like gunicorn and uvicorn) and next to the asynchronous read endpoints
+# (asgi.py). Updates are written with a session of their own, so that a
+# flush never commits the request's session. If the pending updates of a
+# User cannot be written before a request that reads them, the request
+# fails with 503 instead of returning stale values.
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+from flask import has_app_context, jsonify
+from sqlalchemy import and_, bindparam
+from sdm_server import app, db
+from sdm_server.metrics import Counter, Gauge
+from sdm_server.models import *
+
+app.config.setdefault('WRITE_BEHIND_ENABLED', os.environ.get('SDM_WRITE_BEHIND') == '1')
+# How long updates are coalesced before they are written.
+app.config.setdefault('WRITE_BEHIND_SECONDS', 1.0)
+# More pending updates than this are written without waiting for the interval.
+app.config.setdefault('WRITE_BEHIND_MAX_PENDING', 10000)
+# The number of processes serving the application; buffering requires a single one.
+app.config.setdefault('SERVER_WORKERS', int(os.environ.get('WEB_CONCURRENCY', 1)))
+
+# The endpoints whose updates are buffered; they do not flush the User's pending updates first.
+COALESCED_ENDPOINTS = ('update_ingredient',)
+
+log = logging.getLogger('sdm_server.writebehind')
+
+UPDATES = Counter('sdm_write_behind_updates_total', 'Cabinet updates buffered by the write-behind layer.')
+COALESCED = Counter('sdm_write_behind_coalesced_total', 'Buffered updates that replaced a pending update of the same ingredient.')
+FLUSHES = Counter('sdm_write_behind_flushes_total', 'Transactions that wrote buffered updates.', ['reason'])
+COMMITS_SAVED = Counter('sdm_write_behind_commits_saved_total', 'Commits saved by writing buffered updates together.')
+PENDING = Gauge('sdm_write_behind_pending', 'Buffered updates not written yet.')
+
+class WriteBehindError(Exception):
+    '''
+    The WriteBehindError class is raised when the pending updates of a User
+    could not be written before a request that reads them.
+    '''
+
+class WriteBehindBuffer:
+    '''
+    The WriteBehindBuffer class holds the pending cabinet updates of the
+    server process and writes them.
+
+    pending : Dictionary, Maps a User id to the (scope, updates, received) of the User: the
+              User's Data_Version scope, a Dictionary mapping (custom, ingredient_id) to the
+              latest (quantity, favorite), and the number of updates received since the last write.
+
+    size : int, The number of pending updates.
+
+    writing : set, The ids of the Users whose updates are taken out of pending and being written.
+
+    lock : Condition, Guards pending, size and writing, and wakes up the writer thread.
+
+    flush_lock : Lock, Held while pending updates are written, so that a User's request
+                 waits for the updates of the User that are being written.
+
+    thread : Thread, The writer thread, started with the first buffered update.
+    '''
+    def __init__(self):
+        self.pending = {}
+        self.size = 0
+        self.writing = set()
+        self.lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+
+    def add(self, user, ingredient_id, quantity, favorite, custom=False):
+        """
+        Buffers the quantity and favorite of an Ingredient in a User's cabinet.
+        Parameters
+        ----------
+        user : User
+            The User that owns the Ingredient.
+        ingredient_id : int
+            The primary key of the Ingredient, or of the Custom Ingredient if custom is True.
+        quantity : int
+            The new quantity.
+        favorite : bool
+            The new favorite flag.
+        custom : bool
+            True if the update is of a Custom_Inventory entry.
+        """
+        with self.lock:
+            scope, updates, received = self.pending.get(user.id, (Data_Version.user_scope(user), {}, 0))
+            key = (custom, ingredient_id)
+            if(key in updates):
+                COALESCED.inc()
+            else:
+                self.size += 1
+                PENDING.set(self.size)
+            updates[key] = (quantity, favorite)
+            self.pending[user.id] = (scope, updates, received + 1)
+            UPDATES.inc()
+            if(self.thread is None and not self.closed):
+                self.thread = threading.Thread(target=self.run, name='sdm-write-behind', daemon=True)
+                self.thread.start()
+            if(self.size > app.config['WRITE_BEHIND_MAX_PENDING']):
+                self.lock.notify()
+
+    def has_pending(self, user_id):
+        """
+        Returns True if a User has updates that are not written yet, including
+        updates that are being written by another thread.
+        """
+        with self.lock:
+            return user_id in self.pending or user_id in self.writing
+
+    def flush(self, reason, user_id=None):
+        """
+        Writes pending updates in one transaction.
+        Parameters
+        ----------
+        reason : str
+            Why the updates are written, reported as a metric label: 'interval', 'read' or 'shutdown'.
+        user_id : int
+            Optionally only write the updates of this User.
+        Returns
+        -------
+        written : int
+            The number of updates written.
+        Raises
+        ------
+        WriteBehindError
+            If the updates could not be written for a 'read'. They are kept and retried.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if(user_id is None):
+                    taken, self.pending = self.pending, {}
+                else:
+                    taken = {user_id: self.pending.pop(user_id)} if user_id in self.pending else {}
+                written = sum(len(updates) for _, updates, _ in taken.values())
+                self.size -= written
+                self.writing.update(taken)
+                PENDING.set(self.size)
+            if(not taken):
+                return 0
+            try:
+                if(has_app_context()):
+                    self.write(taken)
+                else:
+                    with app.app_context():
+                        self.write(taken)
+            except Exception as error:
+                log.exception("Writing %d buffered cabinet updates failed, they are retried.", written)
+                self.restore(taken)
+                if(reason == 'read'):
+                    raise WriteBehindError("Buffered cabinet updates could not be written.") from error
+                return 0
+            finally:
+                with self.lock:
+                    self.writing.difference_update(taken)
+            FLUSHES.inc(reason=reason)
+            COMMITS_SAVED.inc(sum(received for _, _, received in taken.values()) - 1)
+            return written
+
+    def write(self, taken):
+        """
+        Writes taken updates and touches the Data_Version of their Users, then commits. A
+        session of its own is used, so the session of the request that triggered the write
+        is neither committed nor rolled back. Writes happen before a request is routed to a
+        replica, or outside of requests, so they go to the primary database.
+        """
+        rows = {False: [], True: []}
+        for user_id, (scope, updates, _) in taken.items():
+            for (custom, ingredient_id), (quantity, favorite) in updates.items():
+                rows[custom].append({'owner': user_id, 'item': ingredient_id,
+                                     'new_quantity': quantity, 'new_favorite': favorite})
+        inventory = Inventory.__table__
+        session = db.session.session_factory()
+        try:
+            if(rows[False]):
+                session.execute(inventory.update()
+                                   .where(and_(inventory.c.user == bindparam('owner'), inventory.c.ingredient == bindparam('item')))
+                                   .values(quantity=bindparam('new_quantity'), favorite=bindparam('new_favorite')), rows[False])
+            if(rows[True]):
+                session.execute(custom_user_ingredients.update()
+                                   .where(and_(custom_user_ingredients.c.user_id == bindparam('owner'),
+                                               custom_user_ingredients.c.ingredient_id == bindparam('item')))
+                                   .values(quantity=bindparam('new_quantity'), favorite=bindparam('new_favorite')), rows[True])
+            for scope, _, _ in taken.values():
+                Data_Version.touch(scope, session)
+            session.commit()
+        finally:
+            session.close()
+
+    def restore(self, taken):
+        """
+        Puts taken updates back after a failed write. Updates received since are newer and kept.
+        """
+        with self.lock:
+            for user_id, (scope, updates, received) in taken.items():
+                _, newer, newer_received = self.pending.get(user_id, (scope, {}, 0))
+                restored = dict(updates)
+                restored.update(newer)
+                self.pending[user_id] = (scope, restored, received + newer_received)
+                self.size += len(restored) - len(newer)
+            PENDING.set(self.size)
+
+    def run(self):
+        """
+        Writes the pending updates every WRITE_BEHIND_SECONDS, or sooner if there are too many.
+        """
+        while(True):
+            with self.lock:
+                self.lock.wait(app.config['WRITE_BEHIND_SECONDS'])
+                if(self.closed):
+                    return
+            self.flush('interval')
+
+    def close(self):
+        """
+        Stops the writer thread and writes every pending update.
+        """
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if(self.thread is not None):
+            self.thread.join(timeout=app.config['WRITE_BEHIND_SECONDS'] + 5)
+        self.flush('shutdown')
+
+buffer = WriteBehindBuffer()
+atexit.register(buffer.close)
+
+def enabled():
+    """
+    Returns True if cabinet updates are buffered.
+    """
+    return app.config['WRITE_BEHIND_ENABLED']
+
+def require_single_process(reason=None):
+    """
+    Refuses to buffer updates where other processes serve the same Users,
+    as they would not read the buffered updates.
+    Parameters
+    ----------
+    reason : str
+        Why another process serves the Users, if it is known already.
+    Raises
+    ------
+    RuntimeError
+        If buffering is enabled but another process serves the Users.
+    """
+    if(reason is None and app.config['SERVER_WORKERS'] > 1):
+        reason = "{} worker processes are configured".format(app.config['SERVER_WORKERS'])
+    if(enabled() and reason):
+        raise RuntimeError("Write-behind (WRITE_BEHIND_ENABLED) only works with a single server process, "
+                           "but {}.".format(reason))
+
+@app.errorhandler(WriteBehindError)
+def write_behind_failed(error):
+    """
+    Answers a request whose User's pending updates could not be written.
+    """
+    return jsonify({"error": "Your latest cabinet changes could not be saved yet. Please try again."}), 503
+
+def flush_user(user):
+    """
+    Writes the pending updates of a User, if there are any, so that the
+    request that follows reads them.
+    """
+    if(buffer.has_pending(user.id)):
+        buffer.flush('read', user.id)
+
+def exit_on_sigterm(signum, frame):
+    """
+    Turns SIGTERM into a normal exit, so that the pending updates are written by the atexit handler.
+    """
+    sys.exit(128 + signum)
+
+require_single_process()
+if(enabled() and threading.current_thread() is threading.main_thread()
+        and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
@@ -1,15 +1,15 @@
 import unittest
 import tests
-import os
 import shutil
 
+# The tests use an in-memory database that is built once per run,
+# so there is no test database file to clean up afterwards.
 test_suite = unittest.TestLoader().discover('tests', pattern='test*')
 unittest.TextTestRunner(verbosity=2).run(test_suite)
 
 try:
-    print(">Deleting test database and cache")
-    os.remove('tests/test.db')
+    print(">Deleting test cache")
     shutil.rmtree('tests/__pycache__', ignore_errors=True)
 except:
-    print(">Could not automatically delete test database and cache.")
-    pass
\ No newline at end of file
+    print(">Could not automatically delete test cache.")
+    pass
@@ -0,0 +1,8 @@
+# The test modules import their helpers as top-level modules (fixtures,
+# query_budget), which is how 'python test.py' finds them through unittest
+# discovery. pytest imports the modules as part of the tests package, so the
+# test directory is put on the path here for it to find the helpers too.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,132 @@
+import csv
+import json
+import logging
+import os
+import unittest
+from sqlalchemy import event
+from sdm_server import app, db
+from sdm_server.models import *
+from query_budget import QueryBudgetMixin
+
+TESTS_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_fixture_rows():
+    '''
+    Reads the ingredient and recipe fixture files shipped with the tests.
+    '''
+    ingredients = []
+    recipes = []
+    with open(os.path.join(TESTS_ROOT, 'ingredients.csv'), newline='') as f:
+        reader = csv.reader(f, delimiter=',')
+        for line in reader:
+            if line not in ingredients:
+                ingredients.append([line[0], line[1], line[2], line[3]])
+
+    with open(os.path.join(TESTS_ROOT, 'Recipes.csv'), newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        for line in reader:
+            if line not in recipes:
+                recipes.append([line[0], line[1]])
+    return ingredients, recipes
+
+
+def build_database():
+    '''
+    Creates the schema and loads the fixtures into an in-memory SQLite
+    database, once per test process. Flask-SQLAlchemy serves in-memory
+    databases from a single shared connection, so the seeded data is
+    visible to every test. Because nothing is written to disk, test
+    processes are independent and the suite can run in parallel, e.g.
+    with 'python -m pytest -n auto tests' (pytest-xdist) from sdm-server.
+    '''
+    if getattr(build_database, 'built', False):
+        return
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'Not A Good Key'
+    # Keep the per-request log out of the test output.
+    logging.getLogger('sdm_server.requests').setLevel(logging.WARNING)
+
+    # pysqlite does not emit BEGIN itself and breaks SAVEPOINT support.
+    # Take over transaction control so that nested transactions work.
+    @event.listens_for(db.engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(db.engine, 'begin')
+    def emit_begin(connection):
+        connection.execute('BEGIN')
+
+    db.create_all()
+    ingredients, recipes = load_fixture_rows()
+    for ingredient in ingredients:
+        ing = Ingredients(name=ingredient[0].lower(), ingredient_type=ingredient[1].lower(), quantity=ingredient[2], is_favorite=eval(ingredient[3]))
+        db.session.add(ing)
+    for recipe in recipes:
+        rec = Recipe(name=recipe[0], instructions=recipe[1])
+        db.session.add(rec)
+    db.session.commit()
+    db.session.remove()
+    build_database.built = True
+
+
+class DatabaseTestCase(QueryBudgetMixin, unittest.TestCase):
+    '''
+    Base class for tests that use the database. The seeded schema is built
+    once per run; every test then runs inside a transaction that is rolled
+    back afterwards, so tests can commit freely without affecting each other.
+
+    The application's session is bound to a connection with an open
+    transaction and a SAVEPOINT. When the code under test commits or rolls
+    back, only the SAVEPOINT ends, and a new one is started immediately.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        build_database()
+        cls.ingredients, cls.recipes = load_fixture_rows()
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.nested = self.connection.begin_nested()
+        self.app_session = db.session
+        # The empty binds make every model use the test connection instead of the engine.
+        db.session = db.create_scoped_session(options={'bind': self.connection, 'binds': {}})
+
+        @event.listens_for(db.session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if not self.nested.is_active:
+                self.nested = self.connection.begin_nested()
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+
+    def get_authorization_header_token(self, username, password, email):
+        '''
+        Registers a User, logs in, and returns the Authorization header of the User.
+        '''
+        data = {"username": username, "password": password, "email": email}
+        self.client.post('/api/register', data=json.dumps(data), content_type='application/json')
+        response = self.client.post('/api/login', data=json.dumps({"loginId": username, "password": password}),
+                                    content_type='application/json')
+        return {"Authorization": "Bearer " + response.get_json().get('token')}
+
+    def add_ingredients(self, header, names):
+        '''
+        Adds Ingredients to the cabinet of the User of an Authorization header.
+        '''
+        return self.client.post('/api/user-ingredients', data=json.dumps({"ingredients": names}), headers=header,
+                                content_type='application/json')
+
+    def update_ingredient(self, header, name, quantity, favorite="False"):
+        '''
+        Updates the quantity and favorite of an Ingredient of the User of an Authorization header.
+        '''
+        data = {"name": name, "quantity": quantity, "isFavorite": favorite}
+        return self.client.patch('/api/all-ingredients', data=json.dumps(data), headers=header,
+                                 content_type='application/json')
@@ -0,0 +1,75 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from sqlalchemy import event
+from sdm_server import db
+
+# Transaction control statements are not queries. They are also emitted by the
+# test fixtures' SAVEPOINTs, which do not exist in production.
+TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT', 'COMMIT', 'ROLLBACK')
+
+class QueryRecorder:
+    '''
+    Records every SQL statement executed on the application's engine while
+    it is active. Statements are grouped by their SQL text, so that the same
+    statement executed many times with different parameters (the signature
+    of an N+1 query loop) can be detected.
+    '''
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(TRANSACTION_CONTROL):
+            self.statements.append((statement, parameters))
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def suspected_n_plus_one(self, threshold):
+        '''
+        Returns the statements that were executed at least 'threshold' times
+        with different parameters, mapped to the number of distinct parameter sets.
+        '''
+        parameters = defaultdict(set)
+        for statement, params in self.statements:
+            parameters[statement].add(repr(params))
+        return {statement: len(params) for statement, params in parameters.items() if len(params) >= threshold}
+
+    def report(self):
+        return '\n'.join('  {}. {} {}'.format(i + 1, ' '.join(statement.split()), params)
+                         for i, (statement, params) in enumerate(self.statements))
+
+
+class QueryBudgetMixin:
+    '''
+    A TestCase mixin that asserts how many SQL statements a block of code,
+    usually a single self.client call, is allowed to execute:
+
+        with self.assertMaxQueries(4):
+            self.client.get('/api/all-recipes', headers=header)
+
+    The block fails if it executes more than max_queries statements, or if
+    any statement is repeated with n_plus_one_threshold or more different
+    parameter sets, which is reported as a suspected N+1 query.
+    '''
+    @contextmanager
+    def assertMaxQueries(self, max_queries, n_plus_one_threshold=3):
+        with QueryRecorder(db.engine) as recorder:
+            yield recorder
+        suspects = recorder.suspected_n_plus_one(n_plus_one_threshold)
+        if suspects:
+            self.fail("Suspected N+1 queries:\n{}\nStatements executed:\n{}".format(
+                '\n'.join('  {} distinct parameter sets: {}'.format(count, ' '.join(statement.split()))
+                          for statement, count in suspects.items()),
+                recorder.report()))
+        if recorder.count > max_queries:
+            self.fail("{} SQL statements executed, the budget is {}:\n{}".format(
+                recorder.count, max_queries, recorder.report()))
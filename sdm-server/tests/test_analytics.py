@@ -0,0 +1,51 @@
+import unittest
+from sdm_server import db, analytics, jobs
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+@unittest.skipIf(analytics.np is None, "NumPy is not installed")
+class TestAnalytics(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ingredients = {name: Ingredients.query.filter_by(name=name).first() for name in ("acai", "ackee", "ade", "ice")}
+        recipes = {recipe.name: recipe for recipe in Recipe.query}
+        for ingredient, recipe in (("acai", "Mango Bliss"), ("ackee", "Mango Bliss"), ("ackee", "Acai-Peanut Protein"),
+                                   ("ade", "Strawberry Madness"), ("ice", "Strawberry Madness"), ("ice", "Peanut Butter Blast")):
+            self.ingredients[ingredient].used_in.append(recipes[recipe])
+        db.session.commit()
+        for username, cabinet in (("first", ["Acai", "Ice"]), ("second", ["Ackee", "Ade"]), ("third", [])):
+            header = self.get_authorization_header_token(username, "pass", username)
+            self.add_ingredients(header, cabinet)
+
+    def test_analyze(self):
+        result = analytics.analyze(db.session, chunk_cells=1)
+        recipe_ids = result.recipe_ids.tolist()
+        names = {recipe.id: recipe.name for recipe in Recipe.query}
+        makers = {names[recipe_id]: count for recipe_id, count in zip(recipe_ids, result.makers.tolist())}
+
+        print("\n>Running test for the makers of every recipe matching the recipe listings.")
+        users = User.query.all()
+        for recipe_id in recipe_ids:
+            expected = sum(recipe_id in {i for (i,) in db.session.execute(Recipe.fully_matched_ids(user.id))} for user in users)
+            self.assertEqual(makers[names[recipe_id]], expected)
+        self.assertEqual((makers["Mango Bliss"], makers["Acai-Peanut Protein"], makers["Peanut Butter Blast"]), (0, 1, 1))
+
+        print(">Running test for the ingredients that would complete a recipe.")
+        unlocks = {Ingredients.query.get(ingredient_id).name: (count, users) for ingredient_id, count, users in
+                   zip(result.ingredient_ids.tolist(), result.unlocks.tolist(), result.unlocked_users.tolist()) if count}
+        # first misses ackee twice and ade once, second misses acai once and ice twice, third misses ackee and ice once.
+        self.assertEqual(unlocks, {"ackee": (3, 2), "acai": (1, 1), "ade": (1, 1), "ice": (3, 2)})
+
+        print(">Running test for the makeable count distribution.")
+        empty = sum(1 for recipe in Recipe.query if recipe.ingredients.count() == 0)
+        self.assertEqual(result.distribution(), [(empty, 1), (empty + 1, 2)])
+
+        print(">Running test for sharded analytics matching the single pass.")
+        sharded, timings = jobs.run_sharded(analytics.analyze_shard, analytics.MatchAnalytics.merge,
+                                            analytics.build_index(db.session), workers=1, shard_size=2)
+        self.assertEqual(len(timings), 2)
+        self.assertEqual(sharded.user_ids.tolist(), result.user_ids.tolist())
+        for name in ('makers', 'one_away', 'makeable', 'unlocks', 'unlocked_users'):
+            self.assertEqual(getattr(sharded, name).tolist(), getattr(result, name).tolist())
+
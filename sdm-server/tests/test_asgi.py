@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+from sdm_server import asgi
+
+
+class TestAsgi(unittest.TestCase):
+    def request(self, scope, messages=()):
+        """
+        Runs the ASGI application on one connection and returns the messages it sent.
+        """
+        received = list(messages)
+        sent = []
+        async def receive():
+            return received.pop(0)
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi.application(scope, receive, send))
+        return sent
+
+    def http(self, method, path, headers=()):
+        return self.request({'type': 'http', 'method': method, 'path': path, 'headers': list(headers)})
+
+    def test_head(self):
+        print("\n>Running test for HEAD responses without a body.")
+        start, body = self.http('HEAD', '/api/unknown')
+        self.assertEqual(start['status'], 404)
+        self.assertIn((b'content-length', str(len(b'{"message": "Not found"}')).encode('ascii')), start['headers'])
+        self.assertEqual(body['body'], b'')
+
+    def test_preflight(self):
+        print("\n>Running test for answering CORS preflight requests.")
+        start, body = self.http('OPTIONS', '/api/all-recipes', [(b'origin', b'http://localhost:3000'),
+                                                                 (b'access-control-request-method', b'GET'),
+                                                                 (b'access-control-request-headers', b'authorization')])
+        headers = dict(start['headers'])
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(headers[b'access-control-allow-origin'], b'http://localhost:3000')
+        self.assertEqual(headers[b'access-control-allow-headers'], b'authorization')
+        self.assertIn(b'GET', headers[b'access-control-allow-methods'])
+
+        print(">Running test for not allowing other origins.")
+        start, _ = self.http('OPTIONS', '/api/all-recipes', [(b'origin', b'http://example.com')])
+        self.assertNotIn(b'access-control-allow-origin', dict(start['headers']))
+
+    def test_other_scopes(self):
+        print("\n>Running test for refusing WebSocket connections.")
+        sent = self.request({'type': 'websocket', 'path': '/api/all-recipes', 'headers': []}, [{'type': 'websocket.connect'}])
+        self.assertEqual(sent, [{'type': 'websocket.close'}])
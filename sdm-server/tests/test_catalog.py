@@ -0,0 +1,76 @@
+import threading
+import unittest
+from flask import g
+from sqlalchemy import create_engine
+from sdm_server import app, db, catalog
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestVersionedCache(unittest.TestCase):
+    def test_sources(self):
+        print("\n>Running test for values being rebuilt only when the version changes.")
+        cache = catalog.VersionedCache()
+        built = []
+        build = lambda version: built.append(version) or version
+        self.assertEqual([cache.get(build, 1), cache.get(build, 1), cache.get(build, 2)], [1, 1, 2])
+        self.assertEqual(built, [1, 2])
+
+        print(">Running test for every replica keeping a value of its own.")
+        with app.test_request_context():
+            g.read_replica = create_engine('sqlite:///replica.db')
+            self.assertEqual(cache.get(build, 1), 1)
+        self.assertEqual(cache.get(build, 2), 2)
+        self.assertEqual(built, [1, 2, 1])
+
+    def test_background(self):
+        print("\n>Running test for the previous value being returned while the next one is built.")
+        cache = catalog.VersionedCache()
+        release = threading.Event()
+        background = lambda version: lambda: release.wait() and version
+        self.assertEqual(cache.get(lambda version: version, 1, background), 1)
+        self.assertEqual(cache.get(lambda version: version, 2, background), 1)
+        release.set()
+        cache.wait()
+        self.assertEqual(cache.get(lambda version: version, 2, background), 2)
+
+
+class TestCatalog(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        recipe = Recipe.query.filter_by(name="Mango Bliss").first()
+        for name in ("yogurt", "acai", "lime"):
+            recipe.ingredients.append(Ingredients.query.filter_by(name=name).first())
+        db.session.commit()
+
+    def test_records(self):
+        print("\n>Running test for the slotted records of the catalog.")
+        records = catalog.get_catalog()
+        recipe = records.recipes[records.recipe_ids["Mango Bliss"]]
+        self.assertEqual(recipe.ingredient_names, ("Acai", "Lime", "Yogurt"))
+        self.assertFalse(hasattr(recipe, '__dict__'))
+        apple, banana = (records.ingredients[Ingredients.query.filter_by(name=name).first().id] for name in ("apple", "banana"))
+        self.assertEqual((apple.display_name, apple.type), ("Apple", "Fruit"))
+        self.assertIs(apple.type, banana.type)
+
+        print(">Running test for the catalog being sorted.")
+        names = [recipe.name for recipe in records.sorted_recipes]
+        self.assertEqual(names, sorted(names))
+        names = [ingredient.display_name for ingredient in records.sorted_ingredients]
+        self.assertEqual(names, sorted(names))
+
+    def test_catalog_version(self):
+        print("\n>Running test for reusing the catalog while it is unchanged.")
+        records = catalog.get_catalog()
+        self.assertIs(catalog.get_catalog(), records)
+
+        print(">Running test for reading the catalog again after a change.")
+        Recipe.query.filter_by(name="Mango Bliss").first().ingredients.append(Ingredients.query.filter_by(name="apple").first())
+        db.session.commit()
+        records = catalog.get_catalog()
+        self.assertEqual(records.recipes[records.recipe_ids["Mango Bliss"]].ingredient_names, ("Acai", "Apple", "Lime", "Yogurt"))
+        response = self.client.get('/api/all-recipes', headers=self.header)
+        recipe = next(recipe for recipe in response.get_json()['recipes'] if recipe['name'] == "Mango Bliss")
+        self.assertEqual(recipe['ingredients'], ["Acai", "Apple", "Lime", "Yogurt"])
+
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sdm_server import app, db
+from sdm_server.metrics import InstrumentedQueuePool, render_metrics
+
+
+class TestEngineProfiles(unittest.TestCase):
+    def create_engine(self, uri):
+        url = make_url(uri)
+        options = {}
+        db.apply_driver_hacks(app, url, options)
+        return db.create_engine(url, options)
+
+    def test_sqlite_file_profile(self):
+        workdir = tempfile.mkdtemp()
+        engine = self.create_engine('sqlite:///' + os.path.join(workdir, 'profile.db'))
+        try:
+            self.assertIsInstance(engine.pool, InstrumentedQueuePool)
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)
+                self.assertEqual(connection.execute('PRAGMA busy_timeout').scalar(), 5000)
+                metrics = render_metrics()
+                self.assertIn('sdm_db_pool_checked_out{database="profile.db"} 1', metrics)
+                self.assertIn('sdm_db_pool_checkout_wait_seconds_count{database="profile.db"} 1', metrics)
+            self.assertIn('sdm_db_pool_saturation{database="profile.db"} 0.0', render_metrics())
+        finally:
+            engine.dispose()
+
+    def test_sqlite_memory_profile(self):
+        engine = self.create_engine('sqlite://')
+        self.assertNotIsInstance(engine.pool, InstrumentedQueuePool)
+        engine.dispose()
+
+    def test_failed_statement_timer(self):
+        print("\n>Running test for failed statements not leaving their start time on the connection.")
+        engine = self.create_engine('sqlite://')
+        with engine.connect() as connection:
+            for _ in range(3):
+                with self.assertRaises(OperationalError):
+                    connection.execute('SELECT * FROM missing_table')
+            self.assertEqual(connection.execute('SELECT 1').scalar(), 1)
+            self.assertEqual(connection.info['query_start'], {})
+        engine.dispose()
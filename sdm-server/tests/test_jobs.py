@@ -0,0 +1,30 @@
+import unittest
+from sdm_server import jobs
+
+
+def sum_shard(shared, user_ids):
+    return {'users': len(user_ids), 'total': sum(user_ids) * shared}
+
+def merge_sums(result, shard_result):
+    return {key: result[key] + shard_result[key] for key in result}
+
+
+class TestJobs(unittest.TestCase):
+    def test_shards(self):
+        print("\n>Running test for splitting users into shards of consecutive ids.")
+        self.assertEqual(jobs.get_shards([5, 1, 4, 2, 3], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(jobs.get_shards([], 2), [])
+
+    def test_run_sharded(self):
+        for workers in (1, 2):
+            print("\n>Running test for merging the shard results of {} worker(s).".format(workers))
+            progress = []
+            result, timings = jobs.run_sharded(sum_shard, merge_sums, 10, user_ids=range(1, 11), workers=workers,
+                                               shard_size=3, progress=lambda *args: progress.append(args[1:]))
+            self.assertEqual(result, {'users': 10, 'total': 550})
+            self.assertEqual(sorted(timing.index for timing in timings), [0, 1, 2, 3])
+            self.assertEqual(sorted(timing.users for timing in timings), [1, 3, 3, 3])
+            self.assertEqual(progress, [(1, 4), (2, 4), (3, 4), (4, 4)])
+
+        print(">Running test for a job without users.")
+        self.assertEqual(jobs.run_sharded(sum_shard, merge_sums, 10, user_ids=[], workers=2), (None, []))
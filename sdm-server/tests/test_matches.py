@@ -0,0 +1,142 @@
+import json
+from sqlalchemy.dialects import mysql, sqlite
+from sdm_server import db, matches
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestMatches(DatabaseTestCase):
+    '''
+    Tests for the materialized user_recipe_match table. Every change is
+    made through the API or the session, and the table is then compared
+    against the live matching with matches.check.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        self.user_id = User.query.filter_by(username="user").first().id
+        acai, ackee, ade = [Ingredients.query.filter_by(name=name).first() for name in ("acai", "ackee", "ade")]
+        mango = Recipe.query.filter_by(name="Mango Bliss").first()
+        strawberry = Recipe.query.filter_by(name="Strawberry Madness").first()
+        acai.used_in.append(mango)
+        ackee.used_in.append(mango)
+        ackee.used_in.append(strawberry)
+        ade.used_in.append(strawberry)
+        db.session.commit()
+        self.mango, self.strawberry = mango.id, strawberry.id
+
+    def stored_counts(self):
+        rows = db.session.execute(user_recipe_match.select().where(user_recipe_match.c.user_id == self.user_id))
+        return {row.recipe_id: row.matched_count for row in rows}
+
+    def test_cabinet_changes(self):
+        print("\n>Running test for adding an ingredient bumping the recipes that use it.")
+        self.add_ingredients(self.header, ["Ackee"])
+        self.assertEqual(self.stored_counts(), {self.mango: 1, self.strawberry: 1})
+        self.add_ingredients(self.header, ["Acai", "Ade"])
+        self.assertEqual(self.stored_counts(), {self.mango: 2, self.strawberry: 2})
+        self.assertEqual(matches.check(db.session), [])
+
+        print(">Running test for removing an ingredient lowering the recipes that use it.")
+        self.client.delete('/api/user-ingredients', data=json.dumps({"ingredients": ["Ackee", "Ade"]}),
+                           headers=self.header, content_type='application/json')
+        self.assertEqual(self.stored_counts(), {self.mango: 1})
+        self.assertEqual(matches.check(db.session), [])
+
+    def test_concurrent_inserts(self):
+        print("\n>Running test for new rows being inserted without failing on a row a concurrent change inserted.")
+        statements = []
+
+        class Recorder:
+            def execute(self, statement):
+                statements.append(statement)
+        matches.apply_cabinet_change(Recorder(), self.user_id, [1], 1)
+        self.assertTrue(str(statements[0].compile(dialect=sqlite.dialect())).startswith("INSERT OR IGNORE INTO user_recipe_match"))
+        self.assertTrue(str(statements[0].compile(dialect=mysql.dialect())).startswith("INSERT IGNORE INTO user_recipe_match"))
+
+    def test_recipe_changes(self):
+        self.add_ingredients(self.header, ["Acai", "Ackee"])
+
+        print("\n>Running test for recipe ingredient changes being recomputed.")
+        ade = Ingredients.query.filter_by(name="ade").first()
+        mango = Recipe.query.filter_by(name="Mango Bliss").first()
+        ade.used_in.append(mango)
+        db.session.commit()
+        self.assertEqual(self.stored_counts()[self.mango], 2)
+        self.assertEqual(matches.check(db.session), [])
+
+        print(">Running test for deleted ingredients and recipes.")
+        db.session.delete(Ingredients.query.filter_by(name="ackee").first())
+        db.session.delete(Recipe.query.filter_by(name="Strawberry Madness").first())
+        db.session.commit()
+        self.assertEqual(self.stored_counts(), {self.mango: 1})
+        self.assertEqual(matches.check(db.session), [])
+
+    def test_check_and_rebuild(self):
+        self.add_ingredients(self.header, ["Acai"])
+        db.session.execute(user_recipe_match.update().values(matched_count=5))
+
+        print("\n>Running test for the checker reporting a stale table.")
+        problems = matches.check(db.session, [self.user_id])
+        self.assertEqual([(problem['recipe_id'], problem['stored'], problem['expected']) for problem in problems
+                          if problem['problem'] == 'matched_count'], [(self.mango, 5, 1)])
+
+        print(">Running test for the rebuild repairing the table.")
+        matches.rebuild(db.session, user_ids=[self.user_id])
+        self.assertEqual(matches.check(db.session), [])
+
+    def test_custom_ingredients(self):
+        print("\n>Running test for custom ingredients satisfying recipes once the catalog has their name.")
+        self.add_ingredients(self.header, ["Acai", "Ackee"])
+        self.client.post('/api/custom-ingredients', data=json.dumps({'name': " Dragon  Fruit", 'type': "Fruit"}),
+                         headers=self.header, content_type='application/json')
+        dragon_fruit = Ingredients(name="dragon fruit", ingredient_type="fruit", quantity=0, is_favorite=False)
+        dragon_fruit.used_in.append(Recipe.query.filter_by(name="Mango Bliss").first())
+        db.session.add(dragon_fruit)
+        db.session.commit()
+        self.assertEqual(self.stored_counts()[self.mango], 3)
+        response = self.client.get('/api/filtered-recipes', headers=self.header)
+        self.assertIn("Mango Bliss", [recipe['name'] for recipe in response.get_json()['recipes']])
+        self.assertEqual(matches.check(db.session), [])
+
+        print(">Running test for an ingredient and a custom ingredient of the same name counting once.")
+        self.add_ingredients(self.header, ["Dragon fruit"])
+        self.assertEqual(self.stored_counts()[self.mango], 3)
+        self.client.delete('/api/user-ingredients', data=json.dumps({"ingredients": ["Dragon fruit"]}),
+                           headers=self.header, content_type='application/json')
+        self.assertEqual(self.stored_counts()[self.mango], 3)
+        self.assertEqual(matches.check(db.session), [])
+
+        print(">Running test for deleting the custom ingredient.")
+        self.client.delete('/api/custom-ingredients', data=json.dumps({'name': "dragon fruit"}),
+                           headers=self.header, content_type='application/json')
+        self.assertEqual(self.stored_counts()[self.mango], 2)
+        self.assertEqual(matches.check(db.session), [])
+
+    def test_custom_only_ingredients(self):
+        print("\n>Running test for a custom ingredient that is not in the catalog completing a recipe.")
+        self.add_ingredients(self.header, ["Acai", "Ackee"])
+        self.client.post('/api/custom-ingredients', data=json.dumps({'name': "Dragon fruit", 'type': "Fruit"}),
+                         headers=self.header, content_type='application/json')
+        other = self.get_authorization_header_token("other", "pass", "other email")
+        self.add_ingredients(other, ["Acai", "Ackee"])
+        dragon_fruit = Custom_Ingredients.query.filter_by(name="dragon fruit").first()
+        dragon_fruit.used_in.append(Recipe.query.filter_by(name="Mango Bliss").first())
+        db.session.commit()
+        key_id = dragon_fruit.key_id
+        self.assertIsNone(Ingredients.query.filter_by(name="dragon fruit").first())
+        self.assertEqual(self.stored_counts()[self.mango], 3)
+        response = self.client.get('/api/filtered-recipes', headers=self.header)
+        recipes = {recipe['name']: recipe for recipe in response.get_json()['recipes']}
+        self.assertIn("Mango Bliss", recipes)
+        self.assertIn("Dragon fruit", recipes["Mango Bliss"]['ingredients'])
+        response = self.client.get('/api/filtered-recipes', headers=other)
+        self.assertNotIn("Mango Bliss", [recipe['name'] for recipe in response.get_json()['recipes']])
+        self.assertEqual(matches.check(db.session), [])
+
+        print(">Running test for an ingredient added under the name of a custom ingredient sharing its key.")
+        db.session.add(Ingredients(name="dragon fruit", ingredient_type="fruit", quantity=0, is_favorite=False))
+        db.session.commit()
+        self.assertEqual(Ingredients.query.filter_by(name="dragon fruit").first().id, key_id)
+        self.assertEqual(self.stored_counts()[self.mango], 3)
+        self.assertEqual(matches.check(db.session), [])
@@ -0,0 +1,196 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from sqlalchemy import create_engine, select
+from sdm_server import db, measurements
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_instructions(self):
+        print("\n>Running test for parsing amounts and units from instructions.")
+        ingredients = {1: "ice", 2: "papaya juice", 3: "strawberry", 4: "strawberry syrup"}
+        parsed = measurements.parse_instructions(
+            "Blend 1/4 cup Ice, 1/2 cup papaya juice, 1 cup Strawberries, and 2 TBSP Strawberry syrup.", ingredients)
+        self.assertEqual(parsed, {1: (0.25, 'cup'), 2: (0.5, 'cup'), 3: (1.0, 'cup'), 4: (0.125, 'cup')})
+
+        print(">Running test for shared amounts, trailing units and unmeasured ingredients.")
+        ingredients = {1: "vanilla yogurt", 2: "milk", 3: "mango", 4: "sugar", 5: "ice"}
+        parsed = measurements.parse_instructions(
+            "Blend 5 Mango slices, 1 1/2 cups each vanilla yogurt and milk, 1 cup ice, and sugar to taste.", ingredients)
+        self.assertEqual(parsed, {1: (1.5, 'cup'), 2: (1.5, 'cup'), 3: (5.0, 'piece'), 5: (1.0, 'cup')})
+
+
+class TestServings(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        mango = Recipe.query.filter_by(name="Mango Bliss").first()
+        ingredients = [Ingredients.query.filter_by(name=name).first() for name in ("mango", "orange juice", "ice")]
+        for ingredient in ingredients:
+            ingredient.used_in.append(mango)
+        db.session.commit()
+        self.mango = mango.id
+
+    def test_measurements_are_stored(self):
+        print("\n>Running test for measurements being stored when a recipe is linked.")
+        rows = db.session.execute(recipe_measurements.select().where(recipe_measurements.c.recipe_id == self.mango))
+        amounts = {Ingredients.query.get(row.ingredient_id).name: (row.amount, row.unit) for row in rows}
+        self.assertEqual(amounts, {"mango": (5.0, 'piece'), "orange juice": (0.25, 'piece'), "ice": (1.0, 'cup')})
+
+        print(">Running test for measurements being parsed again when instructions change.")
+        mango = Recipe.query.get(self.mango)
+        mango.instructions = "Blend 10 Mango slices, 1/4 Orange juice, and 1 cup ice."
+        db.session.commit()
+        amount = db.session.execute(recipe_measurements.select().where(
+            recipe_measurements.c.ingredient_id == Ingredients.query.filter_by(name="mango").first().id)).first().amount
+        self.assertEqual(amount, 10.0)
+
+    def test_recipe_servings(self):
+        for name, quantity in (("Mango", 12), ("Orange juice", 2), ("Ice", 3)):
+            self.update_ingredient(self.header, name, quantity)
+
+        print("\n>Running test for servings limited by the scarcest ingredient.")
+        self.assertEqual(self.get_servings()["Mango Bliss"], 2)
+
+        print(">Running test for servings counted in the exact amounts a serving uses.")
+        self.update_ingredient(self.header, "Orange juice", 0.75)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 2)
+        self.update_ingredient(self.header, "Orange juice", 0.3)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 1)
+        self.update_ingredient(self.header, "Orange juice", 2)
+
+        print(">Running test for servings following inventory changes.")
+        self.update_ingredient(self.header, "Ice", 1)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 1)
+        self.update_ingredient(self.header, "Mango", 4)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 0)
+
+    def test_make_recipe(self):
+        for name, quantity in (("Mango", 12), ("Orange juice", 1), ("Ice", 3)):
+            self.update_ingredient(self.header, name, quantity)
+
+        print("\n>Running test for decrementing the cabinet by the exact amounts when a recipe is made.")
+        response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'recipe': "Mango Bliss", 'ingredients': [
+            {'name': "Ice", 'used': 1, 'quantity': 2},
+            {'name': "Mango", 'used': 5, 'quantity': 7},
+            {'name': "Orange juice", 'used': 0.25, 'quantity': 0.75}]})
+
+        print(">Running test for decrementing nothing when a quantity is too low.")
+        self.update_ingredient(self.header, "Orange juice", 0.2)
+        response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['missing'], [{'name': "Orange juice", 'needed': 0.25, 'quantity': 0.2}])
+        self.assertEqual(self.get_quantities(), {"mango": 7, "orange juice": 0.2, "ice": 2})
+
+        print(">Running test for making a recipe with an ingredient missing from the cabinet.")
+        self.client.delete('/api/user-ingredients', data=json.dumps({"ingredients": ["Ice"]}), headers=self.header,
+                           content_type='application/json')
+        self.update_ingredient(self.header, "Orange juice", 1)
+        response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['missing'], [{'name': "Ice", 'needed': None, 'quantity': 0}])
+
+        print(">Running test for making a recipe that does not exist.")
+        response = self.client.post('/api/recipes/Not A Recipe/make', headers=self.header)
+        self.assertEqual(response.status_code, 404)
+
+    def test_advertised_servings(self):
+        print("\n>Running test for making exactly the advertised number of servings.")
+        for name, quantity in (("Mango", 16), ("Orange juice", 0.75), ("Ice", 4)):
+            self.update_ingredient(self.header, name, quantity)
+        servings = self.get_servings()["Mango Bliss"]
+        self.assertEqual(servings, 3)
+        for _ in range(servings):
+            response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 0)
+        response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['missing'], [{'name': "Mango", 'needed': 5, 'quantity': 1},
+                                                          {'name': "Orange juice", 'needed': 0.25, 'quantity': 0}])
+
+    def test_untracked_ingredient(self):
+        print("\n>Running test for ingredients in the cabinet without a quantity not limiting servings.")
+        self.add_ingredients(self.header, ["Ice"])
+        for name, quantity in (("Mango", 10), ("Orange juice", 2)):
+            self.update_ingredient(self.header, name, quantity)
+        self.assertEqual(self.get_servings()["Mango Bliss"], 2)
+
+        print(">Running test for making a recipe without decrementing an untracked ingredient.")
+        response = self.client.post('/api/recipes/Mango Bliss/make', headers=self.header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([ingredient['name'] for ingredient in response.get_json()['ingredients']], ["Mango", "Orange juice"])
+        self.assertEqual(self.get_quantities(), {"mango": 5, "orange juice": 1.75})
+        self.assertEqual(self.get_servings()["Mango Bliss"], 1)
+
+    def get_quantities(self):
+        rows = db.session.query(Ingredients.name, Inventory.quantity).join(Inventory, Inventory.ingredient == Ingredients.id)
+        return dict(rows)
+
+    def get_servings(self):
+        response = self.client.get('/api/recipe-servings', headers=self.header)
+        return {recipe['name']: recipe['servings'] for recipe in response.get_json()['recipes']}
+
+
+class TestConcurrentMakes(unittest.TestCase):
+    def setUp(self):
+        # Every thread needs a connection of its own to the same database, so the test uses a file.
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.engine = create_engine('sqlite:///' + self.path, connect_args={'timeout': 30})
+        db.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(User.__table__.insert(), {'id': 1, 'user_uuid': "uuid", 'username': "user",
+                                                         'password': "pass", 'email': "email"})
+            connection.execute(ingredient_keys.insert(), [{'id': 1, 'name': "mango"}, {'id': 2, 'name': "ice"}])
+            connection.execute(Ingredients.__table__.insert(), [
+                {'id': 1, 'name': "mango", 'ingredient_type': "fruit", 'quantity': 0},
+                {'id': 2, 'name': "ice", 'ingredient_type': "other", 'quantity': 0}])
+            connection.execute(Recipe.__table__.insert(), {'id': 1, 'name': "Mango Ice", 'instructions': "Blend."})
+            connection.execute(recipe_measurements.insert(), [
+                {'recipe_id': 1, 'ingredient_id': 1, 'amount': 1.0, 'unit': 'piece'},
+                {'recipe_id': 1, 'ingredient_id': 2, 'amount': 0.5, 'unit': 'cup'}])
+            connection.execute(Inventory.__table__.insert(), [
+                {'user': 1, 'ingredient': 1, 'quantity': 3, 'favorite': False},
+                {'user': 1, 'ingredient': 2, 'quantity': 2, 'favorite': False}])
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_concurrent_makes(self):
+        print("\n>Running test for concurrent makes never overdrawing or partly decrementing the cabinet.")
+        barrier = threading.Barrier(8)
+        made, errors = [], []
+
+        def make():
+            try:
+                with self.engine.connect() as connection:
+                    transaction = connection.begin()
+                    barrier.wait()
+                    used, decremented = measurements.consume(connection, 1, 1)
+                    if(decremented < len(used)):
+                        transaction.rollback()
+                    else:
+                        transaction.commit()
+                        made.append(decremented)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=make) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(made, [2, 2, 2])
+        inventory = Inventory.__table__
+        with self.engine.connect() as connection:
+            quantities = dict(connection.execute(select([inventory.c.ingredient, inventory.c.quantity])).fetchall())
+        self.assertEqual(quantities, {1: 0, 2: 0.5})
@@ -0,0 +1,104 @@
+import unittest
+from sqlalchemy import create_engine, inspect
+from sdm_server import db
+from sdm_server import migrations, similarity
+from fixtures import DatabaseTestCase
+
+# The schema of the association tables before migrations were introduced.
+LEGACY_SCHEMA = [
+    'CREATE TABLE user (id INTEGER NOT NULL, user_uuid VARCHAR(50) NOT NULL, username VARCHAR(50) NOT NULL, '
+    'password VARCHAR(80) NOT NULL, email VARCHAR(50) NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE recipe (id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, instructions TEXT NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE ingredients (id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, ingredient_type VARCHAR(50) NOT NULL, '
+    'quantity INTEGER NOT NULL, is_favorite BOOLEAN NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE custom_ingredients (id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, ingredient_type VARCHAR(50) NOT NULL, '
+    'quantity INTEGER NOT NULL, is_favorite BOOLEAN NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE inventory (user INTEGER NOT NULL, ingredient INTEGER NOT NULL, quantity INTEGER NOT NULL, '
+    'favorite BOOLEAN NOT NULL, PRIMARY KEY (user, ingredient), '
+    'FOREIGN KEY(user) REFERENCES user (id), FOREIGN KEY(ingredient) REFERENCES ingredients (id))',
+    'CREATE TABLE recipe_ingredients (recipe_id INTEGER, ingredient_id INTEGER, '
+    'FOREIGN KEY(recipe_id) REFERENCES recipe (id), FOREIGN KEY(ingredient_id) REFERENCES ingredients (id))',
+    'CREATE TABLE user_ingredients (user_id INTEGER, ingredient_id INTEGER, '
+    'FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(ingredient_id) REFERENCES ingredients (id))',
+    'CREATE TABLE custom_user_ingredients (user_id INTEGER, ingredient_id INTEGER, '
+    'FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(ingredient_id) REFERENCES custom_ingredients (id))',
+]
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.connection = self.engine.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
+    def test_upgrade_legacy_database(self):
+        for statement in LEGACY_SCHEMA:
+            self.connection.execute(statement)
+        self.connection.execute("INSERT INTO user VALUES (1, 'uuid', 'user', 'password', 'user@example.com')")
+        self.connection.execute("INSERT INTO ingredients VALUES (1, 'lime', 'fruit', 1, 0), (2, 'gin', 'liquor', 1, 0)")
+        self.connection.execute("INSERT INTO user_ingredients VALUES (1, 1), (1, 1), (1, 2), (1, NULL)")
+        self.connection.execute("INSERT INTO inventory VALUES (1, 1, 3, 0)")
+        self.connection.execute("INSERT INTO recipe VALUES (1, 'gimlet', 'Shake 2 oz gin and 1/2 lime.'), (2, 'water', 'Pour.')")
+        self.connection.execute("INSERT INTO recipe_ingredients VALUES (1, 1), (1, 2), (1, 2)")
+        self.connection.execute("INSERT INTO user VALUES (2, 'uuid2', 'user2', 'password', 'user2@example.com')")
+        self.connection.execute("INSERT INTO custom_ingredients VALUES (1, ' Gin', 'liquor', 1, 0), (2, 'Oat  Milk', 'dairy', 1, 0), "
+                                "(3, 'oat milk', 'milk', 4, 1), (4, 'OAT MILK', 'dairy', 3, 1)")
+        self.connection.execute("INSERT INTO custom_user_ingredients VALUES (1, 1), (1, 2), (2, 3), (1, 4)")
+        self.assertIsNone(migrations.get_version(self.connection))
+
+        version = migrations.upgrade(self.connection)
+        self.assertEqual(version, migrations.head())
+        self.assertEqual(migrations.get_version(self.connection), migrations.head())
+
+        rows = self.connection.execute('SELECT user_id, ingredient_id FROM user_ingredients ORDER BY ingredient_id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 1), (1, 2)])
+        inspector = inspect(self.connection)
+        self.assertEqual(inspector.get_pk_constraint('user_ingredients')['constrained_columns'], ['user_id', 'ingredient_id'])
+        self.assertIn('ix_user_ingredients_ingredient_id_user_id',
+                      [index['name'] for index in inspector.get_indexes('user_ingredients')])
+        self.assertIn('ix_custom_ingredients_name',
+                      [index['name'] for index in inspector.get_indexes('custom_ingredients')])
+        self.assertIn('data_version', inspector.get_table_names())
+        rows = self.connection.execute('SELECT id, ingredient_count FROM recipe ORDER BY id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 2), (2, 0)])
+        rows = self.connection.execute('SELECT user_id, recipe_id, matched_count FROM user_recipe_match').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 1, 2)])
+        rows = self.connection.execute('SELECT id, name, ingredient_type FROM custom_ingredients ORDER BY id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 'gin', 'liquor'), (2, 'oat milk', 'dairy')])
+        rows = self.connection.execute('SELECT user_id, ingredient_id, quantity, favorite FROM custom_user_ingredients '
+                                       'ORDER BY user_id, ingredient_id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 1, 1, 0), (1, 2, 3, 1), (2, 2, 4, 1)])
+        self.assertTrue(any(index['unique'] and index['column_names'] == ['name']
+                            for index in inspector.get_indexes('custom_ingredients')))
+        rows = self.connection.execute('SELECT ingredient_id, amount, unit FROM recipe_measurements ORDER BY ingredient_id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 0.5, 'piece'), (2, 0.25, 'cup')])
+        rows = self.connection.execute('SELECT id, name FROM ingredient_keys ORDER BY id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 'lime'), (2, 'gin'), (3, 'oat milk')])
+        rows = self.connection.execute('SELECT id, key_id FROM custom_ingredients ORDER BY id').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 2), (2, 3)])
+        self.assertIn('ingredient_keys', [key['referred_table'] for key in inspector.get_foreign_keys('recipe_ingredients')])
+        quantity = next(column for column in inspector.get_columns('inventory') if column['name'] == 'quantity')
+        self.assertEqual((quantity['type'].precision, quantity['type'].scale), (12, 4))
+        self.assertEqual(self.connection.execute('SELECT quantity FROM inventory').scalar(), 3)
+        rows = self.connection.execute('SELECT recipe_id, signature FROM recipe_signatures').fetchall()
+        self.assertEqual([row[0] for row in rows], [1])
+        # The copied MinHash of the migration agrees with similarity.py for the pinned parameters.
+        coefficients = similarity.get_coefficients(migrations.SIGNATURE_HASHES, migrations.SIGNATURE_SEED)
+        self.assertEqual(rows[0][1], similarity.pack(similarity.signature([1, 2], coefficients)))
+
+        # Upgrading again is a no-op.
+        self.assertEqual(migrations.upgrade(self.connection), migrations.head())
+
+    def test_upgrade_empty_database(self):
+        self.assertEqual(migrations.upgrade(self.connection), migrations.head())
+        self.assertEqual(set(inspect(self.connection).get_table_names()),
+                         set(db.metadata.tables) | {'schema_version'})
+
+
+class TestQueryPlans(DatabaseTestCase):
+    def test_hot_queries_use_indexes(self):
+        for name, (plan, uses_indexes) in migrations.check_query_plans(self.connection).items():
+            self.assertTrue(uses_indexes, "{} scans a table: {}".format(name, plan))
@@ -0,0 +1,84 @@
+import json
+import unittest
+from sdm_server import resolver
+from fixtures import DatabaseTestCase
+
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = resolver.NameIndex(None, [(1, "strawberry"), (2, "papaya juice"), (3, "green apple"),
+                                               (4, "apple"), (5, "lime"), (6, "lime juice")])
+
+    def test_resolve(self):
+        print("\n>Running test for resolving exact, spaced and plural names.")
+        self.assertEqual(self.index.resolve(" Papaya   Juice "), (2, "papaya juice"))
+        self.assertEqual(self.index.resolve("papayajuice"), (2, "papaya juice"))
+        self.assertEqual(self.index.resolve("Strawberries"), (1, "strawberry"))
+        self.assertEqual(self.index.resolve("Limes"), (5, "lime"))
+
+        print(">Running test for resolving misspelled names.")
+        self.assertEqual(self.index.resolve("strawbery"), (1, "strawberry"))
+        self.assertEqual(self.index.resolve("appel"), (4, "apple"))
+        self.assertEqual(self.index.resolve("lmie"), (5, "lime"))
+        self.assertEqual(self.index.resolve("green aple"), (3, "green apple"))
+
+        print(">Running test for resolving without edits.")
+        self.assertEqual(self.index.resolve("Strawberries", fuzzy=False), (1, "strawberry"))
+        self.assertIsNone(self.index.resolve("strawbery", fuzzy=False))
+        self.assertIsNone(self.index.resolve("green aple", fuzzy=False))
+
+        print(">Running test for names without a close ingredient.")
+        self.assertIsNone(self.index.resolve("kiwi"))
+        self.assertIsNone(self.index.resolve("pineapple"))
+        self.assertIsNone(self.index.resolve(" "))
+
+        print(">Running test for short names having to match exactly.")
+        self.assertIsNone(self.index.resolve("lim"))
+        self.assertIsNone(self.index.resolve("apl"))
+
+    def test_edit_distance(self):
+        print("\n>Running test for the bounded edit distance.")
+        self.assertEqual(resolver.edit_distance("apple", "appel", 2), 1)
+        self.assertEqual(resolver.edit_distance("lime", "lime juice", 2), 3)
+        self.assertEqual(resolver.edit_distance("abc", "xyz", 1), 2)
+
+
+class TestResolvedRequests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+
+    def test_add_ingredients(self):
+        print("\n>Running test for adding plural ingredients and suggesting misspelled ones.")
+        response = self.client.post('/api/user-ingredients', headers=self.header, content_type='application/json',
+                                    data=json.dumps({"ingredients": ["Bananas", "Strawbery", "Nothing like it"]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['resolved'],
+                         {"Bananas": "Banana", "Strawbery": None, "Nothing like it": None})
+        self.assertEqual(response.get_json()['suggested'], {"Strawbery": "Strawberry"})
+        cabinet = self.client.get('/api/user-ingredients', headers=self.header).get_json()['ingredients']['default']
+        self.assertEqual([ingredient['name'] for ingredient in cabinet], ["Banana"])
+
+    def test_update_ingredient(self):
+        print("\n>Running test for updating a plural ingredient.")
+        response = self.client.patch('/api/all-ingredients', headers=self.header, content_type='application/json',
+                                     data=json.dumps({'name': "Mangos", 'quantity': 2, 'isFavorite': "True"}))
+        self.assertEqual(response.get_json()['resolved'], {"Mangos": "Mango"})
+        cabinet = self.client.get('/api/user-ingredients', headers=self.header).get_json()['ingredients']['default']
+        self.assertEqual(cabinet, [{'name': "Mango", 'type': "Fruit", 'quantity': 2, 'favorite': "True"}])
+
+        print(">Running test for a misspelled ingredient only being suggested.")
+        response = self.client.patch('/api/all-ingredients', headers=self.header, content_type='application/json',
+                                     data=json.dumps({'name': "Mnago", 'quantity': 5, 'isFavorite': "False"}))
+        self.assertEqual(response.get_json()['resolved'], {"Mnago": None})
+        self.assertEqual(response.get_json()['suggested'], {"Mnago": "Mango"})
+        cabinet = self.client.get('/api/user-ingredients', headers=self.header).get_json()['ingredients']['default']
+        self.assertEqual(cabinet[0]['quantity'], 2)
+
+        print(">Running test for custom ingredients taking precedence over close ingredients.")
+        self.client.post('/api/custom-ingredients', data=json.dumps({'name': "Mangoes", 'type': "Fruit"}),
+                         headers=self.header, content_type='application/json')
+        response = self.client.patch('/api/all-ingredients', headers=self.header, content_type='application/json',
+                                     data=json.dumps({'name': "Mangoes", 'quantity': 1, 'isFavorite': "False"}))
+        self.assertEqual(response.get_json()['resolved'], {"Mangoes": "Mangoes"})
+
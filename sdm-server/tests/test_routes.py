@@ -1,52 +1,22 @@
 import unittest
-import csv
+import gzip
 import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
 from sdm_server import app, db
 from sdm_server.models import *
+from fixtures import DatabaseTestCase
 
 
-class TestRoutes(unittest.TestCase):
+class TestRoutes(DatabaseTestCase):
     '''
     Module for running unittests on current supported frontend routes.
     This module performs tests on the expected operations and requests
     each route is expected to receive. Responses are checked to make
     sure they are in line with expectations.
     '''
-    @classmethod
-    def setUpClass(cls):
-        cls.ingredients = []
-        cls.recipes = []
-        with open('ingredients.csv', newline='') as f:
-            reader = csv.reader(f, delimiter=',')
-            for line in reader:
-                if line not in cls.ingredients:
-                    cls.ingredients.append([line[0], line[1], line[2], line[3]])
-
-        with open('Recipes.csv', newline='') as f:
-            reader = csv.reader(f, delimiter=';')
-            for line in reader:
-                if line not in cls.recipes:
-                    cls.recipes.append([line[0], line[1]])
-
-    def setUp(self):
-        self.client = app.test_client()
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../tests/test.db'
-        app.config['SECRET_KEY'] = 'Not A Good Key'
-        db.create_all()
-
-        for ingredient in TestRoutes.ingredients:
-            ing = Ingredients(name=ingredient[0].lower(), ingredient_type=ingredient[1].lower(), quantity=ingredient[2], is_favorite=eval(ingredient[3]))
-            db.session.add(ing)
-        for recipe in TestRoutes.recipes:
-            rec = Recipe(name=recipe[0], instructions=recipe[1])
-            db.session.add(rec)
-        db.session.commit()
-
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
-
     def test_login(self):
         invalid_message = "Invalid username or password"
 
@@ -460,6 +430,30 @@ class TestRoutes(unittest.TestCase):
         self.assertEqual(response.status_code, 401)
         self.assertEqual(invalid_message, response_message)
 
+    def test_shared_custom_ingredients(self):
+        first = self.get_authorization_header_token("user", "pass", "email")
+        second = self.get_authorization_header_token("user2", "pass", "email2")
+
+        print("\n>Running test for users sharing one custom ingredient of the same name.")
+        self.add_custom_ingredients_to_user(first, {'name': "Oat Milk", 'type': "Dairy"})
+        response = self.add_custom_ingredients_to_user(second, {'name': "oat  milk", 'type': "Milk"})
+        self.assertEqual(response.get_json(), {'message': "Added ingredient 'oat  milk' of type 'Dairy', the type it was first added with",
+                                               'type': "Dairy"})
+        self.assertEqual(Custom_Ingredients.query.filter_by(name="oat milk").count(), 1)
+
+        print(">Running test for quantities and favorites staying per user.")
+        self.client.patch('/api/all-ingredients', data=json.dumps({'name': "Oat Milk", 'quantity': 3, 'isFavorite': "True"}),
+                          headers=first, content_type='application/json')
+        custom = lambda header: self.client.get('/api/user-ingredients', headers=header).get_json()['ingredients']['custom']
+        self.assertEqual(custom(first), [{'name': "Oat milk", 'type': "Dairy", 'quantity': 3, 'favorite': "True"}])
+        self.assertEqual(custom(second), [{'name': "Oat milk", 'type': "Dairy", 'quantity': 0, 'favorite': "False"}])
+
+        print(">Running test for deleting a shared custom ingredient for one user.")
+        self.client.delete('/api/custom-ingredients', data=json.dumps({'name': "Oat Milk"}),
+                           headers=first, content_type='application/json')
+        self.assertEqual(custom(first), [])
+        self.assertEqual(len(custom(second)), 1)
+
     def test_get_recipes(self):
         header = self.get_authorization_header_token("user", "pass", "email")
         all_recipe_first = "Acai-Peanut Protein"
@@ -537,17 +531,218 @@ class TestRoutes(unittest.TestCase):
         self.assertTrue(apple != None)
         self.assertTrue(len(apple.owned_by) == 2)
 
+    def test_filtered_recipes(self):
+        header = self.get_authorization_header_token("user", "pass", "email")
+        acai, ackee, ade = [Ingredients.query.filter_by(name=name).first() for name in ("acai", "ackee", "ade")]
+        mango = Recipe.query.filter_by(name="Mango Bliss").first()
+        strawberry = Recipe.query.filter_by(name="Strawberry Madness").first()
+        acai.used_in.append(mango)
+        ackee.used_in.append(mango)
+        ade.used_in.append(strawberry)
+        db.session.commit()
+
+        print("\n>Running test for ingredient counts maintained on write.")
+        self.assertEqual(mango.ingredient_count, 2)
+        self.assertEqual(strawberry.ingredient_count, 1)
+        instructions = mango.instructions
+
+        print(">Running test for recipes needing every ingredient in the cabinet.")
+        self.add_ingredients_to_user(header, {'name': "Acai", 'quantity': 1, 'isFavorite': False})
+        response = self.client.get('/api/filtered-recipes', headers=header)
+        names = [recipe['name'] for recipe in response.get_json().get('recipes')]
+        self.assertNotIn("Mango Bliss", names)
+        self.assertNotIn("Strawberry Madness", names)
+        # Recipes without ingredients can always be made.
+        self.assertIn("Peanut Butter Blast", names)
+        response = self.client.get('/api/partial-filter', headers=header)
+        self.assertEqual([{'name': "Mango Bliss", 'instructions': instructions, 'ingredients': ["Acai", "Ackee"]}],
+                         [dict(recipe, ingredients=sorted(recipe['ingredients'])) for recipe in response.get_json().get('recipes')])
+
+        self.add_ingredients_to_user(header, {'name': "Ackee", 'quantity': 1, 'isFavorite': False})
+        response = self.client.get('/api/filtered-recipes', headers=header)
+        names = [recipe['name'] for recipe in response.get_json().get('recipes')]
+        self.assertIn("Mango Bliss", names)
+        self.assertNotIn("Strawberry Madness", names)
+
+        print(">Running test for ingredient counts after removing an ingredient.")
+        db.session.delete(Ingredients.query.filter_by(name="ackee").first())
+        db.session.commit()
+        self.assertEqual(Recipe.query.filter_by(name="Mango Bliss").first().ingredient_count, 1)
+
+        print(">Running test for ingredient counts of a recipe created with its ingredients.")
+        recipe = Recipe(name="Acai Ade", instructions="Blend 1 cup acai and 1 cup ade.")
+        linked = Ingredients.query.filter(Ingredients.name.in_(["acai", "ade"])).all()
+        for ingredient in linked:
+            ingredient.used_in.append(recipe)
+        db.session.commit()
+        self.assertEqual(recipe.ingredient_count, 2)
+
+    def test_conditional_get(self):
+        header = self.get_authorization_header_token("user", "pass", "email")
+        ingredient = {'name': "Apple", 'quantity': 1, 'isFavorite': False}
+        Data_Version.query.update({'updated_at': datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+
+        print("\n>Running test for ETag and Last-Modified on list endpoints.")
+        response = self.client.get('/api/all-recipes', headers=header)
+        etag = response.headers.get('ETag')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+        print(">Running test for unchanged listing returning 304.")
+        response = self.client.get('/api/all-recipes', headers=dict(header, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(b'', response.get_data())
+        self.assertEqual(etag, response.headers.get('ETag'))
+
+        print(">Running test for cabinet change invalidating the user's listings.")
+        response = self.client.get('/api/user-ingredients', headers=header)
+        etag = response.headers.get('ETag')
+        self.add_ingredients_to_user(header, ingredient)
+        response = self.client.get('/api/user-ingredients', headers=dict(header, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+
+        print(">Running test for ETags being specific to a User.")
+        other_header = self.get_authorization_header_token("other", "pass", "other")
+        response = self.client.get('/api/all-recipes', headers=dict(other_header, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        print(">Running test for no Last-Modified within the second of the last write.")
+        # A later write in the same second would have the same Last-Modified and be answered with 304.
+        Data_Version.query.filter_by(name='catalog').update({'updated_at': datetime.utcnow() + timedelta(seconds=1)})
+        db.session.commit()
+        response = self.client.get('/api/all-recipes', headers=header)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.headers.get('Last-Modified'))
+
+    def test_read_replicas(self):
+        # A second SQLite file stands in for a replica. It has the schema but
+        # different data, so the responses show which database served them.
+        replica_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'replica.db')
+        replica = create_engine(replica_uri)
+        db.metadata.create_all(replica)
+        replica.execute(Recipe.__table__.insert(), name="Replica Only", instructions="Served by the replica.")
+        replica.dispose()
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [replica_uri]
+        try:
+            header = self.get_authorization_header_token("user", "pass", "email")
+            ingredient = {'name': "Apple", 'quantity': 1, 'isFavorite': False}
+            Data_Version.query.update({'updated_at': datetime.utcnow() - timedelta(hours=1)})
+            db.session.commit()
+
+            print("\n>Running test for listings read from the replica.")
+            response = self.client.get('/api/all-recipes', headers=header)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(["Replica Only"], [recipe['name'] for recipe in response.get_json().get('recipes')])
+
+            print(">Running test for validators read from the replica that served the listing.")
+            # The replica has no data versions yet, so its listing is of version 0.
+            user_id = User.query.filter_by(username="user").first().id
+            self.assertEqual(response.headers.get('ETag'), 'W/"{}-0"'.format(user_id))
+            self.assertIsNone(response.headers.get('Last-Modified'))
+
+            print(">Running test for reading your own writes from the primary.")
+            self.add_ingredients_to_user(header, ingredient)
+            response = self.client.get('/api/user-ingredients', headers=header)
+            self.assertEqual(["Apple"], [item['name'] for item in response.get_json().get('ingredients')['default']])
+
+            print(">Running test for reads returning to the replica after the window.")
+            Data_Version.query.update({'updated_at': datetime.utcnow() - timedelta(hours=1)})
+            db.session.commit()
+            response = self.client.get('/api/user-ingredients', headers=header)
+            self.assertEqual([], response.get_json().get('ingredients')['default'])
+        finally:
+            app.config['SQLALCHEMY_REPLICA_URIS'] = []
+            for engine in db.replica_engines.values():
+                engine.dispose()
+            db.replica_engines.clear()
+
+    def test_response_compression(self):
+        header = self.get_authorization_header_token("user", "pass", "email")
+
+        print("\n>Running test for gzip compression of large listings.")
+        plain = self.client.get('/api/all-recipes', headers=header)
+        response = self.client.get('/api/all-recipes', headers=dict(header, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(plain.get_data(), gzip.decompress(response.get_data()))
+        self.assertTrue(len(response.get_data()) < len(plain.get_data()))
+
+        print(">Running test for small responses sent uncompressed.")
+        response = self.client.post('/api/authenticate', headers=dict(header, **{'Accept-Encoding': 'gzip'}))
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
+    def test_metrics(self):
+        header = self.get_authorization_header_token("user", "pass", "email")
+
+        print("\n>Running test for Prometheus metrics after serving requests.")
+        self.client.get('/api/all-recipes', headers=header)
+        response = self.client.get('/metrics')
+        metrics = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn('sdm_request_duration_seconds_bucket{method="GET",route="/api/all-recipes",le="+Inf"}', metrics)
+        self.assertIn('sdm_requests_total{method="GET",route="/api/all-recipes",status="200"}', metrics)
+        self.assertIn('sdm_db_queries_total{route="/api/all-recipes"}', metrics)
+        self.assertIn('sdm_requests_in_flight', metrics)
+
+    def test_query_budgets(self):
+        header = self.get_authorization_header_token("user", "pass", "email")
+        ingredients = ["Apple", "Banana", "Mango", "Kiwi"]
+        custom_ingredients = {'name': "Juicy", 'type': "Liquid"}
+
+        # Link the first recipes to ingredients, so that per-recipe query loops
+        # would execute more than once and be detected.
+        for recipe in Recipe.query.order_by(Recipe.name).limit(5):
+            for name in ingredients:
+                recipe.ingredients.append(Ingredients.query.filter_by(name=name.lower()).first())
+        db.session.commit()
+        for name in ingredients[:3]:
+            self.add_ingredients_to_user(header, {'name': name, 'quantity': 1, 'isFavorite': False})
+        self.add_custom_ingredients_to_user(header, custom_ingredients)
+        linked = Recipe.query.order_by(Recipe.name).first().name
+
+        print(">Running test for query budget of reading the catalog.")
+        # The catalog is read once per catalog version (see catalog.py), the budgets below are for the requests after it.
+        with self.assertMaxQueries(5):
+            response = self.client.get('/api/all-recipes', headers=header)
+        self.assertEqual(response.status_code, 200)
+
+        budgets = [('/api/all-ingredients', 5),
+                   ('/api/custom-ingredients', 3),
+                   ('/api/user-ingredients', 4),
+                   ('/api/all-recipes', 2),
+                   ('/api/filtered-recipes', 3),
+                   ('/api/partial-filter', 3),
+                   ('/api/recipe-servings', 4),
+                   ('/api/shopping-list/optimize?budget=3', 5),
+                   ('/api/recipes/{}/similar'.format(linked), 4),
+                   ('/api/recommendations', 4)]
+        for endpoint, budget in budgets:
+            print(">Running test for query budget of {}.".format(endpoint))
+            with self.assertMaxQueries(budget):
+                response = self.client.get(endpoint, headers=header)
+            self.assertEqual(response.status_code, 200)
+
+        print(">Running test for query budget of the shopping list.")
+        recipes = [recipe.name for recipe in Recipe.query]
+        with self.assertMaxQueries(4):
+            response = self.client.post('/api/shopping-list', data=json.dumps({"recipes": recipes}),
+                                        headers=header, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        print(">Running test for query budget of cabinet updates.")
+        with self.assertMaxQueries(15):
+            self.add_ingredients_to_user(header, {'name': "Kiwi", 'quantity': 2, 'isFavorite': True})
+        with self.assertMaxQueries(8):
+            self.delete_ingredients_from_user(header, {"ingredients": ingredients})
+
     def get_test_user_token(self, username, expires):
         user = User.query.filter_by(username=username).first()
         return user.get_reset_token(expires)
 
-    def get_authorization_header_token(self, username, password, email):
-        self.register_user({"username": username, "password": password, "email": email})
-        login_data = {"loginId": username, "password": password}
-        response = self.client.post('/api/login', data=json.dumps(login_data), content_type='application/json')
-        token = response.get_json().get('token')
-        return {"Authorization": "Bearer " + token}
-
     def register_user(self, data):
         return self.client.post('/api/register', data=json.dumps(data), content_type='application/json')
 
@@ -0,0 +1,82 @@
+import json
+import unittest
+from sdm_server import db, shopping
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestOptimizer(unittest.TestCase):
+    def test_bundles(self):
+        print("\n>Running test for buying the smallest set of ingredients when none completes a recipe alone.")
+        index = shopping.CatalogIndex(0, {1: (10, 11), 2: (10, 11, 12), 3: (13, 14, 15), 4: (16,)})
+        picks = shopping.optimize(index, {16}, 3)
+        self.assertEqual(sorted(ingredient_id for ingredient_id, _ in picks[:2]), [10, 11])
+        self.assertEqual([recipe_ids for _, recipe_ids in picks], [[], [1], [2]])
+        self.assertEqual(shopping.optimize(index, {16}, 1), [])
+
+        print(">Running test for going back to single ingredients after the first ingredient of a set.")
+        index = shopping.CatalogIndex(0, {1: (10, 11), 2: (10, 12), 3: (10, 12), 4: (11, 30, 31), 5: (11, 32, 33)})
+        self.assertEqual(shopping.optimize(index, set(), 2), [(10, []), (12, [2, 3])])
+
+
+class TestShoppingList(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        acai, ackee, ade = [Ingredients.query.filter_by(name=name).first() for name in ("acai", "ackee", "ade")]
+        recipes = {recipe.name: recipe for recipe in Recipe.query}
+        acai.used_in.append(recipes["Mango Bliss"])
+        ackee.used_in.append(recipes["Mango Bliss"])
+        ackee.used_in.append(recipes["Acai-Peanut Protein"])
+        ackee.used_in.append(recipes["Strawberry Madness"])
+        ade.used_in.append(recipes["Strawberry Madness"])
+        ade.used_in.append(recipes["Peanut Butter Blast"])
+        db.session.commit()
+        self.add_ingredients(self.header, ["Acai"])
+
+    def test_optimize(self):
+        print("\n>Running test for the ingredient that unlocks the most recipes being picked first.")
+        response = self.client.get('/api/shopping-list/optimize?budget=1', headers=self.header)
+        self.assertEqual(response.get_json()['ingredients'],
+                         [{"name": "Ackee", "unlocks": ["Acai-Peanut Protein", "Mango Bliss"]}])
+
+        print(">Running test for later picks counting the recipes completed by earlier picks.")
+        response = self.client.get('/api/shopping-list/optimize?budget=5', headers=self.header)
+        self.assertEqual(response.get_json()['ingredients'],
+                         [{"name": "Ackee", "unlocks": ["Acai-Peanut Protein", "Mango Bliss"]},
+                          {"name": "Ade", "unlocks": ["Peanut Butter Blast", "Strawberry Madness"]}])
+
+    def test_invalid_budget(self):
+        print("\n>Running test for rejecting a missing or invalid budget.")
+        for query in ('', '?budget=0', '?budget=many', '?budget=1000'):
+            response = self.client.get('/api/shopping-list/optimize' + query, headers=self.header)
+            self.assertEqual(response.status_code, 400)
+
+    def test_shopping_list(self):
+        print("\n>Running test for missing ingredients being listed once, grouped by type.")
+        response = self.client.post('/api/shopping-list', headers=self.header, content_type='application/json',
+                                    data=json.dumps({"recipes": ["Mango Bliss", "Strawberry Madness", "Unknown"]}))
+        self.assertEqual(response.get_json()['ingredients'], {
+            "Fruit": [{"name": "Ackee", "recipes": ["Mango Bliss", "Strawberry Madness"], "amount": None, "unit": None}],
+            "Liquid": [{"name": "Ade", "recipes": ["Strawberry Madness"], "amount": None, "unit": None}]})
+
+        print(">Running test for cabinet ingredients with too small a quantity being listed.")
+        ice = Ingredients.query.filter_by(name="ice").first()
+        ice.used_in.append(Recipe.query.filter_by(name="Mango Bliss").first())
+        ice.used_in.append(Recipe.query.filter_by(name="Strawberry Madness").first())
+        db.session.commit()
+        self.update_ingredient(self.header, "Ice", 1)
+        response = self.client.post('/api/shopping-list', headers=self.header, content_type='application/json',
+                                    data=json.dumps({"recipes": ["Mango Bliss", "Strawberry Madness"]}))
+        self.assertEqual(response.get_json()['ingredients']["Other"],
+                         [{"name": "Ice", "recipes": ["Mango Bliss", "Strawberry Madness"], "amount": 0.25, "unit": "cup"}])
+        response = self.client.post('/api/shopping-list', headers=self.header, content_type='application/json',
+                                    data=json.dumps({"recipes": ["Mango Bliss"]}))
+        self.assertNotIn("Other", response.get_json()['ingredients'])
+
+        print(">Running test for rejecting a request without a list of recipe names.")
+        for data in ({}, {"recipes": "Mango Bliss"}, {"recipes": [{"a": 1}]}, {"recipes": ["Mango Bliss", 1]}, ["Mango Bliss"]):
+            response = self.client.post('/api/shopping-list', headers=self.header, content_type='application/json',
+                                        data=json.dumps(data))
+            self.assertEqual(response.status_code, 400)
+
@@ -0,0 +1,79 @@
+import unittest
+from sdm_server import db, similarity
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestMinHash(unittest.TestCase):
+    def test_signature(self):
+        print("\n>Running test for signatures estimating the Jaccard similarity.")
+        coefficients = similarity.get_coefficients(256, 1)
+        first = similarity.signature(range(0, 20), coefficients)
+        second = similarity.signature(range(10, 30), coefficients)
+        estimate = sum(x == y for x, y in zip(first, second)) / len(coefficients)
+        self.assertAlmostEqual(estimate, 1 / 3, delta=0.1)
+        self.assertEqual(similarity.signature([3, 1, 2], coefficients), similarity.signature([1, 2, 3], coefficients))
+
+        print(">Running test for packing signatures into 4 bytes per hash.")
+        self.assertEqual(len(similarity.pack(first)), 4 * 256)
+        self.assertEqual(similarity.unpack(similarity.pack(first)), first)
+
+
+class TestSimilarRecipes(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        self.ingredients = {name: Ingredients.query.filter_by(name=name).first()
+                            for name in ("acai", "ackee", "ade", "ice", "lime", "yogurt")}
+        recipes = {recipe.name: recipe for recipe in Recipe.query}
+        for recipe, ingredients in (("Mango Bliss", ("acai", "ackee", "ade")),
+                                    ("Strawberry Madness", ("acai", "ackee", "ade", "ice")),
+                                    ("Peanut Butter Blast", ("lime", "yogurt"))):
+            for name in ingredients:
+                self.ingredients[name].used_in.append(recipes[recipe])
+        db.session.commit()
+        self.refresh_index()
+
+    def test_similar(self):
+        print("\n>Running test for similar recipes sharing most ingredients.")
+        recipes = self.get_similar("Mango Bliss")
+        self.assertEqual(recipes[0]['name'], "Strawberry Madness")
+        self.assertEqual(recipes[0]['ingredients'], ["Acai", "Ackee", "Ade", "Ice"])
+        self.assertAlmostEqual(recipes[0]['similarity'], 0.75, delta=0.2)
+        self.assertNotIn("Peanut Butter Blast", [recipe['name'] for recipe in recipes])
+
+        print(">Running test for the previous index being used while the index of a changed catalog is built.")
+        ice = Ingredients.query.filter_by(name="ice").first()
+        ice.used_in.remove(Recipe.query.filter_by(name="Strawberry Madness").first())
+        db.session.commit()
+        self.assertNotEqual(similarity.get_index().version, Data_Version.lookup('catalog')[0])
+
+        print(">Running test for signatures following ingredient changes.")
+        self.refresh_index()
+        self.assertEqual(self.get_similar("Mango Bliss")[0]['similarity'], 1.0)
+
+        print(">Running test for an unknown recipe.")
+        response = self.client.get('/api/recipes/Unknown/similar', headers=self.header)
+        self.assertEqual(response.status_code, 404)
+
+    def test_recommendations(self):
+        print("\n>Running test for recommending recipes similar to makeable ones.")
+        self.add_ingredients(self.header, ["Acai", "Ackee", "Ade"])
+        response = self.client.get('/api/recommendations', headers=self.header)
+        recommendations = response.get_json()['recommendations']
+        self.assertEqual(recommendations[0]['because'], "Mango Bliss")
+        self.assertEqual([recipe['name'] for recipe in recommendations[0]['recipes']], ["Strawberry Madness"])
+
+        print(">Running test for rejecting an invalid limit.")
+        response = self.client.get('/api/recommendations?limit=0', headers=self.header)
+        self.assertEqual(response.status_code, 400)
+
+    def refresh_index(self):
+        # The index of a changed catalog is built in the background.
+        while(similarity.get_index().version != Data_Version.lookup('catalog')[0]):
+            similarity.wait_for_index()
+
+    def get_similar(self, name):
+        response = self.client.get('/api/recipes/{}/similar'.format(name), headers=self.header)
+        return response.get_json()['recipes']
+
@@ -0,0 +1,58 @@
+from sdm_server import db, substitutions
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestSubstitutions(DatabaseTestCase):
+    '''
+    Tests for substitution-aware recipe matching with the default
+    SUBSTITUTION_GROUPS.
+    '''
+    def setUp(self):
+        super().setUp()
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        acai = Ingredients.query.filter_by(name="acai").first()
+        lemon_juice = Ingredients.query.filter_by(name="lemon juice").first()
+        mango = Recipe.query.filter_by(name="Mango Bliss").first()
+        acai.used_in.append(mango)
+        lemon_juice.used_in.append(mango)
+        db.session.commit()
+
+    def test_closure(self):
+        print("\n>Running test for the closure grouping ingredients by name and type.")
+        closure = substitutions.get_closure()
+        ids = {ingredient.name: ingredient.id for ingredient in Ingredients.query}
+        self.assertIn(ids["lime juice"], closure.substitutes[ids["lemon juice"]])
+        self.assertIn(ids["orange juice"], closure.substitutes[ids["lemon juice"]])
+        self.assertNotIn(ids["honeydew juice"], closure.substitutes)
+        self.assertNotIn(ids["lime"], closure.substitutes)
+        self.assertIn(ids["plain yogurt"], closure.substitutes[ids["yogurt"]])
+        self.assertEqual(closure.cover({ids["lime juice"], ids["lemon juice"]})[ids["orange juice"]], ids["lemon juice"])
+
+        print(">Running test for the closure being rebuilt for a new catalog version.")
+        self.assertIs(substitutions.get_closure(), closure)
+        db.session.add(Ingredients(name="yuzu juice", ingredient_type="liquid", quantity=0, is_favorite=False))
+        db.session.commit()
+        rebuilt = substitutions.get_closure()
+        self.assertIsNot(rebuilt, closure)
+        self.assertIn(Ingredients.query.filter_by(name="yuzu juice").first().id, rebuilt.substitutes[ids["lemon juice"]])
+
+    def test_filtered_recipes_with_substitutions(self):
+        self.add_ingredients(self.header, ["Acai", "Lime juice"])
+
+        print("\n>Running test for substituted recipes being left out by default.")
+        response = self.client.get('/api/filtered-recipes', headers=self.header)
+        self.assertNotIn("Mango Bliss", [recipe['name'] for recipe in response.get_json()['recipes']])
+
+        print(">Running test for substituted recipes reporting their substitutions.")
+        response = self.client.get('/api/filtered-recipes?substitutions=true', headers=self.header)
+        recipes = {recipe['name']: recipe for recipe in response.get_json()['recipes']}
+        self.assertEqual(recipes["Mango Bliss"]['substitutions'], {"Lemon juice": "Lime juice"})
+        self.assertEqual(recipes["Strawberry Madness"]['substitutions'], {})
+
+        print(">Running test for exact matches not needing substitutions.")
+        self.add_ingredients(self.header, ["Lemon juice"])
+        response = self.client.get('/api/filtered-recipes?substitutions=true', headers=self.header)
+        recipes = [recipe for recipe in response.get_json()['recipes'] if recipe['name'] == "Mango Bliss"]
+        self.assertEqual([recipe['substitutions'] for recipe in recipes], [{}])
+
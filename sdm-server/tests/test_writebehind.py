@@ -0,0 +1,159 @@
+import json
+import threading
+from sqlalchemy.exc import OperationalError
+from sdm_server import app, db, writebehind
+from sdm_server.metrics import render_metrics
+from sdm_server.models import *
+from fixtures import DatabaseTestCase
+
+
+class TestWriteBehind(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        app.config['WRITE_BEHIND_ENABLED'] = True
+        # The writer thread must not flush during the test, the test flushes itself.
+        app.config['WRITE_BEHIND_SECONDS'] = 3600
+        self.header = self.get_authorization_header_token("user", "pass", "email")
+        self.user_id = User.query.filter_by(username="user").first().id
+
+    def tearDown(self):
+        writebehind.buffer.flush('shutdown')
+        app.config['WRITE_BEHIND_ENABLED'] = False
+        app.config['WRITE_BEHIND_SECONDS'] = 1.0
+        super().tearDown()
+
+    def test_coalesced_updates(self):
+        print("\n>Running test for writing the first update of an ingredient right away.")
+        self.update_ingredient(self.header, "Apple", 1, "False")
+        self.assertEqual(self.inventory("apple"), (1, False))
+        self.assertFalse(writebehind.buffer.has_pending(self.user_id))
+
+        print(">Running test for buffering updates of an ingredient in the cabinet.")
+        for quantity in (2, 3, 4):
+            self.update_ingredient(self.header, "Apple", quantity, "True")
+        self.assertEqual(self.inventory("apple"), (1, False))
+        self.assertTrue(writebehind.buffer.has_pending(self.user_id))
+
+        print(">Running test for reading the latest update.")
+        response = self.client.get('/api/user-ingredients', headers=self.header)
+        apple = next(ingredient for ingredient in response.get_json()['ingredients']['default'] if ingredient['name'] == "Apple")
+        self.assertEqual((apple['quantity'], apple['favorite']), (4, "True"))
+        self.assertFalse(writebehind.buffer.has_pending(self.user_id))
+        metrics = render_metrics()
+        self.assertIn('sdm_write_behind_flushes_total{reason="read"}', metrics)
+        self.assertIn('sdm_write_behind_pending 0', metrics)
+
+    def test_shutdown_flush(self):
+        print("\n>Running test for writing buffered updates of custom ingredients on shutdown.")
+        self.client.post('/api/custom-ingredients', data=json.dumps({'name': "Oat Milk", 'type': "Dairy"}),
+                         headers=self.header, content_type='application/json')
+        self.update_ingredient(self.header, "Apple", 1, "False")
+        self.update_ingredient(self.header, "Oat Milk", 5, "True")
+        self.update_ingredient(self.header, "Apple", 2, "False")
+        self.update_ingredient(self.header, "Oat Milk", 6, "False")
+        saved = self.sample('sdm_write_behind_commits_saved_total')
+        self.assertEqual(writebehind.buffer.flush('shutdown'), 2)
+        self.assertEqual(self.inventory("apple"), (2, False))
+        entry = Custom_Inventory.query.filter_by(user=self.user_id).one()
+        self.assertEqual((entry.quantity, entry.favorite), (6, False))
+        self.assertEqual(self.sample('sdm_write_behind_commits_saved_total'), saved + 2)
+
+        print(">Running test for writing updates right away when the buffer is disabled.")
+        app.config['WRITE_BEHIND_ENABLED'] = False
+        self.update_ingredient(self.header, "Apple", 7, "True")
+        self.assertEqual(self.inventory("apple"), (7, True))
+
+    def test_failed_read_flush(self):
+        print("\n>Running test for refusing a read while the user's updates cannot be written.")
+        self.update_ingredient(self.header, "Apple", 1, "False")
+        self.update_ingredient(self.header, "Apple", 2, "False")
+
+        def fail(taken):
+            raise OperationalError("UPDATE inventory", {}, Exception("database is locked"))
+        writebehind.buffer.write = fail
+        try:
+            with self.assertLogs('sdm_server.writebehind', 'ERROR'):
+                response = self.client.get('/api/user-ingredients', headers=self.header)
+        finally:
+            del writebehind.buffer.write
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(writebehind.buffer.has_pending(self.user_id))
+
+        print(">Running test for the next read writing the kept updates.")
+        response = self.client.get('/api/user-ingredients', headers=self.header)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.inventory("apple"), (2, False))
+
+    def test_read_during_flush(self):
+        print("\n>Running test for a read waiting for the user's updates that another thread is writing.")
+        self.update_ingredient(self.header, "Apple", 1, "False")
+        self.update_ingredient(self.header, "Apple", 2, "False")
+        started, release, written = threading.Event(), threading.Event(), []
+
+        def slow(taken):
+            started.set()
+            release.wait(5)
+            written.append(taken)
+        writebehind.buffer.write = slow
+        try:
+            flusher = threading.Thread(target=writebehind.buffer.flush, args=('interval',))
+            flusher.start()
+            self.assertTrue(started.wait(5))
+            self.assertTrue(writebehind.buffer.has_pending(self.user_id))
+            user = User.query.get(self.user_id)
+            reader = threading.Thread(target=writebehind.flush_user, args=(user,))
+            reader.start()
+            reader.join(0.2)
+            self.assertTrue(reader.is_alive())
+            release.set()
+            flusher.join(5)
+            reader.join(5)
+        finally:
+            release.set()
+            del writebehind.buffer.write
+        self.assertFalse(reader.is_alive())
+        self.assertEqual(len(written), 1)
+        self.assertFalse(writebehind.buffer.has_pending(self.user_id))
+
+    def test_failed_write_closes_session(self):
+        print("\n>Running test for a failed update closing the session of the write.")
+        closed = []
+
+        class FailingSession:
+            def execute(self, statement, rows=None):
+                raise OperationalError("UPDATE inventory", {}, Exception("database is locked"))
+
+            def close(self):
+                closed.append(True)
+        session_factory = db.session.session_factory
+        db.session.session_factory = FailingSession
+        try:
+            with self.assertRaises(OperationalError):
+                writebehind.buffer.write({self.user_id: ("user:{}".format(self.user_id), {(False, 1): (1, False)}, 1)})
+        finally:
+            db.session.session_factory = session_factory
+        self.assertEqual(closed, [True])
+
+    def test_single_process(self):
+        print("\n>Running test for refusing to buffer updates with several server processes.")
+        workers = app.config['SERVER_WORKERS']
+        app.config['SERVER_WORKERS'] = 4
+        try:
+            with self.assertRaises(RuntimeError):
+                writebehind.require_single_process()
+        finally:
+            app.config['SERVER_WORKERS'] = workers
+        with self.assertRaises(RuntimeError):
+            writebehind.require_single_process("the asynchronous endpoints read the database directly")
+        app.config['WRITE_BEHIND_ENABLED'] = False
+        writebehind.require_single_process("the asynchronous endpoints read the database directly")
+
+    def inventory(self, name):
+        entry = db.session.query(Inventory.quantity, Inventory.favorite).join(Ingredients, Ingredients.id == Inventory.ingredient) \
+                          .filter(Inventory.user == self.user_id, Ingredients.name == name).one()
+        return tuple(entry)
+
+    def sample(self, name):
+        lines = [line for line in render_metrics().splitlines() if line.startswith(name + ' ')]
+        return int(lines[0].split()[1]) if lines else 0
+
@@ -7,3 +7,4 @@ export { default as NavItem } from "./side-nav/navItem";
 export { default as NavGroup } from "./side-nav/navGroup";
 export { default as TopNav } from "./top-nav/topNav";
 export { default as RecipeGridList } from "./grid-list/gridlist";
+export { default as Recommendations } from "./recommendations/recommendations";
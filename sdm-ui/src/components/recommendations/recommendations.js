@@ -0,0 +1,44 @@
+import React, { Component } from "react";
+import List from "@material-ui/core/List";
+import ListItem from "@material-ui/core/ListItem";
+import ListItemText from "@material-ui/core/ListItemText";
+import ListSubheader from "@material-ui/core/ListSubheader";
+import { recommendationsRequest } from "../../util/API";
+
+import { $primaryDarker, $lighter } from "../../theme/palette";
+
+class Recommendations extends Component {
+  constructor(props) {
+    super(props);
+    this.state = {
+      recommendations: [],
+    };
+  }
+
+  async componentDidMount() {
+    let resp = await recommendationsRequest();
+    this.setState({ recommendations: resp || [] });
+  }
+
+  render() {
+    if (this.state.recommendations.length === 0) return null;
+    return (
+      <List style={{ color: $primaryDarker, backgroundColor: $lighter }}>
+        {this.state.recommendations.map((group) => (
+          <li key={group.because}>
+            <ul style={{ padding: 0 }}>
+              <ListSubheader>Because you can make {group.because}</ListSubheader>
+              {group.recipes.map((recipe) => (
+                <ListItem key={recipe.name}>
+                  <ListItemText primary={recipe.name} />
+                </ListItem>
+              ))}
+            </ul>
+          </li>
+        ))}
+      </List>
+    );
+  }
+}
+
+export default Recommendations;
@@ -8,6 +8,7 @@ import {
   SideNav,
   NavGroup,
   NavItem,
+  Recommendations,
 } from "../../components";
 
 import "./myCabinet.scss";
@@ -103,6 +104,7 @@ class LayoutPage extends Component {
         </SideNav>
         <div className={"content-wrapper"}>
           <DataTable pageType={pageType} search={search} />
+          <Recommendations />
         </div>
       </div>
     );
@@ -227,6 +227,38 @@ export const partialRecipesRequest = async () => {
   }
 };
 
+/**
+ * Authenticated request for the recipes most similar to a recipe
+ *
+ * @param name
+ * @public
+ */
+export const similarRecipesRequest = async (name) => {
+  if (tokenIsValid()) {
+    let response = await authenticatedRequest(
+      "recipes/" + encodeURIComponent(name) + "/similar",
+      "GET"
+    );
+    if (response.recipes) {
+      return response.recipes;
+    }
+  }
+};
+
+/**
+ * Authenticated request for recipes similar to the ones the cabinet can make
+ *
+ * @public
+ */
+export const recommendationsRequest = async () => {
+  if (tokenIsValid()) {
+    let response = await authenticatedRequest("recommendations", "GET");
+    if (response.recommendations) {
+      return response.recommendations;
+    }
+  }
+};
+
 export const updateIngredientRequest = (name, favorite, quantity) => {
   if (tokenIsValid()) {
     let body = JSON.stringify({